@@ -6,18 +6,17 @@ import shutil
 import tempfile
 import os
 
-from flask import Blueprint
+from flask import Blueprint, Response, jsonify, stream_with_context
 from flask.views import MethodView
 from werkzeug.datastructures import FileStorage
 
+import ckan.authz as authz
 import ckan.lib.navl.dictization_functions as dict_fns
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
-import ckanapi
-
-from ckanext.ddi.importer import ddiimporter
+from ckanext.ddi.importer import profiling, timing
 
 log = logging.getLogger(__name__)
 
@@ -102,7 +101,10 @@ class ImportView(MethodView):
         except toolkit.NotAuthorized:
             return toolkit.abort(401, toolkit._('Unauthorized to create a package'))
 
-    def get(self, package_type, data=None, errors=None, error_summary=None):
+    def get(
+        self, package_type, data=None, errors=None, error_summary=None,
+        preview=None, preview_status=None,
+    ):
         self._check_auth()
 
         data = data or self._clean_request_form()
@@ -124,6 +126,8 @@ class ImportView(MethodView):
             'action': 'new',
             'stage': stage,
             'dataset_type': package_type,
+            'preview': preview,
+            'preview_status': preview_status,
         }
 
         toolkit.c.pkg = None
@@ -148,56 +152,59 @@ class ImportView(MethodView):
     def post(self, package_type):
         self._check_auth()
 
+        data = self._clean_request_form()
+        if data.get('preview'):
+            return self._preview(package_type, data)
+
+        from ckanext.ddi.importer import ddiimporter
+
         pkg_id = None
-        file_path = None
+        job_id = None
 
-        data = self._clean_request_form()
+        timer = timing.ImportTimer()
+        timer.start('request')
+        user = toolkit.c.user
+        importer = ddiimporter.DdiImporter(username=user, timer=timer)
 
-        try:
-            user = toolkit.c.user
-            importer = ddiimporter.DdiImporter(username=user)
+        profiler = None
+        if self._is_profiled(data):
+            profiler = profiling.ImportProfiler()
 
-            if isinstance(data.get('upload'), FileStorage):
+        try:
+            if self._is_async(data):
+                job_id = self._enqueue_import(user, data)
+            elif isinstance(data.get('upload'), FileStorage):
                 log.debug('upload: %s' % data['upload'])
-                file_path = self._save_temp_file(data['upload'].stream)
-                log.debug('file_path: %s' % file_path)
-                pkg_id = importer.run(
-                    file_path=file_path,
+                pkg_id = self._run(
+                    importer,
+                    profiler,
+                    data['upload'].filename,
                     upload=data['upload'],
                     data=data,
                 )
             elif data.get('url'):
                 log.debug('url: %s' % data['url'])
-                pkg_id = importer.run(
+                pkg_id = self._run(
+                    importer,
+                    profiler,
+                    data['url'],
                     url=data['url'],
                     data=data,
                 )
             else:
                 raise PackageImportError('An XML file (uploaded file or URL) is required')
 
-            registry = ckanapi.LocalCKAN(username=user)
-
-            resource_dict = {
-                'package_id': pkg_id,
-                'name': 'DDI RDF',
-                'format': 'rdf',
-                'url': '',
-                'type': 'attachment',
-                'file_type': 'other',
-            }
-            if isinstance(data.get('rdf_upload'), FileStorage):
-                resource_dict['upload'] = data['rdf_upload']
-                registry.call_action('resource_create', resource_dict)
-            elif data.get('rdf_url'):
-                resource_dict['url'] = data['rdf_url']
-                registry.call_action('resource_create', resource_dict)
-
-            toolkit.h.flash_success(
-                toolkit._(
-                    'Dataset import from XML successfully completed. '
-                    + 'You can now add data files to it.'
+            if importer.status == 'unchanged':
+                toolkit.h.flash_notice(
+                    toolkit._('The dataset is already up to date.')
+                )
+            elif pkg_id is not None:
+                toolkit.h.flash_success(
+                    toolkit._(
+                        'Dataset import from XML successfully completed. '
+                        + 'You can now add data files to it.'
+                    )
                 )
-            )
         except toolkit.ValidationError as e:
             errors = e.error_dict
             error_summary = e.error_summary
@@ -208,10 +215,16 @@ class ImportView(MethodView):
             }
             return self.get(package_type, data, errors)
         finally:
-            if file_path is not None:
-                os.remove(file_path)
+            if job_id is not None:
+                timer.report('queued')
+            else:
+                timer.report(importer.status or 'failed')
 
-        if pkg_id is not None:
+        if job_id is not None:
+            return toolkit.redirect_to(
+                toolkit.h.url_for('ddi_import.import_status', job_id=job_id)
+            )
+        elif pkg_id is not None:
             try:
                 toolkit.requires_ckan_version("2.9")
                 url = toolkit.h.url_for(
@@ -228,8 +241,94 @@ class ImportView(MethodView):
         else:
             return toolkit.redirect_to(toolkit.h.url_for('ddi_import.import'))
 
-    def _save_temp_file(self, fileobj):
-        fd, file_path = tempfile.mkstemp()
+    def _preview(self, package_type, data):
+        """
+            Show the dataset mapped from the DDI file and its validation
+            errors, without importing it
+        """
+        try:
+            result = toolkit.get_action('ddi_import_preview')(
+                self._get_context(), dict(data)
+            )
+        except toolkit.ValidationError as e:
+            return self.get(package_type, data, e.error_dict, e.error_summary)
+        except Exception as e:
+            errors = {
+                'import': toolkit._('Dataset import from XML failed: %s' % str(e))
+            }
+            return self.get(package_type, data, errors)
+
+        errors = result['errors']
+        error_summary = None
+        if errors:
+            error_summary = toolkit.ValidationError(errors).error_summary
+        return self.get(
+            package_type,
+            data,
+            errors,
+            error_summary,
+            preview=_get_preview_fields(result['pkg_dict']),
+            preview_status=result.get('status'),
+        )
+
+    def _is_profiled(self, data):
+        """
+            Sysadmins can profile an import with the `profile` field or
+            parameter if `ckanext.ddi.profile_imports` is enabled
+        """
+        if not profiling.is_enabled() or not authz.is_sysadmin(toolkit.c.user):
+            return False
+        return toolkit.asbool(
+            data.get('profile', toolkit.request.args.get('profile', False))
+        )
+
+    def _run(self, importer, profiler, source, **kwargs):
+        if profiler is None:
+            return importer.run(**kwargs)
+        try:
+            return profiler.run(importer, source, **kwargs)
+        finally:
+            if profiler.paths:
+                toolkit.h.flash_notice(
+                    toolkit._('Import profile saved to %s') % ', '.join(profiler.paths)
+                )
+
+    def _is_async(self, data):
+        return toolkit.asbool(
+            data.get(
+                'async',
+                toolkit.config.get('ckanext.ddi.async_imports', False)
+            )
+        )
+
+    def _enqueue_import(self, user, data):
+        """
+            Save the uploaded files where the background jobs worker can
+            read them, and enqueue the import
+        """
+        from ckanext.ddi import jobs
+
+        upload_dir = toolkit.config.get('ckanext.ddi.async_upload_dir')
+        files = {}
+        job_data = {}
+        for field, value in data.items():
+            if isinstance(value, FileStorage):
+                files[field] = (
+                    self._save_temp_file(value.stream, upload_dir),
+                    value.filename,
+                )
+            else:
+                job_data[field] = value
+
+        if 'upload' not in files and not data.get('url'):
+            for file_path, filename in files.values():
+                os.remove(file_path)
+            raise PackageImportError('An XML file (uploaded file or URL) is required')
+
+        return jobs.enqueue_import(user, job_data, files)
+
+    def _save_temp_file(self, fileobj, directory=None):
+        fd, file_path = tempfile.mkstemp(dir=directory)
         with os.fdopen(fd, 'wb') as output_file:
             fileobj.seek(0)
             shutil.copyfileobj(fileobj, output_file)
@@ -237,6 +336,99 @@ class ImportView(MethodView):
         return file_path
 
 
+def _get_preview_fields(pkg_dict):
+    """ Return the non empty fields of a previewed dataset as (name, text) """
+    fields = []
+    for key, value in sorted(pkg_dict.items()):
+        if isinstance(value, list):
+            value = u', '.join(
+                item.get('display_name') or item.get('name') or item.get('value', '')
+                if isinstance(item, dict) else u'%s' % item
+                for item in value
+            )
+        if value is not None and value != '':
+            fields.append((key, u'%s' % value))
+    return fields
+
+
+def import_status(package_type, job_id):
+    """
+        Status of an asynchronous import, as JSON (with `format=json` or
+        when requested by the Accept header) or as a page
+    """
+    from ckanext.ddi import jobs
+
+    user = toolkit.c.user
+    if not user:
+        return toolkit.abort(403, "Forbidden")
+
+    try:
+        status = jobs.get_import_status(job_id)
+    except KeyError:
+        return toolkit.abort(404, toolkit._('Import job not found'))
+
+    if status['user'] != user and not authz.is_sysadmin(user):
+        return toolkit.abort(403, "Forbidden")
+
+    accept = toolkit.request.accept_mimetypes
+    if (toolkit.request.args.get('format') == 'json' or
+            accept.best_match(['text/html', 'application/json']) == 'application/json'):
+        return jsonify(status)
+
+    return toolkit.render(
+        'ddi/import_status.html',
+        extra_vars={
+            u'status': status,
+            u'dataset_type': package_type,
+        },
+    )
+
+
+def import_timings(package_type):
+    """
+        Percentiles of the duration of each stage of the recent imports
+        handled by this process, as JSON (sysadmins only)
+    """
+    if not authz.is_sysadmin(toolkit.c.user):
+        return toolkit.abort(403, "Forbidden")
+    return jsonify(timing.get_histogram().get_summary())
+
+
+def export_ddi(package_type, id):
+    """
+        DDI codebook of a dataset, streamed
+
+        The ETag changes with the `metadata_modified` of the dataset and the
+        mapping, so clients can revalidate their copy without downloading it
+        again.
+    """
+    from ckanext.ddi import exporter
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+        'auth_user_obj': toolkit.c.userobj,
+    }
+    try:
+        pkg_dict = toolkit.get_action('package_show')(context, {'id': id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._('Unauthorized to read dataset %s') % id)
+
+    etag = exporter.get_etag(pkg_dict)
+    if toolkit.request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(
+            stream_with_context(exporter.export(pkg_dict, context)),
+            mimetype='application/xml',
+        )
+    response.set_etag(etag)
+    return response
+
+
 class PackageImportError(Exception):
     pass
 
@@ -246,3 +438,15 @@ ddi_import_blueprint.add_url_rule(
     view_func=ImportView.as_view(str(u'import')),
     strict_slashes=False,
 )
+ddi_import_blueprint.add_url_rule(
+    rule=u'/import/status/<job_id>',
+    view_func=import_status,
+)
+ddi_import_blueprint.add_url_rule(
+    rule=u'/import/timings',
+    view_func=import_timings,
+)
+ddi_import_blueprint.add_url_rule(
+    rule=u'/<id>/ddi.xml',
+    view_func=export_ddi,
+)
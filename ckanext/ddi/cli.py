@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+import ckan.plugins.toolkit as tk
+
+
+@click.group(short_help=u'DDI import and export commands')
+def ddi():
+    pass
+
+
+@ddi.command(u'import-batch')
+@click.argument(u'sources', nargs=-1, required=True)
+@click.option(u'--workers', type=int, default=None,
+              help=u'Number of parsing processes (defaults to the CPU count)')
+@click.option(u'--chunk-size', type=int, default=10,
+              help=u'Number of files parsed by a worker at once')
+@click.option(u'--user', default=None,
+              help=u'User creating the datasets (defaults to the site user)')
+@click.option(u'--owner-org', default=None,
+              help=u'Organization of the imported datasets')
+@click.option(u'--private/--public', default=None,
+              help=u'Visibility of the imported datasets')
+def import_batch(sources, workers, chunk_size, user, owner_org, private):
+    u'''Import DDI XML files in bulk
+
+    SOURCES are directories (all their .xml files are imported), glob
+    patterns, XML files or manifests listing one file per line.
+    '''
+    from ckanext.ddi.importer import batch
+
+    file_paths = batch.find_files(sources)
+    if not file_paths:
+        tk.error_shout(u'No DDI files found')
+        raise click.Abort()
+
+    if user is None:
+        user = tk.get_action(u'get_site_user')({u'ignore_auth': True}, {})
+        user = user[u'name']
+
+    data = {}
+    if owner_org is not None:
+        data[u'owner_org'] = owner_org
+    if private is not None:
+        data[u'private'] = private
+
+    click.echo(u'Importing %d files' % len(file_paths))
+    importer = batch.BatchImporter(
+        user, workers=workers, chunk_size=chunk_size, data=data or None
+    )
+    stats = importer.run(file_paths)
+
+    for file_path, error in stats.failures:
+        tk.error_shout(u'%s: %s' % (file_path, error))
+    click.secho(stats.summary(), fg=u'green' if not stats.failures else u'red')
+
+
+@ddi.command(u'export')
+@click.argument(u'dataset')
+@click.option(u'--output', u'-o', default=u'-',
+              help=u'Output file, stdout by default')
+def export(dataset, output):
+    u'''Export a dataset as a DDI codebook'''
+    from ckanext.ddi import exporter
+
+    context = {u'ignore_auth': True}
+    try:
+        pkg_dict = tk.get_action(u'package_show')(context, {u'id': dataset})
+    except tk.ObjectNotFound:
+        tk.error_shout(u'Dataset not found: %s' % dataset)
+        raise click.Abort()
+
+    with click.open_file(output, u'wb') as output_file:
+        for chunk in exporter.export(pkg_dict, context):
+            output_file.write(chunk)
+
+
+def get_commands():
+    return [ddi]
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+    Export of datasets as DDI codebooks
+
+    The codebook is built by inverting the mapping used by the importer
+    (`DdiCkanMetadata.mapping`): every key mapped from a plain element or
+    attribute path of `stdyDscr` is written back to that path. Keys mapped
+    from several elements (eg `author`, `data_collection_dates`) are not
+    exported.
+
+    Documents are streamed with lxml's incremental writer, and the variables
+    of the data dictionary are read and written one at a time, so the memory
+    used does not depend on the number of variables.
+"""
+import collections
+import itertools
+import os
+import re
+import tempfile
+
+import six
+from lxml import etree
+
+import ckan.lib.uploader as uploader
+import ckan.plugins.toolkit as tk
+
+from ckanext.ddi.importer import mapping, metadata, variables
+
+import logging
+log = logging.getLogger(__name__)
+
+# The codebooks are written in the DDI version read by the importer, so
+# that exported datasets can be imported again
+DDI_NAMESPACE = metadata.namespaces['ddi']
+DDI_VERSION = '1.2.2'
+DDI_SCHEMA = 'http://www.icpsr.umich.edu/DDI/Version1-2-2.xsd'
+XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
+# Size of the chunks of the streamed document
+CHUNK_SIZE = 64 * 1024
+
+# Keys not exported: the CKAN id and license don't come from the codebook,
+# and `notes` holds the abstract once imported
+EXCLUDED_KEYS = ('id', 'license_id', 'notes')
+# Fields the importer copies some keys to (see DdiImporter.improve_pkg_dict),
+# used when the dataset doesn't have the key itself
+FALLBACK_KEYS = {
+    'abstract': 'notes',
+    'abbreviation': 'short_title',
+    'id_number': 'original_id',
+    'unit_of_analysis': 'unit_of_measurement',
+}
+
+# Order of the children of the DDI elements written by the exporter
+CHILDREN_ORDER = {
+    'codeBook': ('docDscr', 'stdyDscr', 'fileDscr', 'dataDscr', 'otherMat'),
+    'stdyDscr': ('citation', 'studyAuthorization', 'stdyInfo', 'method',
+                 'dataAccs', 'othrStdyMat', 'notes'),
+    'citation': ('titlStmt', 'rspStmt', 'prodStmt', 'distStmt', 'serStmt',
+                 'verStmt', 'biblCit', 'holdings', 'notes'),
+    'titlStmt': ('titl', 'subTitl', 'altTitl', 'parTitl', 'IDNo'),
+    'rspStmt': ('AuthEnty', 'othId'),
+    'prodStmt': ('producer', 'copyright', 'prodDate', 'prodPlac', 'software',
+                 'fundAg', 'grantNo'),
+    'distStmt': ('distrbtr', 'contact', 'depositr', 'depDate', 'distDate'),
+    'serStmt': ('serName', 'serInfo'),
+    'verStmt': ('version', 'verResp', 'notes'),
+    'stdyInfo': ('studyBudget', 'subject', 'abstract', 'sumDscr',
+                 'qualityStatement', 'notes', 'exPostEvaluation'),
+    'subject': ('keyword', 'topcClas'),
+    'sumDscr': ('timePrd', 'collDate', 'nation', 'geogCover', 'geogUnit',
+                'geoBndBox', 'boundPoly', 'anlyUnit', 'universe', 'dataKind'),
+    'method': ('dataColl', 'notes', 'anlyInfo', 'stdyClas', 'dataProcessing',
+               'codingInstructions'),
+    'dataColl': ('timeMeth', 'dataCollector', 'collectorTraining', 'frequenc',
+                 'sampProc', 'sampleFrame', 'targetSampleSize', 'deviat',
+                 'collMode', 'resInstru', 'instrumentDevelopment', 'sources',
+                 'collSitu', 'actMin', 'ConOps', 'weight', 'cleanOps'),
+    'anlyInfo': ('respRate', 'EstSmpErr', 'dataAppr'),
+    'dataAccs': ('setAvail', 'useStmt', 'notes'),
+    'setAvail': ('accsPlac', 'origArch', 'avlStatus', 'collSize', 'complete',
+                 'fileQnty', 'notes'),
+    'useStmt': ('confDec', 'specPerm', 'restrctn', 'contact', 'citReq',
+                'deposReq', 'conditions', 'disclaimer'),
+}
+
+ExportField = collections.namedtuple(
+    'ExportField', 'key path attribute multiple separator'
+)
+
+
+def _tag(name):
+    return '{%s}%s' % (DDI_NAMESPACE, name)
+
+
+def _get_target(xpath):
+    """
+        Return the element names (from `stdyDscr`) and the attribute an
+        expression of the mapping selects, or None if it isn't a plain path
+    """
+    anchor, relative_xpath = metadata.anchor_xpath(xpath)
+    if anchor != 'stdyDscr' or re.search(r'[\[\]()|*]', relative_xpath):
+        return None
+    steps = [step for step in relative_xpath[1:].split('/') if step]
+    attribute = None
+    if steps and steps[-1].startswith('@'):
+        attribute = steps.pop()[1:]
+    if not steps or not all(step.startswith('ddi:') for step in steps):
+        return None
+    return ('stdyDscr',) + tuple(step[len('ddi:'):] for step in steps), attribute
+
+
+def get_fields(mapping):
+    """
+        Return the ExportFields of the keys of a mapping that can be
+        inverted, in the order they claim their elements
+    """
+    fields = []
+    for key in sorted(mapping):
+        if key in EXCLUDED_KEYS:
+            continue
+        value = mapping[key]
+        separator = None
+        if isinstance(value, metadata.XPathTextValue):
+            xpath, multiple = value.get_xpaths()[0], False
+        elif isinstance(value, metadata.ArrayTextValue) and \
+                isinstance(value._config, metadata.XPathMultiValue):
+            xpath, multiple = value._config.get_xpaths()[0], True
+            separator = value.env.get('separator', ' ')
+        elif isinstance(value, (metadata.ArrayDictValue, metadata.ArrayValue)) and \
+                len(value.get_xpaths()) == 1 and \
+                isinstance(value._config[0], metadata.XPathMultiValue):
+            xpath, multiple = value.get_xpaths()[0], True
+        else:
+            continue
+        target = _get_target(xpath)
+        if target is None:
+            continue
+        path, attribute = target
+        fields.append(ExportField(key, path, attribute, multiple, separator))
+    return fields
+
+
+def _get_texts(pkg_dict, field):
+    """ Return the texts of the elements of a field of a dataset """
+    value = pkg_dict.get(field.key)
+    if not value and field.key in FALLBACK_KEYS:
+        value = pkg_dict.get(FALLBACK_KEYS[field.key])
+    if not value:
+        return []
+    if not isinstance(value, list):
+        value = six.text_type(value)
+        if field.multiple:
+            # lists of dicts (eg data_collector) are stored comma separated
+            value = value.split(field.separator or ',')
+        else:
+            value = [value]
+    texts = []
+    for item in value:
+        if isinstance(item, dict):
+            item = item.get('display_name') or item.get('name') or item.get('value')
+        if item is not None and six.text_type(item).strip():
+            texts.append(six.text_type(item).strip())
+    return texts
+
+
+class _Node(object):
+    """ Element of the codebook being exported """
+    def __init__(self, name):
+        self.name = name
+        self.texts = []
+        self.attrib = collections.OrderedDict()
+        self.children = collections.OrderedDict()
+
+    def get_child(self, name):
+        if name not in self.children:
+            self.children[name] = _Node(name)
+        return self.children[name]
+
+    def get_children(self):
+        order = CHILDREN_ORDER.get(self.name, ())
+        return sorted(
+            self.children.values(),
+            key=lambda child: order.index(child.name) if child.name in order
+            else len(order),
+        )
+
+
+class _Buffer(object):
+    """ File-like object keeping what is written until it is popped """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+class DdiExporter(object):
+    """
+        Writer of the DDI codebook of a dataset, with the mapping of
+        `metadata_class` (by default the mapping file, if any)
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE, metadata_class=None):
+        self.chunk_size = chunk_size
+        self.metadata_class = metadata_class or mapping.get_metadata_class()
+        self.fields = get_fields(self.metadata_class().get_mapping())
+
+    def get_tree(self, pkg_dict):
+        """
+            Return the `codeBook` node of a dataset, with the elements of
+            the fields that have a value
+
+            When several keys map to the same element (eg `abstract` and
+            `description`), the first one with a value is exported.
+        """
+        root = _Node('codeBook')
+        for field in self.fields:
+            texts = _get_texts(pkg_dict, field)
+            if not texts:
+                continue
+            node = root
+            for name in field.path:
+                node = node.get_child(name)
+            if field.attribute is not None:
+                node.attrib.setdefault(field.attribute, texts[0])
+            elif not node.texts:
+                node.texts = texts
+        return root
+
+    def generate(self, pkg_dict, variables=()):
+        """
+            Yield the codebook of a dataset, with the `variables` of its
+            data dictionary (dicts with the keys of `variables.FIELDS`), as
+            chunks of bytes
+        """
+        output = _Buffer()
+        variables = iter(variables)
+        with etree.xmlfile(output, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element(
+                _tag('codeBook'),
+                {
+                    'version': DDI_VERSION,
+                    '{%s}schemaLocation' % XSI_NAMESPACE:
+                        '%s %s' % (DDI_NAMESPACE, DDI_SCHEMA),
+                },
+                nsmap={None: DDI_NAMESPACE, 'xsi': XSI_NAMESPACE},
+            ):
+                for child in self.get_tree(pkg_dict).get_children():
+                    self._write_node(xf, child)
+                first = next(variables, None)
+                if first is not None:
+                    with xf.element(_tag('dataDscr')):
+                        for variable in itertools.chain([first], variables):
+                            self._write_variable(xf, variable)
+                            xf.flush()
+                            if output.size >= self.chunk_size:
+                                yield output.pop()
+        yield output.pop()
+
+    def _write_node(self, xf, node):
+        for text in node.texts or [None]:
+            with xf.element(_tag(node.name), node.attrib):
+                if text is not None:
+                    xf.write(text)
+                for child in node.get_children():
+                    self._write_node(xf, child)
+
+    def _element(self, xf, name, text, **attrib):
+        with xf.element(_tag(name), attrib):
+            xf.write(text)
+
+    def _write_variable(self, xf, variable):
+        attrib = {'name': variable['name']}
+        if variable.get('interval'):
+            attrib['intrvl'] = variable['interval']
+        with xf.element(_tag('var'), attrib):
+            if variable.get('label'):
+                self._element(xf, 'labl', variable['label'])
+            if variable.get('question'):
+                with xf.element(_tag('qstn')):
+                    self._element(xf, 'qstnLit', variable['question'])
+            for statistic, name in sorted(variables.SUMMARY_STATISTICS.items()):
+                value = _format_number(variable.get(name))
+                if value:
+                    self._element(xf, 'sumStat', value, type=statistic)
+            for value, label in _get_categories(variable.get('categories')):
+                with xf.element(_tag('catgry')):
+                    self._element(xf, 'catValu', value)
+                    if label:
+                        self._element(xf, 'labl', label)
+            if variable.get('type'):
+                with xf.element(_tag('varFormat'), {'type': variable['type']}):
+                    pass
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    if value is None:
+        return ''
+    return six.text_type(value)
+
+
+def _get_categories(categories):
+    """ Return the (value, label) pairs of the `categories` of a variable """
+    pairs = []
+    for category in (categories or '').split('; '):
+        if category:
+            value, separator, label = category.partition('=')
+            pairs.append((value, label))
+    return pairs
+
+
+def iter_data_dictionary(pkg_dict, context=None, chunk_size=None):
+    """
+        Yield the variables of the data dictionary of a dataset, read from
+        its DataStore table or its uploaded CSV file
+    """
+    resource = variables.get_data_dictionary_resource(pkg_dict)
+    if resource is None:
+        return
+
+    if resource.get('datastore_active'):
+        for variable in _iter_datastore(resource['id'], context, chunk_size):
+            yield variable
+    elif resource.get('url_type') == 'upload':
+        file_path = uploader.get_resource_uploader(resource).get_path(resource['id'])
+        if not os.path.exists(file_path):
+            log.warning('Data dictionary file not found: %s' % file_path)
+            return
+        for variable in variables.read_csv(file_path):
+            yield variable
+
+
+def _iter_datastore(resource_id, context=None, chunk_size=None):
+    chunk_size = chunk_size or variables.get_chunk_size()
+    offset = 0
+    while True:
+        result = tk.get_action('datastore_search')(dict(context or {}), {
+            'resource_id': resource_id,
+            'limit': chunk_size,
+            'offset': offset,
+            'sort': '_id',
+        })
+        for record in result['records']:
+            yield record
+        if len(result['records']) < chunk_size:
+            break
+        offset += chunk_size
+
+
+def is_cache_enabled():
+    return tk.asbool(tk.config.get('ckanext.ddi.export_cache', True))
+
+
+def get_cache_dir():
+    return tk.config.get('ckanext.ddi.export_cache_dir') or os.path.join(
+        tempfile.gettempdir(), 'ckanext-ddi-exports'
+    )
+
+
+def get_etag(pkg_dict):
+    """
+        Return the version of the export of a dataset, which changes with
+        the dataset, its data dictionary and the mapping
+
+        The variables are written to the DataStore after the dataset is
+        saved, and the data dictionary resource is only marked as modified
+        once they all are.
+    """
+    resource = variables.get_data_dictionary_resource(pkg_dict) or {}
+    return '%s-%s-%s-%s' % (
+        pkg_dict['id'],
+        re.sub(r'[^0-9]', '', pkg_dict.get('metadata_modified') or ''),
+        re.sub(r'[^0-9]', '', resource.get('last_modified') or ''),
+        mapping.get_metadata_class()().get_fingerprint(),
+    )
+
+
+class ExportCache(object):
+    """
+        Exported codebooks saved on disk, one per dataset and version (see
+        get_etag)
+
+        A codebook is saved while it is streamed the first time, and
+        replaces the previous export of the dataset once it is complete.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or get_cache_dir()
+
+    def get_path(self, pkg_dict):
+        return os.path.join(self.directory, get_etag(pkg_dict) + '.xml')
+
+    def stream(self, pkg_dict, generate):
+        """
+            Yield the cached codebook of a dataset, or the chunks of
+            `generate()` while saving them
+        """
+        file_path = self.get_path(pkg_dict)
+        try:
+            cache_file = open(file_path, 'rb')
+        except IOError:
+            cache_file = None
+        if cache_file is not None:
+            with cache_file:
+                for chunk in iter(lambda: cache_file.read(CHUNK_SIZE), b''):
+                    yield chunk
+            return
+
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in generate():
+                    temp_file.write(chunk)
+                    yield chunk
+            self._remove_exports(pkg_dict['id'])
+            os.rename(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _remove_exports(self, package_id):
+        """ Remove the previous exports of a dataset """
+        for name in os.listdir(self.directory):
+            if name.startswith(package_id + '-') and name.endswith('.xml'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+def export(pkg_dict, context=None):
+    """
+        Return the DDI codebook of a dataset (the result of package_show) as
+        an iterator of bytes, from the cache if enabled
+
+        `context` is used to read the data dictionary from the DataStore.
+    """
+    exporter = DdiExporter()
+
+    def generate():
+        return exporter.generate(pkg_dict, iter_data_dictionary(pkg_dict, context))
+
+    if not is_cache_enabled():
+        return generate()
+    return ExportCache().stream(pkg_dict, generate)
@@ -1,2 +1,22 @@
-from ckanext.ddi.importer.ddiimporter import DdiImporter
-from ckanext.ddi.importer.metadata import DdiCkanMetadata
+import sys
+
+# DdiImporter and DdiCkanMetadata are imported on first use on Python 3.7+
+# (PEP 562), so that importing a submodule of the package (eg variables)
+# does not load them. ddiimporter itself still imports lxml, ckanapi,
+# ckanext-harvest and ckanext-scheming when it is loaded.
+if sys.version_info < (3, 7):
+    from ckanext.ddi.importer.ddiimporter import DdiImporter  # noqa
+    from ckanext.ddi.importer.metadata import DdiCkanMetadata  # noqa
+else:
+    _LAZY_ATTRIBUTES = {
+        'DdiImporter': 'ckanext.ddi.importer.ddiimporter',
+        'DdiCkanMetadata': 'ckanext.ddi.importer.metadata',
+    }
+
+    def __getattr__(name):
+        if name not in _LAZY_ATTRIBUTES:
+            raise AttributeError(
+                'module %r has no attribute %r' % (__name__, name)
+            )
+        import importlib
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from werkzeug.datastructures import FileStorage
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from ckanext.ddi.importer import cache, mapping
+from ckanext.ddi.importer.ddiimporter import DdiImporter, NameAllocator
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def find_files(sources):
+    """
+        Return the DDI files to import from a list of directories (all the
+        `.xml` files they contain), glob patterns, XML files or manifests
+        (text files with one path per line)
+    """
+    file_paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            file_paths.extend(sorted(glob.glob(os.path.join(source, '*.xml'))))
+        elif os.path.isfile(source) and not source.lower().endswith('.xml'):
+            base_path = os.path.dirname(source)
+            with open(source) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        file_paths.append(os.path.join(base_path, line))
+        elif os.path.isfile(source):
+            file_paths.append(source)
+        else:
+            file_paths.extend(sorted(glob.glob(source)))
+    return file_paths
+
+
+def parse_files(file_paths, data=None):
+    """
+        Parse and map a chunk of DDI files
+
+        This runs in the worker processes of a BatchImporter, so errors are
+        returned as strings instead of being raised.
+    """
+    results = []
+    importer = DdiImporter()
+    ckan_metadata = mapping.get_metadata_class()()
+    for file_path in file_paths:
+        try:
+            with open(file_path, 'rb') as xml_file:
+                pkg_dict = ckan_metadata.load_stream(xml_file)
+            pkg_dict = importer.improve_pkg_dict(pkg_dict, None, data)
+            results.append((file_path, pkg_dict, None))
+        except Exception as e:
+            results.append((file_path, None, str(e) or repr(e)))
+    return results
+
+
+class BatchImportStats(object):
+    """ Counters of a batch import """
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.files = 0
+        self.bytes = 0
+        self.imported = 0
+        self.unchanged = 0
+        self.failures = []
+
+    def add(self, file_path, error=None, status=None):
+        self.files += 1
+        try:
+            self.bytes += os.path.getsize(file_path)
+        except OSError:
+            pass
+        if error is not None:
+            self.failures.append((file_path, error))
+        elif status == 'unchanged':
+            self.unchanged += 1
+        else:
+            self.imported += 1
+
+    def finish(self):
+        self.end_time = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-6)
+        return (
+            '%d files (%.1f MB) in %.1fs: %.2f files/s, %.2f MB/s, '
+            '%d imported, %d unchanged, %d failures' % (
+                self.files,
+                self.bytes / 1e6,
+                elapsed,
+                self.files / elapsed,
+                self.bytes / 1e6 / elapsed,
+                self.imported,
+                self.unchanged,
+                len(self.failures),
+            )
+        )
+
+
+class BatchImporter(object):
+    """
+        Import DDI files in bulk
+
+        Files are parsed and mapped in chunks of `chunk_size` by a pool of
+        `workers` processes, and the resulting datasets are written by the
+        calling process. At most two chunks per worker are waiting to be
+        written at any time.
+
+        The names of the datasets are allocated by a NameAllocator shared by
+        the whole batch.
+    """
+    def __init__(self, username, workers=None, chunk_size=10, data=None):
+        self.username = username
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunk_size = max(chunk_size, 1)
+        self.data = data
+        self.name_allocator = NameAllocator()
+
+    def run(self, file_paths):
+        stats = BatchImportStats()
+
+        # Don't share the open database connections with the workers
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for file_path, pkg_dict, error in self._parse(executor, file_paths):
+                status = None
+                if error is None:
+                    status, error = self._write(file_path, pkg_dict)
+                if error is not None:
+                    log.warning('Could not import %s: %s' % (file_path, error))
+                stats.add(file_path, error, status)
+
+        stats.finish()
+        return stats
+
+    def _parse(self, executor, file_paths):
+        max_pending = 2 * self.workers
+        pending = set()
+        for i in range(0, len(file_paths), self.chunk_size):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        yield result
+            chunk = file_paths[i:i + self.chunk_size]
+            pending.add(executor.submit(parse_files, chunk, self.data))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    yield result
+
+    def _write(self, file_path, pkg_dict):
+        """ Import a dataset, return its status and the error if it failed """
+        importer = DdiImporter(
+            username=self.username, name_allocator=self.name_allocator
+        )
+        try:
+            with open(file_path, 'rb') as xml_file:
+                with importer.timer.stage('hashing'):
+                    content_hash = cache.get_content_hash(xml_file)
+                upload = FileStorage(
+                    xml_file, filename=os.path.basename(file_path)
+                )
+                name = importer.insert_or_update_pkg(
+                    pkg_dict,
+                    upload,
+                    resources=lambda: importer.get_data_dictionary_resources(
+                        file_path
+                    ),
+                    content_hash=content_hash,
+                )
+            importer.write_data_dictionary(name, file_path)
+        except tk.ValidationError as e:
+            return None, str(e.error_dict)
+        except Exception as e:
+            return None, str(e) or repr(e)
+        finally:
+            importer.timer.report(importer.status or 'failed')
+        return importer.status, None
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    Cache of the metadata mapped from DDI documents
+
+    The same document is often imported several times within minutes
+    (previews followed by the import, retries after validation errors, the
+    same study imported by several organizations). The mapped metadata is
+    cached by the SHA-256 of the document and the fingerprint of the mapping,
+    so those imports don't parse the document again.
+
+    The cache is kept in the memory of each process by default. With
+    `ckanext.ddi.metadata_cache_backend = redis`, it is shared by all the
+    processes through the Redis server CKAN uses.
+"""
+import collections
+import copy
+import hashlib
+import json
+import threading
+import time
+
+import ckan.plugins.toolkit as tk
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'memory'
+DEFAULT_SIZE = 100
+DEFAULT_TTL = 3600
+HASH_CHUNK_SIZE = 64 * 1024
+REDIS_KEY_PREFIX = 'ckanext-ddi:metadata:'
+# Version of the cached values, to be changed when the way values are
+# mapped changes without the mapping itself changing
+CACHE_VERSION = 1
+
+
+def get_content_hash(source):
+    """
+        Return the SHA-256 of a DDI document, a file path or a seekable
+        file object (which is rewound)
+    """
+    content_hash = hashlib.sha256()
+    if hasattr(source, 'read'):
+        source.seek(0)
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+        source.seek(0)
+    else:
+        with open(source, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(HASH_CHUNK_SIZE), b''):
+                content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def get_key(ckan_metadata, content_hash):
+    """
+        Return the cache key of the metadata mapped by `ckan_metadata` (a
+        CkanMetadata) from a DDI document, given its `content_hash` (see
+        get_content_hash)
+    """
+    return '%d:%s:%s' % (
+        CACHE_VERSION, ckan_metadata.get_fingerprint(), content_hash
+    )
+
+
+class MetadataCache(object):
+    """
+        Mapped metadata of the last `size` DDI documents, for `ttl` seconds
+
+        Copies are stored and returned, as the importer modifies the dicts
+        it gets.
+    """
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (expiry time, value) by key, least recently used first
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+            if item[0] is not None and item[0] < time.time():
+                return None
+            self.items[key] = item
+        return copy.deepcopy(item[1])
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        expiry = time.time() + self.ttl if self.ttl > 0 else None
+        item = (expiry, copy.deepcopy(value))
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = item
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class RedisMetadataCache(object):
+    """
+        Mapped metadata shared by the processes through Redis, as JSON, for
+        `ttl` seconds
+
+        The number of documents is bounded by the TTL and the memory policy
+        of the Redis server rather than by a size. `connection` can be any
+        object with the `get`, `set`, `scan_iter` and `delete` methods of a
+        Redis client.
+    """
+    def __init__(self, connection, ttl=DEFAULT_TTL, prefix=REDIS_KEY_PREFIX):
+        self.connection = connection
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.connection.get(self.prefix + key)
+        except Exception as e:
+            log.warning('Could not read the DDI metadata cache: %r' % e)
+            return None
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return json.loads(value)
+
+    def set(self, key, value):
+        try:
+            self.connection.set(
+                self.prefix + key,
+                json.dumps(value).encode('utf-8'),
+                ex=self.ttl if self.ttl > 0 else None,
+            )
+        except Exception as e:
+            log.warning('Could not write the DDI metadata cache: %r' % e)
+
+    def clear(self):
+        for key in self.connection.scan_iter(self.prefix + '*'):
+            self.connection.delete(key)
+
+
+_caches = {}
+
+
+def get_cache():
+    """
+        Return the metadata cache set by `ckanext.ddi.metadata_cache_backend`
+        ('memory' or 'redis'), holding the metadata of
+        `ckanext.ddi.metadata_cache_size` documents (in memory, 0 disables
+        the cache) for `ckanext.ddi.metadata_cache_ttl` seconds
+    """
+    backend = tk.config.get('ckanext.ddi.metadata_cache_backend', DEFAULT_BACKEND)
+    size = tk.asint(tk.config.get('ckanext.ddi.metadata_cache_size', DEFAULT_SIZE))
+    ttl = tk.asint(tk.config.get('ckanext.ddi.metadata_cache_ttl', DEFAULT_TTL))
+    if size <= 0:
+        backend = DEFAULT_BACKEND
+    cache = _caches.get((backend, size, ttl))
+    if cache is None:
+        if backend == 'redis':
+            from ckan.lib.redis import connect_to_redis
+            cache = RedisMetadataCache(connect_to_redis(), ttl)
+        else:
+            if backend != DEFAULT_BACKEND:
+                log.warning('Unknown DDI metadata cache backend: %s' % backend)
+            cache = MetadataCache(size, ttl)
+        _caches[(backend, size, ttl)] = cache
+    return cache
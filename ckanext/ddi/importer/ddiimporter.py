@@ -1,12 +1,22 @@
+import hashlib
+import json
+import os
 import re
+import threading
+from contextlib import contextmanager
 
-import requests
-import codecs
+import six
+from sqlalchemy import or_
+from werkzeug.datastructures import FileStorage
 
+import ckan.lib.plugins as lib_plugins
+import ckan.lib.uploader as uploader
+import ckan.model as model
+import ckan.plugins as plugins
 import ckan.plugins.toolkit as tk
 from ckan.lib.munge import munge_title_to_name, munge_name
 from ckanext.harvest.harvesters import HarvesterBase
-from ckanext.ddi.importer import metadata
+from ckanext.ddi.importer import cache, fetch, mapping, timing, variables
 
 from ckanext.scheming.helpers import scheming_get_dataset_schema
 
@@ -15,28 +25,114 @@ import ckanapi
 import logging
 log = logging.getLogger(__name__)
 
+# Dataset field storing the digest of the imported metadata, or key of the
+# extra storing it if the scheming schema has no such field
+DIGEST_FIELD = 'ddi_digest'
+# Maximum number of digits appended to make dataset names unique
+NAME_SUFFIX_LENGTH = 3
+
 
 class DdiImporter(HarvesterBase):
-    def __init__(self, username=None):
+    def __init__(self, username=None, on_stage=None, name_allocator=None, timer=None):
         self.username = username
+        self.on_stage = on_stage
+        self.name_allocator = name_allocator
+        self.status = None
+        # Imports report their own timings, unless the timer is shared with
+        # the caller (eg the import view), which then reports them
+        self.report_timings = timer is None
+        self.timer = timer or timing.ImportTimer()
+        # Time spent on each key of the mapping, set when profiling
+        self.mapping_timings = None
+        # SHA-256 of the last DDI document mapped, part of the digest
+        self.content_hash = None
+
+    def set_stage(self, stage):
+        """
+            Report the current stage of the import ('fetching', 'parsing' or
+            'creating') to the `on_stage` callback
+        """
+        if self.on_stage is not None:
+            self.on_stage(stage)
 
     def run(self, file_path=None, url=None, params=None, upload=None, data=None):
-        pkg_dict = None
-        ckan_metadata = metadata.DdiCkanMetadata()
+        """
+            Import a dataset from a DDI file path, uploaded file or URL, and
+            return its name
+
+            The duration of each stage of the import is reported to the
+            timing sinks (see ckanext.ddi.importer.timing).
+        """
+        self.status = None
+        if self.report_timings:
+            self.timer = timing.ImportTimer()
+        try:
+            with self.timer.stage('total'):
+                return self._run(file_path, url, params, upload, data)
+        finally:
+            if self.report_timings:
+                self.timer.report(self.status or 'failed')
+
+    def _run(self, file_path=None, url=None, params=None, upload=None, data=None):
+        with self._open_source(file_path, url, upload) as (source, fetched_url):
+            return self._import(source, fetched_url, params, upload, data)
+
+    def preview(self, file_path=None, url=None, params=None, upload=None, data=None):
+        """
+            Map a DDI file path, uploaded file or URL and validate the
+            resulting dataset without writing it
+
+            Returns the mapped dataset and the validation errors (an empty
+            dict if it can be imported), and sets the outcome the import
+            would have as `status`. The mapped metadata is cached, so
+            importing the same file afterwards doesn't parse it again.
+        """
+        with self._open_source(file_path, url, upload) as (source, fetched_url):
+            pkg_dict = self._get_pkg_dict(source, fetched_url, params, data)
+        return pkg_dict, self.check_pkg_dict(pkg_dict, self.content_hash)
+
+    @contextmanager
+    def _open_source(self, file_path=None, url=None, upload=None):
+        """
+            Yield the DDI document to import (a file path or a file object)
+            and the URL it was fetched from, if any
+        """
+        xml_file = None
         if file_path is not None:
-            with codecs.open(file_path, 'rb') as xml_file:
-                pkg_dict = ckan_metadata.load(xml_file.read())
+            source = file_path
+            self.timer.add_bytes('parsing', os.path.getsize(file_path))
+        elif upload is not None:
+            # Parse the uploaded file from its (spooled) stream, which is
+            # then rewound to be hashed and stored as the DDI XML resource
+            source = upload.stream
+            self.timer.add_bytes('parsing', timing.get_size(upload.stream))
         elif url is not None:
             log.debug('Fetch file from %s' % url)
+            self.set_stage('fetching')
             try:
-                r = requests.get(url)
-            except requests.exceptions.RequestException as e:
+                with self.timer.stage('fetching'):
+                    xml_file = source = fetch.fetch(url)
+            except fetch.FetchError as e:
                 raise ContentFetchError(
-                    'Error while getting URL %s: %r'
+                    'Error while getting URL %s: %s'
                     % (url, e)
                 )
+            self.timer.add_bytes('fetching', timing.get_size(xml_file))
+        else:
+            raise ContentImportError('A DDI file (path, upload or URL) is required')
+
+        try:
+            yield source, url if xml_file else None
+        finally:
+            if xml_file is not None:
+                xml_file.close()
 
-            pkg_dict = ckan_metadata.load(r.content)
+    def _get_pkg_dict(self, source, url=None, params=None, data=None):
+        """ Return the dataset mapped from a DDI document """
+        self.set_stage('parsing')
+        pkg_dict = self._load(mapping.get_metadata_class()(), source)
+
+        if url is not None:
             resources = []
 
             # if we can assume the URL is from a NADA catalogue
@@ -66,9 +162,28 @@ class DdiImporter(HarvesterBase):
             })
             pkg_dict['resources'] = resources
 
-        pkg_dict = self.improve_pkg_dict(pkg_dict, params, data)
+        with self.timer.stage('improving'):
+            return self.improve_pkg_dict(pkg_dict, params, data)
+
+    def _import(self, source, url=None, params=None, upload=None, data=None):
+        pkg_dict = self._get_pkg_dict(source, url, params, data)
+
+        # The CSV files of the data dictionary are closed once stored
+        csv_uploads = []
+
+        def resources():
+            data_dictionary = self.get_data_dictionary_resources(source)
+            csv_uploads.extend(resource['upload'] for resource in data_dictionary)
+            return get_rdf_resources(data) + data_dictionary
+
+        self.set_stage('creating')
         try:
-            return self.insert_or_update_pkg(pkg_dict, upload)
+            name = self.insert_or_update_pkg(
+                pkg_dict,
+                upload,
+                resources=resources,
+                content_hash=self.content_hash,
+            )
         except tk.ValidationError as e:
             raise e
         except Exception as e:
@@ -76,56 +191,285 @@ class DdiImporter(HarvesterBase):
                 'Could not import dataset %s: %s'
                 % (pkg_dict.get('name', ''), e)
             )
+        finally:
+            for csv_upload in csv_uploads:
+                csv_upload.close()
+
+        self.write_data_dictionary(name, source)
+        return name
+
+    def get_data_dictionary_resources(self, source):
+        """
+            Return the CSV data dictionary resource of the variables of a DDI
+            document, if `ckanext.ddi.data_dictionary` is 'csv' and it has
+            variables
+        """
+        if variables.get_mode() != 'csv':
+            return []
+        with self.timer.stage('variables'):
+            try:
+                csv_upload = variables.get_csv_upload(source)
+            finally:
+                _rewind(source)
+        if csv_upload is None:
+            return []
+        return [get_attachment(
+            variables.DATA_DICTIONARY_NAME, 'csv', upload=csv_upload
+        )]
+
+    def write_data_dictionary(self, name, source):
+        """
+            Write the variables of a DDI document to a DataStore table of the
+            dataset, if `ckanext.ddi.data_dictionary` is 'datastore' and the
+            dataset was written
+        """
+        if variables.get_mode() != 'datastore' or self.status == 'unchanged':
+            return
+        registry = ckanapi.LocalCKAN(username=self.username)
+        # The uploaded DDI file was read to its end when it was stored
+        _rewind(source)
+        try:
+            with self.timer.stage('variables'):
+                # Replace the data dictionary of a previous import, if any
+                resource = variables.get_data_dictionary_resource(
+                    registry.call_action('package_show', {'id': name})
+                )
+                variables.write_datastore(
+                    registry,
+                    name,
+                    variables.iter_variables(source),
+                    variables.get_chunk_size(),
+                    resource_id=resource['id'] if resource else None,
+                )
+        except (tk.ValidationError, tk.ObjectNotFound, tk.NotAuthorized) as e:
+            # The dataset is imported even if the DataStore rejects its
+            # variables, but errors parsing the document are raised
+            log.warning(
+                'Could not import the data dictionary of %s: %r' % (name, e)
+            )
+        finally:
+            _rewind(source)
+
+    def _load(self, ckan_metadata, fileobj):
+        """
+            Return the metadata mapped from a DDI document, from the
+            metadata cache if it was mapped recently (unless profiling)
+
+            The hash of the document is kept as `content_hash`.
+        """
+        metadata_cache = cache.get_cache()
+        with self.timer.stage('hashing'):
+            self.content_hash = cache.get_content_hash(fileobj)
+        key = cache.get_key(ckan_metadata, self.content_hash)
+        if self.mapping_timings is None:
+            pkg_dict = metadata_cache.get(key)
+            if pkg_dict is not None:
+                return pkg_dict
+
+        with self.timer.stage('parsing'):
+            try:
+                dataset_xml = ckan_metadata.parse_stream(fileobj)
+            finally:
+                _rewind(fileobj)
+        with self.timer.stage('mapping'):
+            pkg_dict = ckan_metadata.load_xml(
+                dataset_xml, timings=self.mapping_timings
+            )
+        metadata_cache.set(key, pkg_dict)
+        return pkg_dict
 
-    def insert_or_update_pkg(self, pkg_dict, upload=None):
+    def insert_or_update_pkg(
+        self, pkg_dict, upload=None, resources=None, content_hash=None
+    ):
+        """
+            Create the dataset, or update it if it exists and
+            `ckanext.ddi.override_datasets` is enabled, and return its name
+
+            The uploaded DDI file and the extra `resources` (eg the DDI RDF)
+            are added as resources by the same package_create or
+            package_update call, so each import is a single write.
+            `resources` can also be a function returning them, which is
+            only called if the dataset is written.
+
+            Existing datasets are left untouched if their digest shows that
+            neither the mapped metadata nor the DDI document (given by its
+            `content_hash`, which covers the variables, not part of the
+            metadata) changed. The outcome ('created', 'updated' or
+            'unchanged') is set as `status`.
+        """
         registry = ckanapi.LocalCKAN(username=self.username)
+        digest = get_digest(pkg_dict, content_hash)
         allow_duplicates = tk.asbool(
             tk.config.get('ckanext.ddi.allow_duplicates', False)
         )
         override_datasets = tk.asbool(
             tk.config.get('ckanext.ddi.override_datasets', False)
         )
-        try:
-            existing_pkg = registry.call_action('package_show', pkg_dict)
-            if not allow_duplicates and not override_datasets:
-                raise ContentDuplicateError(
-                    'Dataset already exists and duplicates are not allowed.'
-                )
 
-            if override_datasets:
-                pkg_dict.pop('id', None)
-                pkg_dict.pop('name', None)
-                existing_pkg.update(pkg_dict)
-                pkg_dict = existing_pkg
-                registry.call_action('package_update', pkg_dict)
-            else:
-                raise ckanapi.NotFound()
-        except ckanapi.NotFound:
+        name_allocator = self.name_allocator or NameAllocator()
+        with self.timer.stage('lookup'):
+            exists = name_allocator.exists(pkg_dict['name'])
+        if exists and override_datasets:
+            with self.timer.stage('lookup'):
+                existing_pkg = registry.call_action(
+                    'package_show', {'id': pkg_dict['name']}
+                )
+            if get_stored_digest(existing_pkg) == digest:
+                log.info('Dataset %s is unchanged' % existing_pkg['name'])
+                self.status = 'unchanged'
+                return existing_pkg['name']
+
+            pkg_dict = merge_pkg_dict(existing_pkg, pkg_dict, digest)
+            pkg_dict['resources'] = replace_data_dictionary(
+                pkg_dict.get('resources', []),
+                self._get_new_resources(upload, resources),
+            )
+            saved_pkg = self._call_with_uploads(registry, 'package_update', pkg_dict)
+            self.status = 'updated'
+        elif exists and not allow_duplicates:
+            raise ContentDuplicateError(
+                'Dataset already exists and duplicates are not allowed.'
+            )
+        else:
             pkg_dict.pop('id', None)
-            pkg_dict['name'] = self._gen_new_name(pkg_dict['name'])
-            registry.call_action('package_create', pkg_dict)
+            with self.timer.stage('lookup'):
+                pkg_dict['name'] = name_allocator.allocate(pkg_dict['name'])
+            pkg_dict['resources'] = (
+                pkg_dict.get('resources', [])
+                + self._get_new_resources(upload, resources)
+            )
+            set_digest(pkg_dict, digest)
+            saved_pkg = self._call_with_uploads(registry, 'package_create', pkg_dict)
+            self.status = 'created'
+
+        if get_stored_digest(saved_pkg) != digest:
+            log.warning(
+                'The digest of dataset %s was not saved, it will be updated '
+                'by every import of the same file' % pkg_dict['name']
+            )
+        log.debug(pkg_dict['name'])
+        return pkg_dict['name']
 
+    def check_pkg_dict(self, pkg_dict, content_hash=None):
+        """
+            Validate a dataset against the (scheming) schema of the action
+            insert_or_update_pkg would call, without writing it, and return
+            the errors
+
+            Existing datasets are validated once merged with the mapped
+            metadata, as they would be updated. The outcome of the import
+            ('created', 'updated' or 'unchanged') is set as `status`.
+        """
+        self.status = None
+        allow_duplicates = tk.asbool(
+            tk.config.get('ckanext.ddi.allow_duplicates', False)
+        )
+        override_datasets = tk.asbool(
+            tk.config.get('ckanext.ddi.override_datasets', False)
+        )
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': self.username,
+        }
+        pkg_dict = dict(pkg_dict)
+        package_plugin = lib_plugins.lookup_package_plugin(pkg_dict.get('type'))
+
+        # A fresh allocator, as the names are not reserved by a preview
+        name_allocator = NameAllocator()
+        with self.timer.stage('lookup'):
+            exists = name_allocator.exists(pkg_dict['name'])
+        if exists and override_datasets:
+            registry = ckanapi.LocalCKAN(username=self.username)
+            with self.timer.stage('lookup'):
+                existing_pkg = registry.call_action(
+                    'package_show', {'id': pkg_dict['name']}
+                )
+            digest = get_digest(pkg_dict, content_hash)
+            if get_stored_digest(existing_pkg) == digest:
+                self.status = 'unchanged'
+                return {}
+            pkg_dict = merge_pkg_dict(existing_pkg, pkg_dict, digest)
+            context['package'] = model.Package.get(existing_pkg['id'])
+            action = 'package_update'
+            schema = package_plugin.update_package_schema()
+            status = 'updated'
+        elif exists and not allow_duplicates:
+            return {'name': [
+                tk._('Dataset already exists and duplicates are not allowed.')
+            ]}
+        else:
+            pkg_dict.pop('id', None)
+            pkg_dict['name'] = name_allocator.allocate(pkg_dict['name'])
+            action = 'package_create'
+            schema = package_plugin.create_package_schema()
+            status = 'created'
+
+        with self.timer.stage('validating'):
+            data, errors = lib_plugins.plugin_validate(
+                package_plugin, context, pkg_dict, schema, action
+            )
+        if not errors:
+            self.status = status
+        return errors
+
+    def _get_new_resources(self, upload, resources):
+        if callable(resources):
+            resources = resources()
+        new_resources = list(resources or [])
         if upload is not None:
+            new_resources.insert(0, get_attachment('DDI XML', 'xml', upload=upload))
+        return new_resources
+
+    def _call_with_uploads(self, registry, action, pkg_dict):
+        """
+            Call package_create or package_update and store the files of the
+            resources with an `upload`, like resource_create does
+
+            The new resources (without an id) also go through the
+            before and after create hooks of the IResourceController
+            plugins, as they would with resource_create.
+        """
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': self.username,
+        }
+        uploads = []
+        created = []
+        for position, resource in enumerate(pkg_dict.get('resources', [])):
+            if not resource.get('id'):
+                _call_resource_hooks(context, resource, pkg_dict)
+                created.append(position)
+            if not resource.get('upload'):
+                continue
+            upload = uploader.get_resource_uploader(resource)
+            if 'mimetype' not in resource and getattr(upload, 'mimetype', None):
+                resource['mimetype'] = upload.mimetype
+            if 'size' not in resource and getattr(upload, 'filesize', None):
+                resource['size'] = upload.filesize
+            uploads.append((position, upload))
+
+        with self.timer.stage('writing'):
+            saved_pkg = registry.call_action(action, pkg_dict)
+
+        for position, upload in uploads:
             try:
-                registry.call_action(
-                    'resource_create',
-                    {
-                        'package_id': pkg_dict['name'],
-                        'upload': upload,
-                        'name': 'DDI XML',
-                        'format': 'xml',
-                        'url': '',
-                        'type': 'attachment',
-                        'file_type': 'other',
-                    }
-                )
+                with self.timer.stage('uploading'):
+                    upload.upload(
+                        saved_pkg['resources'][position]['id'],
+                        uploader.get_max_resource_size(),
+                    )
             except Exception as e:
                 raise UploadError(
                     'Could not upload file: %s' % str(e)
                 )
 
-        log.debug(pkg_dict['name'])
-        return pkg_dict['name']
+        for position in created:
+            _call_resource_hooks(
+                context, saved_pkg['resources'][position], after=True
+            )
+        return saved_pkg
 
     def improve_pkg_dict(self, pkg_dict, params, data=None):
         if pkg_dict['name'] != '':
@@ -190,39 +534,343 @@ class DdiImporter(HarvesterBase):
         return pkg_dict
 
 
-def _get_dataset_schema():
+def _call_resource_hooks(context, resource, pkg_dict=None, after=False):
+    """
+        Call the `before_create` (or `after_create`) hook of the
+        IResourceController plugins for a resource written by
+        package_create or package_update, like resource_create does
+
+        Before the write, the hooks get the resource with the `package_id`
+        of its dataset (its name if it doesn't exist yet), and their changes
+        are applied to it.
+    """
+    # The hooks were renamed in CKAN 2.10
+    hook_name = 'after_' if after else 'before_'
+    if tk.check_ckan_version(min_version='2.10'):
+        hook_name += 'resource_create'
+    else:
+        hook_name += 'create'
+
+    if after:
+        for plugin in plugins.PluginImplementations(plugins.IResourceController):
+            getattr(plugin, hook_name)(context, resource)
+        return
+
+    hook_resource = dict(resource)
+    hook_resource.setdefault('package_id', pkg_dict.get('id') or pkg_dict['name'])
+    for plugin in plugins.PluginImplementations(plugins.IResourceController):
+        getattr(plugin, hook_name)(context, hook_resource)
+    if 'package_id' not in resource:
+        hook_resource.pop('package_id', None)
+    resource.clear()
+    resource.update(hook_resource)
+
+
+def _rewind(source):
+    """ Rewind a file object, to read it again """
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+
+def get_attachment(name, format, upload=None, url=''):
+    """ Return the dict of a DDI file resource """
+    resource = {
+        'name': name,
+        'format': format,
+        'url': url,
+        'type': 'attachment',
+        'file_type': 'other',
+    }
+    if upload is not None:
+        resource['upload'] = upload
+    return resource
+
+
+def replace_data_dictionary(resources, new_resources):
+    """
+        Return the resources of a dataset followed by the `new_resources`
+        of an import, the new data dictionary (if any) replacing the one of
+        the previous import in place, keeping its id
+    """
+    resources = list(resources)
+    new_resources = list(new_resources)
+    new_dictionary = variables.get_data_dictionary_resource(
+        {'resources': new_resources}
+    )
+    old_dictionary = variables.get_data_dictionary_resource({'resources': resources})
+    if new_dictionary is not None and old_dictionary is not None:
+        new_resources.remove(new_dictionary)
+        resources[resources.index(old_dictionary)] = dict(
+            new_dictionary, id=old_dictionary['id']
+        )
+    return resources + new_resources
+
+
+def get_rdf_resources(data):
+    """
+        Return the DDI RDF resource from the `rdf_upload` file or the
+        `rdf_url` of the import form data, if any
+    """
+    if not data:
+        return []
+    if isinstance(data.get('rdf_upload'), FileStorage):
+        return [get_attachment('DDI RDF', 'rdf', upload=data['rdf_upload'])]
+    if data.get('rdf_url'):
+        return [get_attachment('DDI RDF', 'rdf', url=data['rdf_url'])]
+    return []
+
+
+def get_existing_names(name):
+    """
+        Return, with a single query, the names of the existing datasets
+        that `name` or the names generated from it by gen_free_name could
+        conflict with
+    """
+    prefix = _escape_like(_get_base_name(name))
+    query = model.Session.query(model.Package.name).filter(or_(
+        model.Package.name == name,
+        model.Package.name.like(prefix + '%', escape='\\'),
+    ))
+    return set(row[0] for row in query)
+
+
+def _escape_like(value):
+    """ Escape the wildcards of a LIKE pattern, with a backslash """
+    return re.sub(r'([\\%_])', r'\\\1', value)
+
+
+def gen_free_name(name, existing_names, start=1):
+    """
+        Return the first of `name`, `name1`, `name2`... not in
+        `existing_names`, like HarvesterBase._gen_new_name
+
+        The numbered names below `start` are assumed to be taken.
+    """
+    ideal_name = _get_ideal_name(name)
+    if ideal_name not in existing_names:
+        return ideal_name
+    base_name = _get_base_name(name)
+    for counter in range(start, 10 ** NAME_SUFFIX_LENGTH):
+        candidate_name = base_name + str(counter)
+        if candidate_name not in existing_names:
+            return candidate_name
+    raise ContentImportError('Could not find a free name for %s' % name)
+
+
+def _get_ideal_name(name):
+    ideal_name = re.sub('-+', '-', munge_title_to_name(name))
+    return ideal_name[:model.PACKAGE_NAME_MAX_LENGTH]
+
+
+def _get_base_name(name):
+    """ Return the name that gen_free_name appends numbers to """
+    return _get_ideal_name(name)[:model.PACKAGE_NAME_MAX_LENGTH - NAME_SUFFIX_LENGTH]
+
+
+class NameAllocator(object):
+    """
+        Allocate free dataset names
+
+        The existing names sharing the base name of a dataset are fetched
+        with a single query the first time that base name is seen, and the
+        allocated names are reserved in memory. Sharing an allocator across
+        the imports of a batch means that datasets with the same title get
+        `name`, `name1`, `name2`... without probing the database each time,
+        and that concurrent imports never get the same name.
+
+        The reservations only apply within the process of the allocator:
+        datasets created at the same time by other processes (eg the web
+        server or a jobs worker) are not seen until they are in the
+        database, and package_create rejects a name taken in between.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Taken names by base name
+        self.names = {}
+        # Next number to try by base name
+        self.counters = {}
+        self.allocated = set()
+
+    def _get_names(self, name):
+        base_name = _get_base_name(name)
+        names = self.names.get(base_name)
+        if names is None:
+            names = self.names[base_name] = get_existing_names(name)
+        elif not name.startswith(base_name) and name not in names:
+            # The exact name is only fetched along with its own base name
+            names.update(get_existing_names(name))
+        return names
+
+    def exists(self, name):
+        """ Return whether a dataset named `name` exists or was allocated """
+        with self.lock:
+            return name in self.allocated or name in self._get_names(name)
+
+    def allocate(self, name):
+        """ Return a free name for a dataset named `name`, and reserve it """
+        with self.lock:
+            names = self._get_names(name)
+            base_name = _get_base_name(name)
+            counter = self.counters.get(base_name, 1)
+            free_name = gen_free_name(name, names, start=counter)
+            names.add(free_name)
+            self.allocated.add(free_name)
+            while base_name + str(counter) in names:
+                counter += 1
+            self.counters[base_name] = counter
+            return free_name
+
+
+def merge_pkg_dict(existing_pkg, pkg_dict, digest):
+    """
+        Return an existing dataset (the result of package_show) updated with
+        the mapped metadata of an import and its digest
+    """
+    pkg_dict = dict(pkg_dict)
+    pkg_dict.pop('id', None)
+    pkg_dict.pop('name', None)
+    merged_pkg = dict(existing_pkg)
+    merged_pkg.update(pkg_dict)
+    set_digest(merged_pkg, digest)
+    return merged_pkg
+
+
+def set_digest(pkg_dict, digest):
+    """
+        Store the digest of an import in its DIGEST_FIELD if the scheming
+        schema of the dataset has one, or else as an extra (which CKAN
+        keeps without it being part of the schema)
+    """
+    extras = [
+        extra for extra in pkg_dict.get('extras') or []
+        if extra.get('key') != DIGEST_FIELD
+    ]
+    if _get_field(DIGEST_FIELD, pkg_dict.get('type') or 'dataset'):
+        pkg_dict[DIGEST_FIELD] = digest
+    else:
+        pkg_dict.pop(DIGEST_FIELD, None)
+        extras.append({'key': DIGEST_FIELD, 'value': digest})
+    if extras or 'extras' in pkg_dict:
+        pkg_dict['extras'] = extras
+
+
+def get_stored_digest(pkg_dict):
+    """ Return the digest stored in a dataset by set_digest, if any """
+    if pkg_dict.get(DIGEST_FIELD):
+        return pkg_dict[DIGEST_FIELD]
+    for extra in pkg_dict.get('extras') or []:
+        if extra.get('key') == DIGEST_FIELD:
+            return extra.get('value')
+    return None
+
+
+def get_digest(pkg_dict, content_hash=None):
+    """
+        Return a digest of the mapped metadata of a dataset and the
+        `content_hash` of the DDI document it was mapped from (see
+        cache.get_content_hash)
+    """
+    digest = hashlib.sha256()
+    metadata_dict = dict(
+        (key, value) for key, value in pkg_dict.items() if key != DIGEST_FIELD
+    )
+    digest.update(
+        json.dumps(metadata_dict, sort_keys=True, default=str).encode('utf-8')
+    )
+    if content_hash is not None:
+        digest.update(content_hash.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _get_dataset_schema(dataset_type='dataset'):
+
+    return scheming_get_dataset_schema(dataset_type)
+
+
+def _get_field(field_name, dataset_type='dataset'):
+    schema = _get_dataset_schema(dataset_type)
+    if not schema:
+        return None
 
-    return scheming_get_dataset_schema('dataset')
+    for field in schema['dataset_fields']:
+        if field['field_name'] == field_name:
+            return field
+    return None
 
 
 def get_allowed_values(field_name):
 
-    schema = _get_dataset_schema()
-    if not schema:
+    field = _get_field(field_name)
+    if not field:
         return []
+    return field.get('choices', [])
 
-    for field in schema['dataset_fields']:
-        if field['field_name'] == field_name:
-            allowed_values = field['choices']
 
-    return allowed_values
+class ChoiceIndex(object):
+    """
+        Lookup of the choices of a scheming field by label (lowercased),
+        value (lowercased) and exact value
+
+        The lookups return the position of the choice along with its value,
+        so that `match` can return the first choice in the schema order
+        matching any of the candidates.
+    """
+    def __init__(self, choices):
+        self.by_label = {}
+        self.by_lower_value = {}
+        self.by_value = {}
+        for position, choice in enumerate(choices):
+            entry = (position, choice['value'])
+            label = choice.get('label', '')
+            if isinstance(label, six.string_types):
+                self.by_label.setdefault(label.lower(), entry)
+            self.by_lower_value.setdefault(choice['value'].lower(), entry)
+            self.by_value.setdefault(choice['value'], entry)
+
+    def match(self, *entries):
+        """ Return the value of the first of the matching `entries` """
+        entries = [entry for entry in entries if entry is not None]
+        if not entries:
+            return None
+        return min(entries)[1]
+
+
+# ChoiceIndex by (dataset type, field name), along with the field they were
+# built from, so that they are rebuilt when the scheming schemas are reloaded
+_choice_indexes = {}
+
+
+def get_choice_index(field_name, dataset_type='dataset'):
+    field = _get_field(field_name, dataset_type)
+    cached = _choice_indexes.get((dataset_type, field_name))
+    if cached is not None and cached[0] is field:
+        return cached[1]
+
+    index = ChoiceIndex(field.get('choices', []) if field else [])
+    _choice_indexes[(dataset_type, field_name)] = (field, index)
+    return index
+
+
+BRACKETS_CODE_RE = re.compile(r'\[.*?\]')
 
 
 def _get_data_collection_technique_value(xml_value):
 
-    allowed_values = get_allowed_values('data_collection_technique')
+    index = get_choice_index('data_collection_technique')
 
-    try:
-        brackets_code = re.search(r'\[.*?\]', xml_value).group(0)
-        brackets_code = brackets_code.lstrip('[').rstrip(']')
-    except AttributeError:
+    match = BRACKETS_CODE_RE.search(xml_value)
+    if match:
+        brackets_code = match.group(0).lstrip('[').rstrip(']')
+    else:
         brackets_code = ''
 
-    for allowed_value in allowed_values:
-        if (xml_value.lower() == allowed_value['label'].lower() or
-                xml_value.lower() == allowed_value['value'].lower() or
-                brackets_code.lower() == allowed_value['value']):
-            return allowed_value['value']
+    value = index.match(
+        index.by_label.get(xml_value.lower()),
+        index.by_lower_value.get(xml_value.lower()),
+        index.by_value.get(brackets_code.lower()),
+    )
+    if value is not None:
+        return value
 
     return xml_value
 
@@ -240,17 +888,16 @@ def _get_keywords(xml_values):
 
     out = []
 
-    allowed_values = get_allowed_values('keywords')
+    index = get_choice_index('keywords')
 
     for item in xml_values:
-        found = False
-        for allowed_value in allowed_values:
-            if (item.get('abbr', '').lower() == allowed_value['value'] or
-                    item.get('value', '').lower() == allowed_value['label'].lower()):
-                out.append(allowed_value['value'])
-                found = True
-                break
-        if not found:
+        value = index.match(
+            index.by_value.get(item.get('abbr', '').lower()),
+            index.by_label.get(item.get('value', '').lower()),
+        )
+        if value is not None:
+            out.append(value)
+        else:
             # Add value anyway so it fails validation
             out.append(item.get('value'))
 
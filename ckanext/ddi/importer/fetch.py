@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
+
+import ckan.plugins.toolkit as tk
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Connections kept open per host
+POOL_SIZE = 10
+CHUNK_SIZE = 64 * 1024
+# Bodies bigger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """
+        Return the requests session used for the host of `url`, so that
+        connections to the same catalogue are kept alive between imports
+    """
+    parsed_url = urlparse(url)
+    key = (parsed_url.scheme, parsed_url.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+    return session
+
+
+def get_timeout():
+    """ Return the (connect, read) timeout of the requests, in seconds """
+    return (
+        float(tk.config.get(
+            'ckanext.ddi.fetch_connect_timeout', DEFAULT_CONNECT_TIMEOUT
+        )),
+        float(tk.config.get(
+            'ckanext.ddi.fetch_read_timeout', DEFAULT_READ_TIMEOUT
+        )),
+    )
+
+
+def get_max_bytes():
+    return tk.asint(tk.config.get('ckanext.ddi.fetch_max_bytes', DEFAULT_MAX_BYTES))
+
+
+def get_cache():
+    """
+        Return the FetchCache configured with `ckanext.ddi.fetch_cache_dir`,
+        or None if the cache is disabled
+    """
+    path = tk.config.get('ckanext.ddi.fetch_cache_dir')
+    if not path:
+        return None
+    max_bytes = tk.asint(tk.config.get(
+        'ckanext.ddi.fetch_cache_max_bytes', DEFAULT_CACHE_MAX_BYTES
+    ))
+    return FetchCache(path, max_bytes)
+
+
+def fetch(url):
+    """
+        Download `url` and return its body as a file object positioned at
+        the start
+
+        The body is streamed to a spooled temporary file, and the download
+        is aborted as soon as it is bigger than `ckanext.ddi.fetch_max_bytes`.
+
+        If the cache is enabled, the request is conditional on the ETag and
+        Last-Modified of the cached copy, which is returned if the document
+        did not change.
+    """
+    cache = get_cache()
+    if cache is None:
+        return _fetch(url)
+
+    headers = cache.get_conditional_headers(url)
+    if headers:
+        cached_file = _fetch(url, headers=headers, cache=cache)
+        if cached_file is not None:
+            return cached_file
+    return _fetch(url, cache=cache)
+
+
+def _fetch(url, headers=None, cache=None):
+    max_bytes = get_max_bytes()
+    try:
+        response = get_session(url).get(
+            url, stream=True, timeout=get_timeout(), headers=headers
+        )
+        with closing(response):
+            if response.status_code == 304 and cache is not None:
+                log.debug('Not modified: %s' % url)
+                return cache.open(url)
+            if response.status_code >= 400:
+                raise FetchError('HTTP error %s' % response.status_code)
+
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and \
+                    int(content_length) > max_bytes:
+                raise ContentTooLargeError(
+                    'Content is bigger than %d bytes' % max_bytes
+                )
+
+            output_file = _spool(response, max_bytes)
+            if cache is not None:
+                cache.store(url, output_file, response.headers)
+            return output_file
+    except requests.exceptions.RequestException as e:
+        raise FetchError(repr(e))
+
+
+def _spool(response, max_bytes):
+    output_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    size = 0
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ContentTooLargeError(
+                    'Content is bigger than %d bytes' % max_bytes
+                )
+            output_file.write(chunk)
+    except Exception:
+        output_file.close()
+        raise
+    log.debug('Fetched %d bytes from %s' % (size, response.url))
+    output_file.seek(0)
+    return output_file
+
+
+class FetchCache(object):
+    """
+        On-disk cache of fetched documents, keyed by URL
+
+        Each document is stored with its ETag and Last-Modified headers.
+        When the total size of the documents goes over `max_bytes`, the
+        least recently used ones are removed.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _get_paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return (
+            os.path.join(self.path, key + '.xml'),
+            os.path.join(self.path, key + '.json'),
+        )
+
+    def get_conditional_headers(self, url):
+        """ Return the headers to revalidate the cached copy of `url` """
+        body_path, meta_path = self._get_paths(url)
+        if not os.path.exists(body_path):
+            return {}
+        try:
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def open(self, url):
+        """ Return the cached copy of `url`, or None if it is not cached """
+        body_path, meta_path = self._get_paths(url)
+        try:
+            cached_file = open(body_path, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            # Used as the last access time for the LRU eviction
+            os.utime(body_path, None)
+        except OSError:
+            pass
+        return cached_file
+
+    def store(self, url, fileobj, headers):
+        """
+            Store the document in `fileobj` if it has an ETag or a
+            Last-Modified header, and rewind `fileobj`
+
+            The download is still used if it can't be cached (eg if the
+            cache directory is not writable), so errors are only logged.
+        """
+        meta = {
+            'url': url,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        if not meta['etag'] and not meta['last_modified']:
+            return
+
+        try:
+            self._store(url, fileobj, meta)
+        except (IOError, OSError) as e:
+            log.warning('Could not cache the document of %s: %r' % (url, e))
+        finally:
+            fileobj.seek(0)
+
+    def _store(self, url, fileobj, meta):
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+        body_path, meta_path = self._get_paths(url)
+        # The body is stored before the headers, so that the cached
+        # headers never validate an outdated body
+        self._write(body_path, lambda f: shutil.copyfileobj(fileobj, f))
+        self._write(meta_path, lambda f: f.write(
+            json.dumps(meta).encode('utf-8')
+        ))
+        self.evict()
+
+    def _write(self, path, write):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                write(tmp_file)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def evict(self):
+        """ Remove the least recently used documents over `max_bytes` """
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.xml'):
+                continue
+            body_path = os.path.join(self.path, filename)
+            try:
+                stat = os.stat(body_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, body_path))
+
+        total_size = sum(size for mtime, size, body_path in entries)
+        for mtime, size, body_path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            for path in (body_path, body_path[:-len('.xml')] + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_size -= size
+
+
+class FetchError(Exception):
+    pass
+
+
+class ContentTooLargeError(FetchError):
+    pass
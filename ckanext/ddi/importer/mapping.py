@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    Mappings loaded from a YAML or JSON file
+
+    The file set by `ckanext.ddi.mapping_file` overrides or adds keys to the
+    default DDI mapping. Each key is mapped with a Value spec, either an
+    XPath expression (for a XPathTextValue) or a dict with the name of the
+    Value class as `type`, and:
+
+    * `xpath`: the expression of the XPath values
+    * `value`: the string of a StringValue, or the spec of the Value wrapped
+      by an ArrayTextValue
+    * `values`: the specs of the Values combined by the other types (eg a
+      CombinedValue or an ArrayValue)
+    * any other option of the Value (eg `separator`)
+
+    The file is compiled into a CkanMetadata class, with its own XPath plan,
+    when CKAN starts (see DdiImport.configure), so changes to the file are
+    applied by restarting CKAN.
+"""
+import json
+import threading
+
+from lxml import etree
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.ddi.importer import metadata
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import logging
+log = logging.getLogger(__name__)
+
+# How Values are configured in mapping files: with an `xpath` expression,
+# a string `value`, a single nested `value`, or a list of nested `values`
+XPATH = 'xpath'
+STRING = 'string'
+SINGLE = 'value'
+LIST = 'values'
+
+# Value classes that can be used in mapping files, with their configuration
+VALUE_TYPES = dict((cls.__name__, (cls, shape)) for cls, shape in (
+    (metadata.StringValue, STRING),
+    (metadata.XPathValue, XPATH),
+    (metadata.XPathMultiValue, XPATH),
+    (metadata.XPathTextValue, XPATH),
+    (metadata.XPathMultiTextValue, XPATH),
+    (metadata.CombinedValue, LIST),
+    (metadata.DateCollectionValue, LIST),
+    (metadata.MultiValue, LIST),
+    (metadata.ArrayValue, LIST),
+    (metadata.ArrayDictValue, LIST),
+    (metadata.ArrayTextValue, SINGLE),
+    (metadata.ArrayDictNameValue, LIST),
+    (metadata.ArrayDictValueAndAttrs, LIST),
+    (metadata.FirstInOrderValue, LIST),
+))
+
+
+class MappingFileError(Exception):
+    pass
+
+
+def get_mapping_file():
+    return tk.config.get('ckanext.ddi.mapping_file') or None
+
+
+def read_mapping_file(path):
+    """ Return the content of a YAML or JSON mapping file """
+    with open(path, 'rb') as mapping_file:
+        content = mapping_file.read().decode('utf-8')
+    if path.lower().endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise MappingFileError(
+                'PyYAML is required to read the mapping file %s' % path
+            )
+        try:
+            return yaml.safe_load(content)
+        except yaml.YAMLError as e:
+            raise MappingFileError('Could not parse %s: %s' % (path, e))
+    try:
+        return json.loads(content)
+    except ValueError as e:
+        raise MappingFileError('Could not parse %s: %s' % (path, e))
+
+
+def compile_value(spec, key):
+    """ Return the Value of a spec of the mapping of `key` """
+    if not isinstance(spec, dict):
+        spec = {'type': 'XPathTextValue', 'xpath': spec}
+    spec = dict(spec)
+    type_name = spec.pop('type', None)
+    if type_name not in VALUE_TYPES:
+        raise MappingFileError(
+            'Unknown value type for %s: %s' % (key, type_name)
+        )
+    cls, shape = VALUE_TYPES[type_name]
+
+    if shape == XPATH:
+        config = spec.pop('xpath', None)
+        try:
+            etree.XPath(config, namespaces=metadata.namespaces)
+        except (TypeError, etree.XPathSyntaxError) as e:
+            raise MappingFileError(
+                'Invalid XPath expression for %s: %r (%s)' % (key, config, e)
+            )
+    elif shape == STRING:
+        config = spec.pop('value', '')
+    elif shape == LIST:
+        config = spec.pop('values', None)
+        if not isinstance(config, list) or 'value' in spec:
+            raise MappingFileError(
+                'The %s of %s needs a list of `values`' % (type_name, key)
+            )
+        config = [compile_value(value, key) for value in config]
+    else:
+        config = spec.pop('value', None)
+        if config is None or 'values' in spec:
+            raise MappingFileError(
+                'The %s of %s needs a single `value`' % (type_name, key)
+            )
+        config = compile_value(config, key)
+    return cls(config, **spec)
+
+
+def compile_mapping(content, base_class=metadata.DdiCkanMetadata):
+    """
+        Return a CkanMetadata class with the mapping of `base_class`
+        updated with the `mapping` of the content of a mapping file
+    """
+    if not isinstance(content, dict) or \
+            not isinstance(content.get('mapping'), dict):
+        raise MappingFileError('Mapping files need a `mapping` dict')
+
+    mapping = dict(base_class.mapping)
+    keys = list(base_class.metadata)
+    for key, spec in sorted(content['mapping'].items()):
+        mapping[key] = compile_value(spec, key)
+        if key not in keys:
+            keys.append(key)
+
+    cls = type(str('FileDdiCkanMetadata'), (base_class,), {
+        'mapping': metadata.FrozenDict(mapping),
+        'metadata': tuple(keys),
+    })
+    # compile the XPath expressions now rather than on the first import
+    cls().get_plan()
+    return cls
+
+
+_lock = threading.Lock()
+# The class of the loaded mapping file, by path
+_compiled = {}
+
+
+def load_mapping_file(path):
+    """ Compile the mapping file at `path` and return its CkanMetadata class """
+    try:
+        content = read_mapping_file(path)
+    except (IOError, OSError) as e:
+        raise MappingFileError('Could not read the mapping file: %s' % e)
+    log.info('Compiling the DDI mapping file %s' % path)
+    cls = compile_mapping(content)
+    with _lock:
+        _compiled.clear()
+        _compiled[path] = cls
+    return cls
+
+
+def get_metadata_class():
+    """
+        Return the CkanMetadata class of the mapping file, or DdiCkanMetadata
+        if there is none
+
+        The file is compiled when the plugin is configured, or else (eg in
+        scripts not loading the plugins) the first time it is needed.
+    """
+    path = get_mapping_file()
+    if path is None:
+        return metadata.DdiCkanMetadata
+    cls = _compiled.get(path)
+    if cls is None:
+        cls = load_mapping_file(path)
+    return cls
@@ -1,6 +1,10 @@
 from lxml import etree
+import hashlib
+import json
 import logging
 import six
+import threading
+import time
 from ckan.lib.munge import munge_title_to_name
 log = logging.getLogger(__name__)
 
@@ -27,42 +31,283 @@ namespaces = {
 }
 
 
+CODEBOOK_TAG = '{%s}codeBook' % namespaces['ddi']
+STDYDSCR_TAG = '{%s}stdyDscr' % namespaces['ddi']
+
+# Sections the absolute mapping expressions can be anchored at, most
+# specific first
+XPATH_ANCHORS = (
+    ('stdyDscr', '//ddi:codeBook/ddi:stdyDscr'),
+    ('codeBook', '//ddi:codeBook'),
+)
+
+# codeBook sections that are not used by the mapping and are discarded
+# while parsing documents in streaming mode
+STREAM_SKIPPED_SECTIONS = ('fileDscr', 'dataDscr', 'otherMat')
+# Repeated children of those sections, cleared as soon as they are parsed
+STREAM_SKIPPED_ITEMS = ('var', 'varGrp', 'nCube', 'otherMat')
+
+
+def _evaluate_xpath(xml, xpath, results=None):
+    """
+        Return the result of `xpath` on `xml`, using the per-document
+        `results` of an XPathPlan if available
+    """
+    if results is not None:
+        return results[xpath]
+    return xml.xpath(xpath, namespaces=namespaces, smart_strings=False)
+
+
+def anchor_xpath(xpath):
+    """
+        Split an absolute `//ddi:codeBook/...` expression into the name of
+        the section it starts at and an expression relative to that section
+
+        Expressions that can't be anchored are returned unchanged with a
+        `None` anchor.
+    """
+    if '|' not in xpath:
+        for anchor, prefix in XPATH_ANCHORS:
+            rest = xpath[len(prefix):]
+            if xpath.startswith(prefix) and rest.startswith('/'):
+                return anchor, '.' + rest
+    return None, xpath
+
+
+def _parse_stream(fileobj, skipped_sections=STREAM_SKIPPED_SECTIONS):
+    """
+        Parse a DDI document from a file-like object or a file path with
+        iterparse and return its root element
+
+        The `skipped_sections` of the codeBook are removed as soon as they
+        are parsed, and their items (eg the variables of `dataDscr`) are
+        cleared one by one, so the memory used does not depend on the size
+        of those sections. Only the events of those elements are reported
+        by libxml2, the rest of the document is built without going
+        through Python.
+    """
+    skipped_tags = set(
+        '{%s}%s' % (namespaces['ddi'], section) for section in skipped_sections
+    )
+    item_tags = set(
+        '{%s}%s' % (namespaces['ddi'], item) for item in STREAM_SKIPPED_ITEMS
+    )
+    context = etree.iterparse(
+        fileobj, events=('end',), tag=sorted(skipped_tags | item_tags)
+    )
+    for event, element in context:
+        parent = element.getparent()
+        if parent is None:
+            continue
+        if element.tag in skipped_tags and parent.tag == CODEBOOK_TAG:
+            parent.remove(element)
+        elif parent.tag in skipped_tags and parent.getparent() is not None \
+                and parent.getparent().tag == CODEBOOK_TAG:
+            element.clear()
+            # drop the (already cleared) preceding items
+            while element.getprevious() is not None:
+                del parent[0]
+    return context.root
+
+
+class XPathPlan(object):
+    """
+        Precompiled XPath expressions of a mapping
+
+        Every unique expression is compiled once, and evaluated at most
+        once per document: all the values using the same expression share
+        its result.
+
+        Expressions starting with `//ddi:codeBook` are compiled relative to
+        the `codeBook` or `codeBook/stdyDscr` elements, which are located
+        once per document, so that they don't scan the whole document (and
+        its potentially huge `dataDscr` section) on every evaluation.
+
+        Smart strings are disabled: string results are plain strings that
+        don't keep a reference to their parent element, so the mapped values
+        don't keep the document alive.
+    """
+    def __init__(self, mapping):
+        self.xpaths = {}
+        for value in mapping.values():
+            for xpath in value.get_xpaths():
+                if xpath not in self.xpaths:
+                    anchor, relative_xpath = anchor_xpath(xpath)
+                    self.xpaths[xpath] = (
+                        anchor,
+                        etree.XPath(
+                            relative_xpath,
+                            namespaces=namespaces,
+                            smart_strings=False,
+                        ),
+                    )
+
+    def evaluate(self, xml):
+        """ Return the (lazily evaluated) results of the plan on `xml` """
+        return XPathResults(self.xpaths, xml)
+
+
+class XPathResults(dict):
+    """ Results of an XPathPlan for one document, keyed by expression """
+    def __init__(self, xpaths, xml):
+        super(XPathResults, self).__init__()
+        self._xpaths = xpaths
+        self._xml = xml
+        self._anchors = None
+
+    def get_anchors(self):
+        """ Return the anchor elements of the document, by section name """
+        if self._anchors is None:
+            root = self._xml.getroottree().getroot()
+            if root.tag == CODEBOOK_TAG:
+                codebooks = [root]
+            else:
+                codebooks = list(root.iter(CODEBOOK_TAG))
+            self._anchors = {
+                'codeBook': codebooks,
+                'stdyDscr': [
+                    element
+                    for codebook in codebooks
+                    for element in codebook.iterchildren(STDYDSCR_TAG)
+                ],
+            }
+        return self._anchors
+
+    def __missing__(self, xpath):
+        if xpath not in self._xpaths:
+            value = self._xml.xpath(
+                xpath, namespaces=namespaces, smart_strings=False
+            )
+        else:
+            anchor, compiled = self._xpaths[xpath]
+            if anchor is None:
+                value = compiled(self._xml)
+            else:
+                value = self._evaluate_anchored(
+                    compiled, self.get_anchors()[anchor]
+                )
+        self[xpath] = value
+        return value
+
+    def _evaluate_anchored(self, compiled, elements):
+        if len(elements) == 1:
+            return compiled(elements[0])
+        value = []
+        for element in elements:
+            value.extend(compiled(element))
+        return value
+
+
+def _describe(value):
+    """
+        Return a JSON serializable description of a Value (or a list of
+        them), which changes with its configuration
+    """
+    if isinstance(value, Value):
+        return [
+            type(value).__name__,
+            _describe(value._config),
+            sorted(value.env.items()),
+        ]
+    if isinstance(value, (list, tuple)):
+        return [_describe(item) for item in value]
+    return value
+
+
+class FrozenDict(dict):
+    """ Read-only dict, for the configuration of Values and the mappings """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
 class Value(object):
+    """
+        Mapping of a CKAN attribute to the XML document
+
+        Values only hold their configuration (`config` and options like
+        `separator`), the document is passed to `get_value` on each call
+        (`xml`, and the `results` of the XPathPlan), so a mapping can be
+        shared by concurrent imports. The configuration can't be changed
+        once the Value is built, and Values have no `__dict__`, to keep the
+        mappings small.
+    """
+    __slots__ = ('_config', 'env')
+
     def __init__(self, config, **kwargs):
-        self._config = config
-        self.env = kwargs
+        if isinstance(config, list):
+            config = tuple(config)
+        object.__setattr__(self, '_config', config)
+        object.__setattr__(self, 'env', FrozenDict(kwargs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __getstate__(self):
+        return self._config, dict(self.env)
+
+    def __setstate__(self, state):
+        config, env = state
+        object.__setattr__(self, '_config', config)
+        object.__setattr__(self, 'env', FrozenDict(env))
 
     def get_value(self, **kwargs):
         """ Abstract method to return the value of the attribute """
         raise NotImplementedError
 
+    def get_xpaths(self):
+        """ Return the XPath expressions used to get the value """
+        if isinstance(self._config, Value):
+            return self._config.get_xpaths()
+        xpaths = []
+        if isinstance(self._config, (list, tuple)):
+            for attribute in self._config:
+                if isinstance(attribute, Value):
+                    xpaths.extend(attribute.get_xpaths())
+        return xpaths
+
 
 class StringValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
         return self._config
 
 
 class XmlValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
+        xml = kwargs['xml']
         return etree.tostring(xml)
 
 
 class XPathValue(Value):
-    def get_element(self, xml, xpath):
-        return xml.xpath(xpath, namespaces=namespaces)[0]
+    __slots__ = ()
+
+    def get_xpaths(self):
+        return [self._config]
+
+    def get_element(self, xml, xpath, results=None):
+        return _evaluate_xpath(xml, xpath, results)[0]
 
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        xml = self.env['xml']
+        xml = kwargs['xml']
 
         xpath = self._config
         log.debug("XPath: %s" % (xpath))
 
         try:
             # this should probably return a XPathTextValue
-            value = self.get_element(xml, xpath)
+            value = self.get_element(xml, xpath, kwargs.get('results'))
         except Exception:
             log.debug('XPath not found: %s' % xpath)
             value = ''
@@ -70,11 +315,15 @@ class XPathValue(Value):
 
 
 class XPathMultiValue(XPathValue):
-    def get_element(self, xml, xpath):
-        return xml.xpath(xpath, namespaces=namespaces)
+    __slots__ = ()
+
+    def get_element(self, xml, xpath, results=None):
+        return _evaluate_xpath(xml, xpath, results)
 
 
 class XPathTextValue(XPathValue):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
         value = super(XPathTextValue, self).get_value(**kwargs)
         if (hasattr(value, 'text') and
@@ -88,8 +337,9 @@ class XPathTextValue(XPathValue):
 
 
 class XPathMultiTextValue(XPathMultiValue):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         values = super(XPathMultiTextValue, self).get_value(**kwargs)
         return_values = []
         for value in values:
@@ -103,10 +353,11 @@ class XPathMultiTextValue(XPathMultiValue):
 
 
 class CombinedValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         value = ''
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = self.env.get('separator', ' ')
         for attribute in self._config:
             new_value = attribute.get_value(**kwargs)
             if new_value is not None:
@@ -115,9 +366,10 @@ class CombinedValue(Value):
 
 
 class DateCollectionValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = self.env.get('separator', ' ')
 
         start_dates = self._config[0].get_value(**kwargs)
         end_dates = self._config[1].get_value(**kwargs)
@@ -136,10 +388,11 @@ class DateCollectionValue(Value):
 
 
 class MultiValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         value = ''
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = self.env.get('separator', ' ')
         for attribute in self._config:
             new_value = attribute.get_value(**kwargs)
             try:
@@ -158,8 +411,9 @@ class MultiValue(Value):
 
 
 class ArrayValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         value = []
         for attribute in self._config:
             new_value = attribute.get_value(**kwargs)
@@ -178,8 +432,9 @@ class ArrayValue(Value):
 
 
 class ArrayDictValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         value = []
         for attribute in self._config:
             new_value = attribute.get_value(**kwargs)
@@ -198,14 +453,17 @@ class ArrayDictValue(Value):
 
 
 class ArrayTextValue(Value):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
-        self.env.update(kwargs)
         values = self._config.get_value(**kwargs)
-        separator = self.env['separator'] if 'separator' in self.env else ' '
+        separator = self.env.get('separator', ' ')
         return separator.join(values)
 
 
 class ArrayDictNameValue(ArrayValue):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
         value = super(ArrayDictNameValue, self).get_value(**kwargs)
         return self.wrap_in_name_dict(value)
@@ -215,6 +473,8 @@ class ArrayDictNameValue(ArrayValue):
 
 
 class ArrayDictValueAndAttrs(ArrayValue):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
         value = super(ArrayDictValueAndAttrs, self).get_value(**kwargs)
         return self.wrap_in_name_dict(value)
@@ -224,6 +484,8 @@ class ArrayDictValueAndAttrs(ArrayValue):
 
 
 class FirstInOrderValue(CombinedValue):
+    __slots__ = ()
+
     def get_value(self, **kwargs):
         for attribute in self._config:
             value = attribute.get_value(**kwargs)
@@ -234,56 +496,56 @@ class FirstInOrderValue(CombinedValue):
 
 class CkanMetadata(object):
     """ Provides general access to metadata for CKAN """
-    def __init__(self):
-        self.metadata = dict.fromkeys([
-            'id',
-            'name',
-            'title',
-            'url',
-            'author',
-            'author_email',
-            'maintainer',
-            'maintainer_email',
-            'license_id',
-            'copyright',
-            'version',
-            'version_notes',
-            'notes',
-            'tags',
-            'keywords',
-            'abbreviation',
-            'study_type',
-            'series_info',
-            'id_number',
-            'description',
-            'production_type',
-            'production_date',
-            'abstract',
-            'kind_of_data',
-            'unit_of_analysis',
-            'description_of_scope',
-            'country',
-            'geographic_coverage',
-            'time_period_covered',
-            'universe',
-            'primary_investigator',
-            'other_producers',
-            'funding',
-            'data_collection_dates',
-            'access_authority',
-            'conditions',
-            'citation_requirement',
-            'contact_persons',
-            'contact_persons_email',
-            'data_collection_technique',
-            'data_collector',
-            'sampling_procedure_notes',
-            'response_rate_notes',
-            'data_collection_notes',
-            'weight_notes',
-            'clean_ops_notes',
-            'data_accs_notes',
-        ])
+    # Keys of the CKAN datasets, shared by all the instances
+    metadata = (
+        'id',
+        'name',
+        'title',
+        'url',
+        'author',
+        'author_email',
+        'maintainer',
+        'maintainer_email',
+        'license_id',
+        'copyright',
+        'version',
+        'version_notes',
+        'notes',
+        'tags',
+        'keywords',
+        'abbreviation',
+        'study_type',
+        'series_info',
+        'id_number',
+        'description',
+        'production_type',
+        'production_date',
+        'abstract',
+        'kind_of_data',
+        'unit_of_analysis',
+        'description_of_scope',
+        'country',
+        'geographic_coverage',
+        'time_period_covered',
+        'universe',
+        'primary_investigator',
+        'other_producers',
+        'funding',
+        'data_collection_dates',
+        'access_authority',
+        'conditions',
+        'citation_requirement',
+        'contact_persons',
+        'contact_persons_email',
+        'data_collection_technique',
+        'data_collector',
+        'sampling_procedure_notes',
+        'response_rate_notes',
+        'data_collection_notes',
+        'weight_notes',
+        'clean_ops_notes',
+        'data_accs_notes',
+    )
 
     def get_attribute(self, ckan_attribute):
         """
@@ -298,19 +560,101 @@ class CkanMetadata(object):
         except etree.XMLSyntaxError as e:
             raise MetadataFormatError('Could not parse XML: %r' % e)
 
+        return self.load_xml(dataset_xml)
+
+    def load_stream(self, fileobj):
+        """
+            Load the metadata from a file-like object or a file path, without
+            building the sections of the document not used by the mapping
+            (eg the variables of `dataDscr`)
+        """
+        return self.load_xml(self.parse_stream(fileobj))
+
+    def parse_stream(self, fileobj):
+        """ Parse the document that load_stream loads the metadata from """
+        try:
+            return _parse_stream(fileobj)
+        except etree.XMLSyntaxError as e:
+            raise MetadataFormatError('Could not parse XML: %r' % e)
+
+    def load_xml(self, dataset_xml, timings=None):
+        """
+            Load the metadata from a parsed XML element
+
+            If `timings` is a dict, the time spent on each key (in seconds)
+            is stored in it.
+        """
+        results = self.get_plan().evaluate(dataset_xml)
+
         ckan_metadata = {}
         for key in self.metadata:
             log.debug("Metadata key: %s" % key)
+            if timings is not None:
+                start = time.time()
             attribute = self.get_attribute(key)
             ckan_metadata[key] = attribute.get_value(
-                xml=dataset_xml
+                xml=dataset_xml,
+                results=results,
             )
+            if timings is not None:
+                timings[key] = time.time() - start
         return ckan_metadata
 
+    def get_plan(self):
+        """
+            Return the XPathPlan of the mapping, compiled once per class
+        """
+        cls = type(self)
+        plan = cls.__dict__.get('_plan')
+        if plan is None:
+            plan = XPathPlan(dict(
+                (key, self.get_attribute(key)) for key in self.metadata
+            ))
+            cls._plan = plan
+        return plan
+
+    def get_fingerprint(self):
+        """
+            Return a digest of the mapping, computed once per class, which
+            changes when any of its keys or values changes
+        """
+        cls = type(self)
+        fingerprint = cls.__dict__.get('_fingerprint')
+        if fingerprint is None:
+            description = [
+                (key, _describe(self.get_attribute(key)))
+                for key in sorted(self.metadata)
+            ]
+            fingerprint = hashlib.sha256(
+                json.dumps([cls.__name__, description]).encode('utf-8')
+            ).hexdigest()[:16]
+            cls._fingerprint = fingerprint
+        return fingerprint
+
+
+class LazyMapping(object):
+    """
+        Class attribute holding a mapping built by `build` the first time it
+        is used, and then frozen
+
+        This keeps the tree of Values from being built when the module is
+        imported by processes that never map a document.
+    """
+    def __init__(self, build):
+        self.build = build
+        self.mapping = None
+        self.lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self.mapping is None:
+            with self.lock:
+                if self.mapping is None:
+                    self.mapping = FrozenDict(self.build())
+        return self.mapping
 
-class DdiCkanMetadata(CkanMetadata):
-    """ Provides access to the DDI metadata """
-    mapping = {
+
+def _build_ddi_mapping():
+    return {
         'id': XPathTextValue('//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:IDNo'),  # noqa
         'name': XPathTextValue(
             "//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:IDNo"  # noqa
@@ -499,6 +843,11 @@ class DdiCkanMetadata(CkanMetadata):
         ),
     }
 
+
+class DdiCkanMetadata(CkanMetadata):
+    """ Provides access to the DDI metadata """
+    mapping = LazyMapping(_build_ddi_mapping)
+
     def get_mapping(self):
         return self.mapping
 
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import os
+import re
+import tempfile
+import time
+import uuid
+
+import ckan.plugins.toolkit as tk
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def is_enabled():
+    """ Return whether sysadmins can profile imports """
+    return tk.asbool(tk.config.get('ckanext.ddi.profile_imports', False))
+
+
+def get_profile_dir():
+    return tk.config.get('ckanext.ddi.profile_dir') or os.path.join(
+        tempfile.gettempdir(), 'ckanext-ddi-profiles'
+    )
+
+
+class ImportProfiler(object):
+    """
+        Run an import under cProfile
+
+        The profile is saved as `<name>.pstats` in `directory`, along with
+        `<name>.mapping.txt`, the time spent on each key of the mapping
+        while loading the metadata (the XPath expressions shared by several
+        keys are counted for the first key using them).
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or get_profile_dir()
+        self.paths = []
+
+    def run(self, importer, source, **kwargs):
+        """
+            Call `importer.run(**kwargs)` and save its profile, named after
+            `source` (the file name or URL of the DDI file)
+        """
+        importer.mapping_timings = {}
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(importer.run, **kwargs)
+        finally:
+            try:
+                self.save(profile, importer.mapping_timings, source)
+            except (IOError, OSError) as e:
+                log.warning('Could not save the import profile: %r' % e)
+            importer.mapping_timings = None
+
+    def save(self, profile, mapping_timings, source):
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+
+        # The uuid keeps the imports profiled in the same second by the
+        # threads of a process from overwriting each other
+        base_path = os.path.join(self.directory, '%s-%d-%s-%s' % (
+            time.strftime('%Y%m%d-%H%M%S'),
+            os.getpid(),
+            uuid.uuid4().hex,
+            re.sub(r'[^A-Za-z0-9_.-]+', '_', source or 'import')[-50:],
+        ))
+        profile.dump_stats(base_path + '.pstats')
+        with open(base_path + '.mapping.txt', 'w') as table_file:
+            table_file.write(format_mapping_timings(mapping_timings))
+
+        self.paths = [base_path + '.pstats', base_path + '.mapping.txt']
+        log.info('Saved the import profile to %s' % ', '.join(self.paths))
+
+
+def format_mapping_timings(mapping_timings):
+    """ Return a table of the mapping timings, slowest keys first """
+    lines = ['%-30s %10s' % ('key', 'ms')]
+    for key, seconds in sorted(
+        mapping_timings.items(), key=lambda item: item[1], reverse=True
+    ):
+        lines.append('%-30s %10.3f' % (key, seconds * 1000))
+    lines.append('%-30s %10.3f' % ('total', sum(mapping_timings.values()) * 1000))
+    return '\n'.join(lines) + '\n'
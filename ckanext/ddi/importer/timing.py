@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import math
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as tk
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_SINKS = 'log histogram'
+DEFAULT_STATSD_HOST = 'localhost'
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_STATSD_PREFIX = 'ckanext.ddi.import'
+# Number of samples per stage kept by the histogram
+HISTOGRAM_SIZE = 1000
+
+
+class ImportTimer(object):
+    """
+        Durations (in seconds) and byte counts of the stages of an import
+
+        Stages are timed with `stage`, or with `start` and `stop` when they
+        don't fit in a block. A stage timed more than once (eg uploading
+        several files) adds up. The measurements are sent to the configured
+        sinks by `report`.
+    """
+    def __init__(self):
+        self.timings = collections.OrderedDict()
+        self.bytes = collections.OrderedDict()
+        self.status = None
+        self._started = {}
+
+    def start(self, name):
+        self._started[name] = time.time()
+
+    def stop(self, name):
+        started = self._started.pop(name, None)
+        if started is not None:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - started
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def add_bytes(self, name, count):
+        self.bytes[name] = self.bytes.get(name, 0) + count
+
+    def report(self, status):
+        """ Send the measurements of a finished import to the sinks """
+        for name in list(self._started):
+            self.stop(name)
+        self.status = status
+        for sink in get_sinks():
+            try:
+                sink.record(self)
+            except Exception as e:
+                log.warning('Could not record the import timings: %r' % e)
+
+
+def get_size(fileobj):
+    """ Return the size of a seekable file object, and rewind it """
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+class LogSink(object):
+    """ Log the measurements of each import as one `key=value` line """
+    def record(self, timer):
+        fields = ['status=%s' % timer.status]
+        fields.extend(
+            '%s_seconds=%.3f' % (name, seconds)
+            for name, seconds in timer.timings.items()
+        )
+        fields.extend(
+            '%s_bytes=%d' % (name, count) for name, count in timer.bytes.items()
+        )
+        log.info('DDI import %s' % ' '.join(fields))
+
+
+class StatsdSink(object):
+    """ Send the measurements to a statsd server, as timers and counters """
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, timer):
+        metrics = ['%s.status.%s:1|c' % (self.prefix, timer.status)]
+        metrics.extend(
+            '%s.%s:%d|ms' % (self.prefix, name, seconds * 1000)
+            for name, seconds in timer.timings.items()
+        )
+        metrics.extend(
+            '%s.%s.bytes:%d|c' % (self.prefix, name, count)
+            for name, count in timer.bytes.items()
+        )
+        self.socket.sendto('\n'.join(metrics).encode('utf-8'), self.address)
+
+
+class HistogramSink(object):
+    """
+        Keep the last HISTOGRAM_SIZE durations of each stage in memory, to
+        get their percentiles
+
+        The samples are per process: with several web server workers, each
+        one has its own histogram.
+    """
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.bytes = collections.Counter()
+        self.statuses = collections.Counter()
+
+    def record(self, timer):
+        with self.lock:
+            self.statuses[timer.status] += 1
+            for name, seconds in timer.timings.items():
+                if name not in self.samples:
+                    self.samples[name] = collections.deque(maxlen=self.size)
+                self.samples[name].append(seconds)
+            for name, count in timer.bytes.items():
+                self.bytes[name] += count
+
+    def get_summary(self):
+        """ Return the count, p50, p95 and max duration of each stage """
+        with self.lock:
+            stages = dict(
+                (name, sorted(samples)) for name, samples in self.samples.items()
+            )
+            summary = {
+                'imports': dict(self.statuses),
+                'bytes': dict(self.bytes),
+                'stages': {},
+            }
+        for name, samples in stages.items():
+            summary['stages'][name] = {
+                'count': len(samples),
+                'p50': _percentile(samples, 50),
+                'p95': _percentile(samples, 95),
+                'max': samples[-1],
+            }
+        return summary
+
+
+def _percentile(samples, percent):
+    """ Nearest-rank percentile of a sorted, non empty list """
+    rank = int(math.ceil(percent / 100.0 * len(samples)))
+    return samples[max(rank, 1) - 1]
+
+
+_histogram = HistogramSink()
+_sinks = {}
+
+
+def get_histogram():
+    return _histogram
+
+
+def get_sinks():
+    """
+        Return the sinks enabled by `ckanext.ddi.timing_sinks`, a space
+        separated list of `log`, `statsd` and `histogram`
+    """
+    names = tk.config.get('ckanext.ddi.timing_sinks', DEFAULT_SINKS)
+    sinks = _sinks.get(names)
+    if sinks is None:
+        sinks = []
+        for name in names.split():
+            if name == 'log':
+                sinks.append(LogSink())
+            elif name == 'statsd':
+                sinks.append(StatsdSink(
+                    tk.config.get('ckanext.ddi.statsd_host', DEFAULT_STATSD_HOST),
+                    tk.asint(tk.config.get(
+                        'ckanext.ddi.statsd_port', DEFAULT_STATSD_PORT
+                    )),
+                    tk.config.get('ckanext.ddi.statsd_prefix', DEFAULT_STATSD_PREFIX),
+                ))
+            elif name == 'histogram':
+                sinks.append(_histogram)
+            else:
+                log.warning('Unknown DDI import timing sink: %s' % name)
+        _sinks[names] = sinks
+    return sinks
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import datetime
+import io
+import itertools
+import tempfile
+
+import six
+from lxml import etree
+from werkzeug.datastructures import FileStorage
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.ddi.importer.metadata import namespaces
+
+import logging
+log = logging.getLogger(__name__)
+
+DATA_DICTIONARY_NAME = 'Data dictionary'
+DEFAULT_CHUNK_SIZE = 1000
+# CSV files bigger than this are spooled to disk instead of memory
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+VAR_TAG = '{%s}var' % namespaces['ddi']
+
+# Columns of the data dictionary, with their DataStore types
+FIELDS = [
+    ('name', 'text'),
+    ('label', 'text'),
+    ('question', 'text'),
+    ('type', 'text'),
+    ('interval', 'text'),
+    ('categories', 'text'),
+    ('valid', 'numeric'),
+    ('invalid', 'numeric'),
+    ('min', 'numeric'),
+    ('max', 'numeric'),
+    ('mean', 'numeric'),
+    ('stdev', 'numeric'),
+]
+# Columns of the `sumStat` of each type
+SUMMARY_STATISTICS = {
+    'vald': 'valid',
+    'invd': 'invalid',
+    'min': 'min',
+    'max': 'max',
+    'mean': 'mean',
+    'stdev': 'stdev',
+}
+
+
+def _compile(xpath):
+    return etree.XPath(xpath, namespaces=namespaces, smart_strings=False)
+
+
+LABEL_XPATH = _compile('string(ddi:labl)')
+QUESTION_XPATH = _compile('string(ddi:qstn/ddi:qstnLit)')
+TYPE_XPATH = _compile('string(ddi:varFormat/@type)')
+CATEGORIES_XPATH = _compile('ddi:catgry')
+CATEGORY_VALUE_XPATH = _compile('string(ddi:catValu)')
+SUMMARY_STATISTICS_XPATH = _compile('ddi:sumStat')
+
+
+def get_mode():
+    """
+        Return how the data dictionary is imported, set by
+        `ckanext.ddi.data_dictionary`: 'csv' (a CSV resource),
+        'datastore' (a DataStore table) or 'none' (the default)
+    """
+    return tk.config.get('ckanext.ddi.data_dictionary', 'none')
+
+
+def get_chunk_size():
+    return tk.asint(tk.config.get(
+        'ckanext.ddi.data_dictionary_chunk_size', DEFAULT_CHUNK_SIZE
+    ))
+
+
+def iter_variables(source):
+    """
+        Yield the variables of the `dataDscr` of a DDI document (a file-like
+        object or a file path) as dicts with the FIELDS keys
+
+        The document is parsed with iterparse, and each variable is cleared
+        once it is read, so the memory used does not depend on the number
+        of variables.
+    """
+    for event, element in etree.iterparse(source, events=('end',), tag=VAR_TAG):
+        yield get_variable(element)
+        element.clear()
+        parent = element.getparent()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def get_variable(var):
+    """ Return the data dictionary entry of a `var` element """
+    variable = {
+        'name': var.get('name', ''),
+        'label': LABEL_XPATH(var).strip(),
+        'question': QUESTION_XPATH(var).strip(),
+        'type': TYPE_XPATH(var).strip(),
+        'interval': var.get('intrvl', ''),
+        'categories': '; '.join(
+            '%s=%s' % (
+                CATEGORY_VALUE_XPATH(category).strip(),
+                LABEL_XPATH(category).strip(),
+            )
+            for category in CATEGORIES_XPATH(var)
+        ),
+    }
+    for field in SUMMARY_STATISTICS.values():
+        variable[field] = ''
+    for statistic in SUMMARY_STATISTICS_XPATH(var):
+        field = SUMMARY_STATISTICS.get(statistic.get('type'))
+        if field is not None:
+            variable[field] = (statistic.text or '').strip()
+    return variable
+
+
+def write_csv(variables, output):
+    """
+        Write the variables as CSV to `output`, a binary file, and return
+        their number
+    """
+    names = [name for name, field_type in FIELDS]
+    if six.PY2:
+        text_output = output
+    else:
+        text_output = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    writer = csv.writer(text_output)
+    writer.writerow(names)
+    count = 0
+    for variable in variables:
+        row = [variable[name] for name in names]
+        if six.PY2:
+            row = [value.encode('utf-8') for value in row]
+        writer.writerow(row)
+        count += 1
+    if not six.PY2:
+        text_output.flush()
+        text_output.detach()
+    return count
+
+
+def read_csv(file_path):
+    """ Yield the variables of a data dictionary CSV file written by write_csv """
+    if six.PY2:
+        with open(file_path, 'rb') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield dict(
+                    (name, value.decode('utf-8')) for name, value in row.items()
+                )
+    else:
+        with io.open(file_path, encoding='utf-8', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield row
+
+
+def get_csv_upload(source):
+    """
+        Return the data dictionary of a DDI document as an uploaded CSV
+        file, or None if it has no variables
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if not write_csv(iter_variables(source), output):
+        output.close()
+        return None
+    output.seek(0)
+    return FileStorage(
+        output, filename='data-dictionary.csv', content_type='text/csv'
+    )
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _iter_records(variables):
+    for variable in variables:
+        for name, field_type in FIELDS:
+            if field_type == 'numeric':
+                variable[name] = _number(variable[name])
+        yield variable
+
+
+def get_data_dictionary_resource(pkg_dict):
+    """
+        Return the data dictionary resource of a dataset (the last one, if
+        previous imports added several), or None
+    """
+    resource = None
+    for candidate in pkg_dict.get('resources') or []:
+        if candidate.get('name') == DATA_DICTIONARY_NAME:
+            resource = candidate
+    return resource
+
+
+def write_datastore(
+    registry, package_id, variables, chunk_size=DEFAULT_CHUNK_SIZE, resource_id=None
+):
+    """
+        Create a DataStore resource with the data dictionary of a dataset,
+        and insert the variables `chunk_size` at a time
+
+        If `resource_id` is given (the data dictionary of a previous import),
+        its table is replaced instead of creating another resource.
+
+        The `last_modified` of the resource is set once all the variables
+        are inserted, so that exports of the dataset are generated again.
+
+        Returns the id of the resource, or None if there are no variables.
+    """
+    records = _iter_records(variables)
+    chunk = list(itertools.islice(records, chunk_size))
+    if not chunk:
+        return None
+
+    data_dict = {
+        'fields': [
+            {'id': name, 'type': field_type} for name, field_type in FIELDS
+        ],
+        'records': chunk,
+        'force': True,
+    }
+    if resource_id is None:
+        data_dict['resource'] = {
+            'package_id': package_id,
+            'name': DATA_DICTIONARY_NAME,
+            'format': 'csv',
+        }
+    else:
+        try:
+            registry.call_action('datastore_delete', {
+                'resource_id': resource_id,
+                'force': True,
+            })
+        except tk.ObjectNotFound:
+            pass
+        data_dict['resource_id'] = resource_id
+    result = registry.call_action('datastore_create', data_dict)
+    resource_id = result['resource_id']
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        registry.call_action('datastore_upsert', {
+            'resource_id': resource_id,
+            'records': chunk,
+            'method': 'insert',
+            'force': True,
+        })
+    registry.call_action('resource_patch', {
+        'id': resource_id,
+        'last_modified': datetime.datetime.utcnow().isoformat(),
+    })
+    return resource_id
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import rq
+from werkzeug.datastructures import FileStorage
+
+import ckan.lib.jobs as jobs
+import ckan.plugins.toolkit as tk
+
+from ckanext.ddi.importer import ddiimporter
+
+import logging
+log = logging.getLogger(__name__)
+
+# Keep the result of finished imports for a day, so their status can be
+# checked
+JOB_RESULT_TTL = 24 * 60 * 60
+
+
+def enqueue_import(user, data, files=None):
+    """
+        Enqueue the import of a dataset on the background jobs queue and
+        return the job id
+
+        `data` is the (serializable) import form data, and `files` maps the
+        upload fields ('upload', 'rdf_upload') to the (path, filename) of
+        the uploaded files, which are deleted once the job is done.
+    """
+    if files and 'upload' in files:
+        source = files['upload'][1]
+    else:
+        source = data.get('url')
+    kwargs = {'title': 'DDI import of %s' % source}
+    if tk.check_ckan_version(min_version='2.9'):
+        kwargs['rq_kwargs'] = {'result_ttl': JOB_RESULT_TTL}
+    job = tk.enqueue_job(import_dataset, [user, data, files], **kwargs)
+    return job.id
+
+
+def import_dataset(user, data, files=None):
+    """ Background job importing a dataset, returns its name """
+    files = files or {}
+    opened_files = []
+    try:
+        for field, (file_path, filename) in files.items():
+            opened_files.append(open(file_path, 'rb'))
+            data[field] = FileStorage(opened_files[-1], filename=filename)
+
+        importer = ddiimporter.DdiImporter(username=user, on_stage=_set_stage)
+        if 'upload' in files:
+            pkg_id = importer.run(
+                upload=data['upload'],
+                data=data,
+            )
+        else:
+            pkg_id = importer.run(url=data['url'], data=data)
+    except Exception as e:
+        _set_stage('failed', error=_get_error_message(e))
+        raise
+    finally:
+        for opened_file in opened_files:
+            opened_file.close()
+        for file_path, filename in files.values():
+            os.remove(file_path)
+
+    _set_stage('done', dataset=pkg_id)
+    return pkg_id
+
+
+def get_import_status(job_id):
+    """
+        Return the status of an import job: its stage (one of 'queued',
+        'fetching', 'parsing', 'creating', 'done' or 'failed'), the
+        imported dataset and the error if the import failed
+
+        Raises KeyError if there is no such job.
+    """
+    job = jobs.job_from_id(job_id)
+    status = job.get_status()
+    meta = job.meta or {}
+
+    if status == 'failed':
+        stage = 'failed'
+    elif status == 'finished':
+        stage = 'done'
+    elif status == 'started':
+        stage = meta.get('stage', 'queued')
+    else:
+        stage = 'queued'
+
+    error = None
+    if stage == 'failed':
+        error = meta.get('error')
+        if not error and job.exc_info:
+            error = job.exc_info.strip().splitlines()[-1]
+
+    return {
+        'id': job.id,
+        'user': job.args[0] if job.args else None,
+        'stage': stage,
+        'dataset': meta.get('dataset') or job.result,
+        'error': error,
+        'created': job.created_at.isoformat() if job.created_at else None,
+    }
+
+
+def _set_stage(stage, **kwargs):
+    job = rq.get_current_job()
+    if job is None:
+        return
+    job.meta['stage'] = stage
+    job.meta.update(kwargs)
+    getattr(job, 'save_meta', job.save)()
+
+
+def _get_error_message(error):
+    if isinstance(error, tk.ValidationError):
+        return str(error.error_summary or error.error_dict)
+    return str(error) or repr(error)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from werkzeug.datastructures import FileStorage
+
+import ckan.plugins.toolkit as tk
+
+
+def ddi_import_preview(context, data_dict):
+    """
+        Map a DDI file to a dataset and validate it, without creating it
+
+        The mapped metadata is cached by content hash, so importing the
+        same file afterwards doesn't parse it again.
+
+        :param upload: the DDI XML file
+        :type upload: uploaded file
+        :param url: URL of the DDI XML file, if there is no `upload`
+        :type url: string
+
+        The other fields of the import form (eg `owner_org` or `private`)
+        are applied to the dataset like an import does.
+
+        :returns: the mapped dataset (`pkg_dict`), the validation errors
+            (`errors`, empty if the file can be imported) and the outcome
+            the import would have (`status`: 'created', 'updated' or
+            'unchanged', or None if it would fail)
+        :rtype: dictionary
+    """
+    from ckanext.ddi.importer import ddiimporter, metadata
+
+    tk.check_access('ddi_import_preview', context, data_dict)
+
+    upload = data_dict.get('upload')
+    if not isinstance(upload, FileStorage):
+        upload = None
+    if upload is None and not data_dict.get('url'):
+        raise tk.ValidationError({
+            'upload': [tk._('An XML file (uploaded file or URL) is required')]
+        })
+
+    importer = ddiimporter.DdiImporter(username=context.get('user'))
+    try:
+        pkg_dict, errors = importer.preview(
+            url=data_dict.get('url') if upload is None else None,
+            upload=upload,
+            data=data_dict,
+        )
+    except (
+        ddiimporter.ContentFetchError,
+        ddiimporter.ContentImportError,
+        metadata.MetadataFormatError,
+    ) as e:
+        raise tk.ValidationError({'upload': [str(e)]})
+
+    pkg_dict.pop('resources', None)
+    return {'pkg_dict': pkg_dict, 'errors': errors, 'status': importer.status}
+
+
+def get_actions():
+    return {
+        'ddi_import_preview': ddi_import_preview,
+    }
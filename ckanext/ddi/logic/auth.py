@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+import ckan.plugins.toolkit as tk
+
+
+def ddi_import_preview(context, data_dict):
+    """ Previewing an import is allowed to the users who can import """
+    try:
+        tk.check_access(
+            'package_create', context, {'owner_org': data_dict.get('owner_org')}
+        )
+    except tk.NotAuthorized:
+        return {'success': False}
+    return {'success': True}
+
+
+def get_auth_functions():
+    return {
+        'ddi_import_preview': ddi_import_preview,
+    }
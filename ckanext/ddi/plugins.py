@@ -6,16 +6,43 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as tk
 
 from ckanext.ddi import blueprints
+from ckanext.ddi.logic import action, auth
 log = logging.getLogger(__name__)
 
 
 class DdiImport(plugins.SingletonPlugin):
     plugins.implements(plugins.IBlueprint)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    if tk.check_ckan_version(min_version='2.9'):
+        plugins.implements(plugins.IClick)
+
+    # The blueprint is registered by every CKAN process (web, CLI and
+    # workers), so blueprints.py must stay light: the views, commands and
+    # actions import the importer (and its dependencies, like lxml, ckanapi
+    # or ckanext-harvest) on first use
 
     def get_blueprint(self):
         return blueprints.ddi_import_blueprint
 
+    def get_commands(self):
+        from ckanext.ddi import cli
+        return cli.get_commands()
+
+    def get_actions(self):
+        return action.get_actions()
+
+    def get_auth_functions(self):
+        return auth.get_auth_functions()
+
+    def configure(self, config):
+        # The mapping file is compiled once, when CKAN starts
+        if config.get('ckanext.ddi.mapping_file'):
+            from ckanext.ddi.importer import mapping
+            mapping.load_mapping_file(config['ckanext.ddi.mapping_file'])
+
     def update_config(self, config):
         tk.add_template_directory(config, 'templates')
         tk.add_resource('fanstatic', 'ddi')
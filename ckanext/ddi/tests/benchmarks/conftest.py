@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.ddi.importer import ddiimporter
+from ckanext.ddi.tests import ddi_generator
+
+# The benchmarks take a while, so they are only run when DDI_BENCHMARKS is set
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Number of variables of the benchmarked codebooks. The biggest ones are
+# only used when DDI_BENCHMARK_LARGE is set, as they take a while to run.
+SIZES = [0, 1000, 10000]
+LARGE_SIZES = [100000]
+
+CHOICES_COUNT = 100
+SEED = 1
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get('DDI_BENCHMARKS'):
+        return
+    skip = pytest.mark.skip(reason='set DDI_BENCHMARKS=1 to run the benchmarks')
+    for item in items:
+        if str(item.fspath).startswith(BENCHMARKS_DIR + os.sep):
+            item.add_marker(skip)
+
+
+def get_sizes():
+    if os.environ.get('DDI_BENCHMARK_LARGE'):
+        return SIZES + LARGE_SIZES
+    return SIZES
+
+
+@pytest.fixture(params=get_sizes(), ids=lambda size: '%d-variables' % size)
+def codebook(request):
+    return ddi_generator.make_codebook(seed=SEED, variables=request.param)
+
+
+@pytest.fixture
+def schema(monkeypatch):
+    """ Stand-in for the scheming schema used by improve_pkg_dict """
+    choices = [
+        {'value': 'choice-%d' % i, 'label': 'Choice %d' % i}
+        for i in range(CHOICES_COUNT)
+    ]
+    schema = {
+        'dataset_fields': [
+            {'field_name': 'keywords', 'choices': choices},
+            {'field_name': 'data_collection_technique', 'choices': choices},
+        ]
+    }
+    monkeypatch.setattr(
+        ddiimporter, 'scheming_get_dataset_schema', lambda dataset_type: schema
+    )
+    return schema
+
+
+class LocalCKAN(object):
+    """ Stand-in for ckanapi.LocalCKAN that does not need a database """
+    def __init__(self, username=None):
+        self.username = username
+
+    def call_action(self, action, data_dict):
+        pkg_dict = dict(data_dict)
+        pkg_dict['resources'] = [
+            dict(resource, id='resource-%d' % position)
+            for position, resource in enumerate(pkg_dict.get('resources', []))
+        ]
+        return pkg_dict
+
+
+class ResourceUpload(object):
+    """ Stand-in for the resource uploader, reading the whole upload """
+    def __init__(self, resource):
+        self.upload_file = resource.pop('upload').stream
+
+    def upload(self, resource_id, max_size):
+        self.upload_file.seek(0)
+        while self.upload_file.read(64 * 1024):
+            pass
+
+
+@pytest.fixture
+def local_ckan(monkeypatch, schema):
+    """
+        Let DdiImporter.run go through without Solr nor Postgres, nor a
+        configured CKAN
+    """
+    # every run imports the same codebook, which must be parsed each time
+    monkeypatch.setitem(tk.config, 'ckanext.ddi.metadata_cache_size', 0)
+    monkeypatch.setitem(tk.config, 'ckanext.ddi.data_dictionary', 'csv')
+    monkeypatch.setattr(ddiimporter.ckanapi, 'LocalCKAN', LocalCKAN)
+    monkeypatch.setattr(ddiimporter, 'get_existing_names', lambda name: set())
+    monkeypatch.setattr(ddiimporter.uploader, 'get_resource_uploader', ResourceUpload)
+    monkeypatch.setattr(
+        ddiimporter.uploader, 'get_max_resource_size', lambda: 10 * 1024 * 1024
+    )
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import io
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from ckanext.ddi.importer import metadata
+from ckanext.ddi.importer.ddiimporter import DdiImporter
+from ckanext.ddi.tests import ddi_generator
+from ckanext.ddi.tests.benchmarks.conftest import SEED
+
+pytest.importorskip('pytest_benchmark')
+
+
+class TestBenchmarkMapping(object):
+    def test_load(self, benchmark, codebook):
+        ckan_metadata = metadata.DdiCkanMetadata()
+        pkg_dict = benchmark(ckan_metadata.load, codebook)
+        assert pkg_dict['name'] == 'DDI-synthetic-1'
+
+    def test_load_stream(self, benchmark, codebook):
+        ckan_metadata = metadata.DdiCkanMetadata()
+        pkg_dict = benchmark(
+            lambda: ckan_metadata.load_stream(io.BytesIO(codebook))
+        )
+        assert pkg_dict['name'] == 'DDI-synthetic-1'
+
+    def test_improve_pkg_dict(self, benchmark, schema):
+        pkg_dict = metadata.DdiCkanMetadata().load(ddi_generator.make_codebook(seed=SEED))
+        pkg_dict['keywords'] = [
+            {'value': 'Choice %d' % i, 'abbr': ''} for i in range(0, 100, 5)
+        ]
+        importer = DdiImporter()
+
+        def setup():
+            return (copy.deepcopy(pkg_dict), None, {'owner_org': 'org'}), {}
+
+        pkg_dict = benchmark.pedantic(
+            importer.improve_pkg_dict, setup=setup, rounds=200
+        )
+        assert pkg_dict['name'] == 'ddi-synthetic-1'
+
+
+class TestBenchmarkImport(object):
+    def test_run(self, benchmark, codebook, local_ckan):
+        importer = DdiImporter(username='benchmark')
+        upload = FileStorage(io.BytesIO(codebook), filename='ddi.xml')
+        name = benchmark(
+            importer.run, upload=upload, data={'owner_org': 'org'}
+        )
+        assert name == 'ddi-synthetic-1'
+        assert importer.status == 'created'
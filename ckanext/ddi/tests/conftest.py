@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import ckan.lib.uploader
+
+
+@pytest.fixture
+def storage_path(monkeypatch, tmpdir, ckan_config):
+    """ Store the uploaded files in a temporary directory """
+    monkeypatch.setitem(ckan_config, u'ckan.storage_path', str(tmpdir))
+    monkeypatch.setattr(ckan.lib.uploader, u'_storage_path', str(tmpdir))
+    return str(tmpdir)
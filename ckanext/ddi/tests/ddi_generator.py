@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+    Generator of synthetic DDI 2.x codebooks, for benchmarks and load tests
+
+    The documents are streamed with lxml's incremental writer, so codebooks
+    of any size can be written without holding them in memory. The same
+    seed and counts always give the same document.
+
+    Usage:
+
+        python -m ckanext.ddi.tests.ddi_generator --variables 100000 \\
+            --seed 1 --output codebook.xml
+"""
+import argparse
+import io
+import random
+import sys
+
+from lxml import etree
+
+DDI_NAMESPACE = 'http://www.icpsr.umich.edu/DDI'
+
+WORDS = (
+    'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing',
+    'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore',
+    'et', 'dolore', 'magna', 'aliqua', 'enim', 'ad', 'minim', 'veniam',
+    'quis', 'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi',
+    'aliquip', 'ex', 'ea', 'commodo', 'consequat',
+)
+NATIONS = (
+    ('MRT', 'Mauritania'),
+    ('JOR', 'Jordan'),
+    ('KEN', 'Kenya'),
+    ('LBN', 'Lebanon'),
+    ('UGA', 'Uganda'),
+    ('COL', 'Colombia'),
+    ('BGD', 'Bangladesh'),
+    ('TCD', 'Chad'),
+)
+COLLECTION_MODES = (
+    'Computer Assisted Personal Interview [capi]',
+    'Computer Assisted Telephone Interview [cati]',
+    'Face-to-face [f2f]',
+    'Paper Assisted Personal Interview [papi]',
+)
+DATA_KINDS = (
+    'Sample survey data [ssd]',
+    'Census/enumeration data [cen]',
+    'Administrative records data [adm]',
+)
+SUMMARY_STATISTICS = ('vald', 'invd', 'min', 'max', 'mean', 'stdev')
+
+
+def _tag(name):
+    return '{%s}%s' % (DDI_NAMESPACE, name)
+
+
+class CodebookGenerator(object):
+    """
+        Writer of synthetic DDI codebooks
+
+        The counts set the number of elements of each kind. Every variable
+        of `dataDscr` has `categories` categories and the summary
+        statistics of a numeric variable.
+    """
+    def __init__(
+        self,
+        seed=None,
+        nations=1,
+        topics=3,
+        keywords=4,
+        coll_dates=2,
+        data_collectors=3,
+        variables=0,
+        categories=5,
+    ):
+        self.seed = seed
+        self.nations = nations
+        self.topics = topics
+        self.keywords = keywords
+        self.coll_dates = coll_dates
+        self.data_collectors = data_collectors
+        self.variables = variables
+        self.categories = categories
+
+    def write(self, output):
+        """ Write a codebook to `output`, a file path or a binary file """
+        self.random = random.Random(self.seed)
+        with etree.xmlfile(output, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            with xf.element(
+                _tag('codeBook'),
+                {'version': '2.5', 'ID': self.get_id_number()},
+                nsmap={None: DDI_NAMESPACE},
+            ):
+                self._write_doc_dscr(xf)
+                self._write_stdy_dscr(xf)
+                self._write_file_dscr(xf)
+                self._write_data_dscr(xf)
+
+    def get_id_number(self):
+        return 'DDI-synthetic-%s' % self.seed
+
+    def _element(self, xf, name, text=None, **attrib):
+        with xf.element(_tag(name), attrib):
+            if text is not None:
+                xf.write(text)
+
+    def _words(self, count):
+        return ' '.join(self.random.choice(WORDS) for i in range(count))
+
+    def _sentence(self, words=12):
+        return self._words(words).capitalize() + '.'
+
+    def _paragraph(self, sentences=4):
+        return ' '.join(self._sentence() for i in range(sentences))
+
+    def _date(self):
+        return '20%02d-%02d-%02d' % (
+            self.random.randint(0, 20),
+            self.random.randint(1, 12),
+            self.random.randint(1, 28),
+        )
+
+    def _write_doc_dscr(self, xf):
+        with xf.element(_tag('docDscr')):
+            with xf.element(_tag('citation')):
+                with xf.element(_tag('titlStmt')):
+                    self._element(xf, 'titl', self._sentence(3))
+
+    def _write_stdy_dscr(self, xf):
+        with xf.element(_tag('stdyDscr')):
+            self._write_citation(xf)
+            self._write_stdy_info(xf)
+            self._write_method(xf)
+            with xf.element(_tag('dataAccs')):
+                with xf.element(_tag('useStmt')):
+                    self._element(xf, 'conditions', self._paragraph())
+                    self._element(xf, 'citReq', self._paragraph())
+
+    def _write_citation(self, xf):
+        with xf.element(_tag('citation')):
+            with xf.element(_tag('titlStmt')):
+                self._element(xf, 'titl', self._sentence(6))
+                self._element(xf, 'altTitl', self._words(2))
+                self._element(xf, 'IDNo', self.get_id_number())
+            with xf.element(_tag('rspStmt')):
+                self._element(
+                    xf, 'AuthEnty', self._sentence(4), affiliation='UNHCR'
+                )
+            with xf.element(_tag('prodStmt')):
+                for i in range(3):
+                    self._element(xf, 'producer', self._words(1))
+            with xf.element(_tag('distStmt')):
+                self._element(
+                    xf, 'contact', self._words(1), email='contact@example.org'
+                )
+            with xf.element(_tag('serStmt')):
+                self._element(xf, 'serName', 'Other Household Survey [hh/oth]')
+                self._element(xf, 'serInfo', self._paragraph())
+            with xf.element(_tag('verStmt')):
+                self._element(xf, 'version', '1.0', date=self._date())
+                self._element(xf, 'notes', self._sentence())
+
+    def _write_stdy_info(self, xf):
+        with xf.element(_tag('stdyInfo')):
+            with xf.element(_tag('subject')):
+                for i in range(self.keywords):
+                    self._element(xf, 'keyword', self._words(1))
+                for i in range(self.topics):
+                    self._element(xf, 'topcClas', self._words(2))
+            self._element(xf, 'abstract', self._paragraph(8))
+            with xf.element(_tag('sumDscr')):
+                for i in range(self.coll_dates):
+                    if self.coll_dates == 1:
+                        event = 'single'
+                    elif i == 0:
+                        event = 'start'
+                    elif i == self.coll_dates - 1:
+                        event = 'end'
+                    else:
+                        event = 'single'
+                    self._element(xf, 'collDate', date=self._date(), event=event)
+                for i in range(self.nations):
+                    abbr, name = NATIONS[i % len(NATIONS)]
+                    self._element(xf, 'nation', name, abbr=abbr)
+                self._element(xf, 'geogCover', self._words(2))
+                self._element(xf, 'anlyUnit', 'Household and individual')
+                self._element(xf, 'universe', self._paragraph())
+                self._element(xf, 'dataKind', self.random.choice(DATA_KINDS))
+            self._element(xf, 'notes', self._paragraph())
+
+    def _write_method(self, xf):
+        with xf.element(_tag('method')):
+            with xf.element(_tag('dataColl')):
+                for i in range(self.data_collectors):
+                    self._element(
+                        xf, 'dataCollector', self._words(2), abbr=self._words(1)
+                    )
+                self._element(xf, 'sampProc', self._paragraph())
+                self._element(xf, 'collMode', self.random.choice(COLLECTION_MODES))
+                self._element(xf, 'collSitu', self._sentence())
+                self._element(xf, 'weight', self._sentence())
+                self._element(xf, 'cleanOps', self._sentence())
+            with xf.element(_tag('anlyInfo')):
+                self._element(xf, 'respRate', self._sentence(5))
+
+    def _write_file_dscr(self, xf):
+        with xf.element(_tag('fileDscr'), {'ID': 'F1'}):
+            with xf.element(_tag('fileTxt')):
+                self._element(xf, 'fileName', 'household.dta')
+                with xf.element(_tag('dimensns')):
+                    self._element(
+                        xf, 'caseQnty', str(self.random.randint(100, 100000))
+                    )
+                    self._element(xf, 'varQnty', str(self.variables))
+
+    def _write_data_dscr(self, xf):
+        with xf.element(_tag('dataDscr')):
+            for i in range(self.variables):
+                self._write_var(xf, i)
+
+    def _write_var(self, xf, i):
+        with xf.element(_tag('var'), {
+            'ID': 'V%d' % (i + 1),
+            'name': 'v%d' % (i + 1),
+            'files': 'F1',
+            'dcml': '0',
+            'intrvl': 'discrete',
+        }):
+            self._element(xf, 'location', width='1')
+            self._element(xf, 'labl', self._words(3))
+            with xf.element(_tag('qstn')):
+                self._element(xf, 'qstnLit', self._words(8) + '?')
+            for statistic in SUMMARY_STATISTICS:
+                self._element(
+                    xf,
+                    'sumStat',
+                    str(self.random.randint(0, 1000)),
+                    type=statistic,
+                )
+            for value in range(1, self.categories + 1):
+                with xf.element(_tag('catgry')):
+                    self._element(xf, 'catValu', str(value))
+                    self._element(xf, 'labl', self._words(2))
+                    self._element(
+                        xf,
+                        'catStat',
+                        str(self.random.randint(0, 1000)),
+                        type='freq',
+                    )
+            self._element(xf, 'varFormat', type='numeric', schema='other')
+
+
+def make_codebook(**kwargs):
+    """ Return a synthetic codebook as bytes, see CodebookGenerator """
+    output = io.BytesIO()
+    CodebookGenerator(**kwargs).write(output)
+    return output.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic DDI codebook'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nations', type=int, default=1)
+    parser.add_argument('--topics', type=int, default=3)
+    parser.add_argument('--keywords', type=int, default=4)
+    parser.add_argument('--coll-dates', type=int, default=2)
+    parser.add_argument('--data-collectors', type=int, default=3)
+    parser.add_argument('--variables', type=int, default=0)
+    parser.add_argument('--categories', type=int, default=5)
+    parser.add_argument(
+        '--output', '-o', default='-', help='Output file, stdout by default'
+    )
+    args = parser.parse_args(argv)
+
+    generator = CodebookGenerator(
+        seed=args.seed,
+        nations=args.nations,
+        topics=args.topics,
+        keywords=args.keywords,
+        coll_dates=args.coll_dates,
+        data_collectors=args.data_collectors,
+        variables=args.variables,
+        categories=args.categories,
+    )
+    if args.output == '-':
+        generator.write(getattr(sys.stdout, 'buffer', sys.stdout))
+    else:
+        generator.write(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+
+from ckanext.ddi.importer import batch
+
+
+def _test_data_path(filename):
+    return os.path.join(os.path.dirname(__file__), 'test_data', filename)
+
+
+class TestFindFiles(object):
+    def test_directory(self, tmpdir):
+        shutil.copy(_test_data_path('ddi_test.xml'), str(tmpdir.join('a.xml')))
+        shutil.copy(_test_data_path('ddi_test.rdf'), str(tmpdir.join('b.rdf')))
+        assert batch.find_files([str(tmpdir)]) == [str(tmpdir.join('a.xml'))]
+
+    def test_glob_and_file(self, tmpdir):
+        for name in ('a.xml', 'b.xml'):
+            shutil.copy(_test_data_path('ddi_test.xml'), str(tmpdir.join(name)))
+        assert batch.find_files([str(tmpdir.join('*.xml'))]) == [
+            str(tmpdir.join('a.xml')), str(tmpdir.join('b.xml'))
+        ]
+        assert batch.find_files([str(tmpdir.join('b.xml'))]) == [
+            str(tmpdir.join('b.xml'))
+        ]
+
+    def test_manifest(self, tmpdir):
+        tmpdir.join('manifest.txt').write('# studies\na.xml\n\nsub/b.xml\n')
+        assert batch.find_files([str(tmpdir.join('manifest.txt'))]) == [
+            str(tmpdir.join('a.xml')), str(tmpdir.join('sub', 'b.xml'))
+        ]
+
+
+class TestParseFiles(object):
+    def test_parse_errors_are_returned(self, tmpdir):
+        tmpdir.join('invalid.xml').write('<codeBook>')
+        results = batch.parse_files([str(tmpdir.join('invalid.xml'))])
+        assert len(results) == 1
+        file_path, pkg_dict, error = results[0]
+        assert pkg_dict is None
+        assert 'Could not parse XML' in error
+
+
+class TestBatchImportStats(object):
+    def test_summary(self):
+        stats = batch.BatchImportStats()
+        stats.add(_test_data_path('ddi_test.xml'))
+        stats.add(_test_data_path('ddi_test.xml'), status='unchanged')
+        stats.add(_test_data_path('ddi_test.rdf'), 'error')
+        stats.finish()
+        assert stats.files == 3
+        assert stats.imported == 1
+        assert stats.unchanged == 1
+        assert stats.failures == [(_test_data_path('ddi_test.rdf'), 'error')]
+        assert '1 failures' in stats.summary()
@@ -4,7 +4,6 @@ import os
 import pytest
 import six
 import ckan.plugins.toolkit as toolkit
-import ckan.lib.uploader
 from ckantoolkit.tests import factories
 
 
@@ -42,11 +41,6 @@ def _load_test_data(filename):
     return open(os.path.join(os.path.dirname(__file__), 'test_data', filename), 'rb')
 
 
-def _patch_storage_path(monkeypatch, tmpdir, ckan_config):
-    monkeypatch.setitem(ckan_config, u'ckan.storage_path', str(tmpdir))
-    monkeypatch.setattr(ckan.lib.uploader, u'_storage_path', str(tmpdir))
-
-
 @pytest.mark.usefixtures('clean_db', 'clean_index')
 @pytest.mark.ckan_config("ckan.webassets.path", "/tmp/webassets")
 class TestBlueprints(object):
@@ -58,8 +52,7 @@ class TestBlueprints(object):
         app.get('/dataset/import', status=403)
         app.post('/dataset/import', status=403)
 
-    def test_form_display(self, app, monkeypatch, tmpdir, ckan_config):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_form_display(self, app, storage_path):
         resp = app.get(
             '/dataset/import',
             extra_environ=self.extra_environ,
@@ -70,10 +63,7 @@ class TestBlueprints(object):
             '<input id="field-rdf_upload" type="file" name="rdf_upload"', resp
         )
 
-    def test_form_submit_success_xml_file_from_upload(
-        self, app, monkeypatch, tmpdir, ckan_config
-    ):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_form_submit_success_xml_file_from_upload(self, app, storage_path):
         files = {'upload': 'ddi_test.xml'}
         resp = _post_request(
             app, '/dataset/import', {}, files, self.extra_environ, status=302
@@ -97,10 +87,7 @@ class TestBlueprints(object):
         assert len(dataset['resources']) == 1
         assert 'ddi_test.xml' in dataset['resources'][0]['url']
 
-    def test_form_submit_success_xml_and_rdf_files_from_uploads(
-        self, app, monkeypatch, tmpdir, ckan_config
-    ):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_form_submit_success_xml_and_rdf_files_from_uploads(self, app, storage_path):
         files = {'upload': 'ddi_test.xml', 'rdf_upload': 'ddi_test.rdf'}
         resp = _post_request(
             app, '/dataset/import', {}, files, self.extra_environ, status=302
@@ -125,22 +112,97 @@ class TestBlueprints(object):
         assert 'ddi_test.xml' in dataset['resources'][0]['url']
         assert 'ddi_test.rdf' in dataset['resources'][1]['url']
 
+    @pytest.mark.ckan_config('ckanext.ddi.async_imports', 'true')
+    def test_form_submit_async(self, app, monkeypatch, tmpdir, ckan_config, storage_path):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.async_upload_dir', str(tmpdir))
+        files = {'upload': 'ddi_test.xml'}
+        resp = _post_request(
+            app, '/dataset/import', {}, files, self.extra_environ, status=302
+        )
+        assert '/dataset/import/status/' in resp.headers['location']
+        job_id = resp.headers['location'].rstrip('/').split('/')[-1]
+
+        resp = app.get(
+            '/dataset/import/status/{}?format=json'.format(job_id),
+            extra_environ=self.extra_environ,
+            status=200,
+        )
+        assert resp.json['id'] == job_id
+        assert resp.json['stage'] == 'queued'
+
+    def test_form_preview(self, app, storage_path):
+        resp = _post_request(
+            app,
+            '/dataset/import',
+            {'preview': 'true'},
+            {'upload': 'ddi_test.xml'},
+            self.extra_environ,
+            status=200,
+        )
+        _assert_in_body('class="ddi-import-preview"', resp)
+        assert toolkit.get_action('package_search')({}, {})['count'] == 0
+
+    def test_import_status_not_found(self, app):
+        app.get(
+            '/dataset/import/status/not-a-job',
+            extra_environ=self.extra_environ,
+            status=404,
+        )
+
+    def test_import_timings(self, app, storage_path):
+        _post_request(
+            app, '/dataset/import', {}, {'upload': 'ddi_test.xml'},
+            self.extra_environ, status=302
+        )
+        resp = app.get('/dataset/import/timings', extra_environ=self.extra_environ)
+        _assert_in_body('"request"', resp)
+        _assert_in_body('"p95"', resp)
+
+    def test_import_timings_unauthorized_user(self, app):
+        user = factories.User()
+        app.get(
+            '/dataset/import/timings',
+            extra_environ={'REMOTE_USER': user['name'].encode('ascii')},
+            status=403,
+        )
+
+    def test_export(self, app, monkeypatch, tmpdir, ckan_config, storage_path):
+        monkeypatch.setitem(
+            ckan_config, u'ckanext.ddi.export_cache_dir', str(tmpdir.join('exports'))
+        )
+        resp = _post_request(
+            app, '/dataset/import', {}, {'upload': 'ddi_test.xml'},
+            self.extra_environ, status=302
+        )
+        pkg_id = resp.headers['Location'].split('/dataset/')[1].split('/')[0]
+        resp = app.get(
+            '/dataset/%s/ddi.xml' % pkg_id, extra_environ=self.extra_environ, status=200
+        )
+        _assert_in_body('<codeBook', resp)
+        _assert_in_body('<IDNo>', resp)
+        app.get(
+            '/dataset/%s/ddi.xml' % pkg_id,
+            headers={'If-None-Match': resp.headers['ETag']},
+            extra_environ=self.extra_environ,
+            status=304,
+        )
+
+    def test_export_not_found(self, app):
+        app.get(
+            '/dataset/not-a-dataset/ddi.xml',
+            extra_environ=self.extra_environ,
+            status=404,
+        )
+
     """
-    def test_form_submit_success_xml_file_from_url(
-        self, app, monkeypatch, tmpdir, ckan_config
-    ):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_form_submit_success_xml_file_from_url(self, app, storage_path):
         # TODO: test importing from a URL, mock the HTTP requests with responses
 
-    def test_form_submit_success_xml_and_rdf_files_from_urls(
-        self, app, monkeypatch, tmpdir, ckan_config
-    ):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_form_submit_success_xml_and_rdf_files_from_urls(self, app, storage_path):
         # TODO: test importing from URLs, mock the HTTP requests with responses
     """
 
-    def test_duplicate_dataset(self, app, monkeypatch, tmpdir, ckan_config):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_duplicate_dataset(self, app, storage_path):
         files = {'upload': 'ddi_test.xml'}
         resp = _post_request(
             app, '/dataset/import', {}, files, self.extra_environ, status=302
@@ -150,8 +212,7 @@ class TestBlueprints(object):
         )
         _assert_in_body('Dataset already exists and duplicates are not allowed', resp)
 
-    def test_form_submit_invalid(self, app, monkeypatch, tmpdir, ckan_config):
-        _patch_storage_path(monkeypatch, tmpdir, ckan_config)
+    def test_form_submit_invalid(self, app, storage_path):
         resp = _post_request(
             app, '/dataset/import', {}, {}, self.extra_environ, status=200
         )
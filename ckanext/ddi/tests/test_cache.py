@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import io
+
+from ckanext.ddi.importer import cache, metadata
+
+
+class _Redis(object):
+    """ Stand-in for a Redis client """
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.expiries[key] = ex
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.values) if fnmatch.fnmatch(key, pattern)]
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class TestMetadataCache(object):
+    def test_least_recently_used_items_are_evicted(self):
+        metadata_cache = cache.MetadataCache(size=2)
+        metadata_cache.set('a', {'name': 'a'})
+        metadata_cache.set('b', {'name': 'b'})
+        assert metadata_cache.get('a') == {'name': 'a'}
+        metadata_cache.set('c', {'name': 'c'})
+        assert metadata_cache.get('b') is None
+        assert metadata_cache.get('a') == {'name': 'a'}
+        assert metadata_cache.get('c') == {'name': 'c'}
+
+    def test_items_are_copied(self):
+        metadata_cache = cache.MetadataCache()
+        pkg_dict = {'tags': [{'name': 'a'}]}
+        metadata_cache.set('a', pkg_dict)
+        pkg_dict['tags'].append({'name': 'b'})
+        metadata_cache.get('a')['tags'].append({'name': 'c'})
+        assert metadata_cache.get('a') == {'tags': [{'name': 'a'}]}
+
+    def test_disabled(self):
+        metadata_cache = cache.MetadataCache(size=0)
+        metadata_cache.set('a', {'name': 'a'})
+        assert metadata_cache.get('a') is None
+
+    def test_items_expire(self, monkeypatch):
+        metadata_cache = cache.MetadataCache(ttl=60)
+        now = [1000.0]
+        monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+        metadata_cache.set('a', {'name': 'a'})
+        now[0] += 59
+        assert metadata_cache.get('a') == {'name': 'a'}
+        now[0] += 2
+        assert metadata_cache.get('a') is None
+        assert not metadata_cache.items
+
+    def test_content_hash(self, tmpdir):
+        path = tmpdir.join('ddi.xml')
+        path.write_binary(b'<codeBook/>')
+        fileobj = io.BytesIO(b'<codeBook/>')
+        fileobj.read()
+        assert cache.get_content_hash(fileobj) == cache.get_content_hash(str(path))
+        assert fileobj.tell() == 0
+        assert cache.get_content_hash(io.BytesIO(b'<other/>')) != \
+            cache.get_content_hash(str(path))
+
+    def test_key_depends_on_the_mapping(self):
+        class OtherMetadata(metadata.DdiCkanMetadata):
+            mapping = dict(
+                metadata.DdiCkanMetadata.mapping,
+                title=metadata.XPathTextValue('//ddi:codeBook/ddi:stdyDscr//ddi:titl'),
+            )
+
+        content_hash = cache.get_content_hash(io.BytesIO(b'<codeBook/>'))
+        key = cache.get_key(metadata.DdiCkanMetadata(), content_hash)
+        assert key == cache.get_key(metadata.DdiCkanMetadata(), content_hash)
+        assert key != cache.get_key(OtherMetadata(), content_hash)
+        assert key != cache.get_key(
+            metadata.DdiCkanMetadata(), cache.get_content_hash(io.BytesIO(b'<other/>'))
+        )
+
+
+class TestRedisMetadataCache(object):
+    def test_get_and_set(self):
+        connection = _Redis()
+        metadata_cache = cache.RedisMetadataCache(connection, ttl=60)
+        metadata_cache.set('a', {'tags': [{'name': 'a'}]})
+        assert metadata_cache.get('a') == {'tags': [{'name': 'a'}]}
+        assert metadata_cache.get('b') is None
+        assert connection.expiries == {cache.REDIS_KEY_PREFIX + 'a': 60}
+
+        connection.values['other'] = b'{}'
+        metadata_cache.clear()
+        assert list(connection.values) == ['other']
+
+    def test_errors_are_cache_misses(self):
+        class BrokenRedis(object):
+            def get(self, key):
+                raise IOError('Connection refused')
+
+            def set(self, key, value, ex=None):
+                raise IOError('Connection refused')
+
+        metadata_cache = cache.RedisMetadataCache(BrokenRedis())
+        metadata_cache.set('a', {'name': 'a'})
+        assert metadata_cache.get('a') is None
+
+
+class TestGetCache(object):
+    def test_configuration(self, monkeypatch, ckan_config):
+        monkeypatch.setattr(cache, '_caches', {})
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.metadata_cache_size', '10')
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.metadata_cache_ttl', '30')
+        metadata_cache = cache.get_cache()
+        assert (metadata_cache.size, metadata_cache.ttl) == (10, 30)
+        assert cache.get_cache() is metadata_cache
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from lxml import etree
+
+from ckanext.ddi.importer import metadata
+from ckanext.ddi.tests import ddi_generator
+
+
+def _count(xml, xpath):
+    return len(etree.fromstring(xml).xpath(xpath, namespaces=metadata.namespaces))
+
+
+class TestCodebookGenerator(object):
+    def test_codebooks_are_reproducible(self):
+        assert ddi_generator.make_codebook(seed=1, variables=10) == \
+            ddi_generator.make_codebook(seed=1, variables=10)
+        assert ddi_generator.make_codebook(seed=1, variables=10) != \
+            ddi_generator.make_codebook(seed=2, variables=10)
+
+    def test_counts(self):
+        xml = ddi_generator.make_codebook(
+            seed=1, nations=2, keywords=5, coll_dates=3, variables=20, categories=4
+        )
+        assert _count(xml, '//ddi:nation') == 2
+        assert _count(xml, '//ddi:keyword') == 5
+        assert _count(xml, '//ddi:collDate') == 3
+        assert _count(xml, '//ddi:dataDscr/ddi:var') == 20
+        assert _count(xml, '//ddi:var[1]/ddi:catgry') == 4
+        assert _count(xml, '//ddi:var[1]/ddi:sumStat') == 6
+
+    def test_codebooks_can_be_mapped(self):
+        xml = ddi_generator.make_codebook(seed=1, topics=2, variables=10)
+        pkg_dict = metadata.DdiCkanMetadata().load(xml)
+        assert pkg_dict['name'] == 'DDI-synthetic-1'
+        assert pkg_dict['data_collection_dates']
+        # the keywords are mapped from the topic classifications
+        assert len(pkg_dict['keywords']) == 2
+
+    def test_cli(self, tmpdir):
+        output = str(tmpdir.join('codebook.xml'))
+        ddi_generator.main(['--seed', '3', '--variables', '5', '--output', output])
+        with open(output, 'rb') as xml_file:
+            assert xml_file.read() == ddi_generator.make_codebook(seed=3, variables=5)
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from ckanext.ddi.importer import ddiimporter, metadata, variables
+from ckanext.ddi.tests import ddi_generator
+
+
+def _upload(content):
+    return FileStorage(io.BytesIO(content), filename='ddi.xml')
+
+
+class TestDigest(object):
+    def test_digest_does_not_depend_on_key_order(self):
+        assert ddiimporter.get_digest(
+            {'name': 'a', 'title': 'A'}
+        ) == ddiimporter.get_digest({'title': 'A', 'name': 'a'})
+
+    def test_digest_ignores_the_stored_digest(self):
+        pkg_dict = {'name': 'a'}
+        digest = ddiimporter.get_digest(pkg_dict)
+        pkg_dict[ddiimporter.DIGEST_FIELD] = digest
+        assert ddiimporter.get_digest(pkg_dict) == digest
+
+    def test_digest_includes_the_document(self):
+        # the variables of a document imported from a URL are not part of
+        # its metadata
+        digest = ddiimporter.get_digest({'name': 'a'}, content_hash='a' * 64)
+        assert digest == ddiimporter.get_digest({'name': 'a'}, content_hash='a' * 64)
+        assert digest != ddiimporter.get_digest({'name': 'a'}, content_hash='b' * 64)
+        assert digest != ddiimporter.get_digest({'name': 'a'})
+
+    def test_digest_field(self, monkeypatch):
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema',
+            lambda t: {'dataset_fields': [{'field_name': ddiimporter.DIGEST_FIELD}]},
+        )
+        pkg_dict = {'name': 'a'}
+        ddiimporter.set_digest(pkg_dict, 'digest')
+        assert pkg_dict == {'name': 'a', ddiimporter.DIGEST_FIELD: 'digest'}
+        assert ddiimporter.get_stored_digest(pkg_dict) == 'digest'
+
+    def test_digest_extra_without_digest_field(self, monkeypatch):
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema', lambda t: _schema([])
+        )
+        pkg_dict = {'name': 'a', 'extras': [
+            {'key': 'other', 'value': 'b'},
+            {'key': ddiimporter.DIGEST_FIELD, 'value': 'old-digest'},
+        ]}
+        ddiimporter.set_digest(pkg_dict, 'digest')
+        assert pkg_dict['extras'] == [
+            {'key': 'other', 'value': 'b'},
+            {'key': ddiimporter.DIGEST_FIELD, 'value': 'digest'},
+        ]
+        assert ddiimporter.get_stored_digest(pkg_dict) == 'digest'
+        assert ddiimporter.get_stored_digest({'name': 'a'}) is None
+
+    def test_content_hash_of_mapped_document(self, monkeypatch):
+        monkeypatch.setattr(ddiimporter.cache, '_caches', {})
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema', lambda t: _schema([])
+        )
+        codebook = ddi_generator.make_codebook(seed=1)
+        importer = ddiimporter.DdiImporter()
+        importer._get_pkg_dict(io.BytesIO(codebook))
+        assert importer.content_hash == ddiimporter.cache.get_content_hash(
+            io.BytesIO(codebook)
+        )
+
+
+class TestReplaceDataDictionary(object):
+    def test_data_dictionary_is_replaced_in_place(self):
+        resources = [
+            {'id': 'xml-id', 'name': 'DDI XML'},
+            {'id': 'dictionary-id', 'name': variables.DATA_DICTIONARY_NAME},
+        ]
+        new_resources = [
+            {'name': 'DDI XML', 'upload': 'xml'},
+            {'name': variables.DATA_DICTIONARY_NAME, 'upload': 'csv'},
+        ]
+        assert ddiimporter.replace_data_dictionary(resources, new_resources) == [
+            {'id': 'xml-id', 'name': 'DDI XML'},
+            {'id': 'dictionary-id', 'name': variables.DATA_DICTIONARY_NAME, 'upload': 'csv'},
+            {'name': 'DDI XML', 'upload': 'xml'},
+        ]
+
+    def test_first_data_dictionary_is_added(self):
+        new_resources = [{'name': variables.DATA_DICTIONARY_NAME, 'upload': 'csv'}]
+        assert ddiimporter.replace_data_dictionary(
+            [{'id': 'xml-id', 'name': 'DDI XML'}], new_resources
+        ) == [{'id': 'xml-id', 'name': 'DDI XML'}] + new_resources
+
+
+class _ResourcePlugin(object):
+    """ IResourceController plugin recording its calls """
+    def __init__(self):
+        self.calls = []
+
+    def before_create(self, context, resource):
+        self.calls.append(('before', dict(resource)))
+        resource['description'] = 'From DDI'
+
+    def after_create(self, context, resource):
+        self.calls.append(('after', dict(resource)))
+
+    before_resource_create = before_create
+    after_resource_create = after_create
+
+
+class _SavingRegistry(object):
+    def call_action(self, action, data_dict):
+        pkg_dict = dict(data_dict, id='pkg-id')
+        pkg_dict['resources'] = [
+            dict(resource, id=resource.get('id') or 'resource-%d' % position)
+            for position, resource in enumerate(data_dict['resources'])
+        ]
+        return pkg_dict
+
+
+class TestResourceHooks(object):
+    def test_hooks_of_new_resources(self, monkeypatch):
+        plugin = _ResourcePlugin()
+        monkeypatch.setattr(
+            ddiimporter.plugins, 'PluginImplementations', lambda interface: [plugin]
+        )
+        pkg_dict = {'name': 'dataset', 'resources': [
+            {'id': 'existing-id', 'name': 'Existing'},
+            {'name': 'DDI RDF', 'url': 'http://example.com/ddi.rdf'},
+        ]}
+        saved_pkg = ddiimporter.DdiImporter()._call_with_uploads(
+            _SavingRegistry(), 'package_create', pkg_dict
+        )
+        assert [(when, resource['name']) for when, resource in plugin.calls] == [
+            ('before', 'DDI RDF'), ('after', 'DDI RDF')
+        ]
+        assert plugin.calls[0][1]['package_id'] == 'dataset'
+        assert plugin.calls[1][1]['id'] == 'resource-1'
+        # changes of the before hook are saved, without the package id
+        assert saved_pkg['resources'][1]['description'] == 'From DDI'
+        assert 'package_id' not in pkg_dict['resources'][1]
+
+
+class _ImportRegistry(object):
+    """ Stand-in for ckanapi.LocalCKAN storing the created dataset """
+    calls = None
+    saved_pkg = None
+
+    def __init__(self, username=None):
+        self.username = username
+
+    def call_action(self, action, data_dict):
+        cls = type(self)
+        cls.calls.append((action, data_dict))
+        if action == 'package_create':
+            cls.saved_pkg = dict(data_dict, id='pkg-id', resources=[
+                dict(resource, id='resource-%d' % position)
+                for position, resource in enumerate(data_dict['resources'])
+            ])
+        if action in ('package_create', 'package_show'):
+            return cls.saved_pkg
+        return {'resource_id': 'dictionary-id'}
+
+
+class _ResourceUpload(object):
+    """ Stand-in for CKAN's uploader, copying the upload without rewinding it """
+    instances = None
+
+    def __init__(self, resource):
+        self.upload_file = resource.pop('upload').stream
+        if self.instances is not None:
+            self.instances.append(self)
+
+    def upload(self, resource_id, max_size):
+        while self.upload_file.read(1024):
+            pass
+
+
+@pytest.fixture
+def import_registry(monkeypatch):
+    """ Let DdiImporter.run store the imported dataset in _ImportRegistry """
+    monkeypatch.setattr(ddiimporter.cache, '_caches', {})
+    monkeypatch.setattr(
+        ddiimporter, 'scheming_get_dataset_schema', lambda t: _schema([])
+    )
+    monkeypatch.setattr(ddiimporter, 'get_existing_names', lambda name: set())
+    monkeypatch.setattr(ddiimporter.ckanapi, 'LocalCKAN', _ImportRegistry)
+    monkeypatch.setattr(_ImportRegistry, 'calls', [])
+    monkeypatch.setattr(
+        ddiimporter.uploader, 'get_resource_uploader', _ResourceUpload
+    )
+    monkeypatch.setattr(
+        ddiimporter.uploader, 'get_max_resource_size', lambda: 10 * 1024 * 1024
+    )
+    monkeypatch.setattr(_ResourceUpload, 'instances', [])
+
+
+class TestDataDictionary(object):
+    def test_not_imported_by_default(self, import_registry):
+        codebook = ddi_generator.make_codebook(seed=1, variables=5)
+        ddiimporter.DdiImporter().run(upload=_upload(codebook))
+
+        assert [action for action, data_dict in _ImportRegistry.calls] == ['package_create']
+        assert [resource['name'] for resource in _ImportRegistry.saved_pkg['resources']] == \
+            ['DDI XML']
+
+    def test_csv_upload_is_closed(self, import_registry, monkeypatch, ckan_config):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.data_dictionary', 'csv')
+        codebook = ddi_generator.make_codebook(seed=1, variables=5)
+        ddi_upload = _upload(codebook)
+        ddiimporter.DdiImporter().run(upload=ddi_upload)
+
+        assert [resource['name'] for resource in _ImportRegistry.saved_pkg['resources']] == \
+            ['DDI XML', variables.DATA_DICTIONARY_NAME]
+        xml_upload, csv_upload = _ResourceUpload.instances
+        assert csv_upload.upload_file.closed
+        # the DDI file belongs to the caller
+        assert not ddi_upload.stream.closed
+
+    def test_upload_in_datastore_mode(self, import_registry, monkeypatch, ckan_config):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.data_dictionary', 'datastore')
+        codebook = ddi_generator.make_codebook(seed=1, variables=5)
+        ddiimporter.DdiImporter().run(upload=_upload(codebook))
+
+        creates = [
+            data_dict for action, data_dict in _ImportRegistry.calls
+            if action == 'datastore_create'
+        ]
+        assert len(creates) == 1
+        assert len(creates[0]['records']) == 5
+
+
+def _schema(choices):
+    return {
+        'dataset_fields': [
+            {'field_name': 'keywords', 'choices': choices},
+            {'field_name': 'data_collection_technique', 'choices': choices},
+        ]
+    }
+
+
+class TestChoiceIndex(object):
+    def test_keywords(self, monkeypatch):
+        schema = _schema([
+            {'value': '1', 'label': 'Health'},
+            {'value': 'edu', 'label': 'Education'},
+        ])
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema', lambda t: schema
+        )
+        assert ddiimporter._get_keywords([
+            {'value': 'HEALTH'},
+            {'value': 'Schools', 'abbr': 'EDU'},
+            {'value': 'Unknown'},
+        ]) == ['1', 'edu', 'Unknown']
+
+    def test_data_collection_technique(self, monkeypatch):
+        schema = _schema([
+            {'value': 'f2f', 'label': 'Face-to-face interview'},
+            {'value': 'tel', 'label': 'Telephone interview'},
+        ])
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema', lambda t: schema
+        )
+        for xml_value, value in (
+            ('face-to-face interview', 'f2f'),
+            ('TEL', 'tel'),
+            ('Computer Assisted Telephone Interview [tel]', 'tel'),
+            ('Other', 'Other'),
+        ):
+            assert ddiimporter._get_data_collection_technique_value(xml_value) == value
+
+    def test_index_is_rebuilt_when_the_schema_changes(self, monkeypatch):
+        schema = _schema([{'value': 'a', 'label': 'A'}])
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema', lambda t: schema
+        )
+        index = ddiimporter.get_choice_index('keywords')
+        assert ddiimporter.get_choice_index('keywords') is index
+
+        schema = _schema([{'value': 'b', 'label': 'B'}])
+        assert ddiimporter.get_choice_index('keywords') is not index
+        assert ddiimporter._get_keywords([{'value': 'b'}]) == ['b']
+
+
+class TestGenFreeName(object):
+    def test_free_name(self):
+        assert ddiimporter.gen_free_name('ddi-test', set()) == 'ddi-test'
+        assert ddiimporter.gen_free_name('ddi-test', {'ddi-test', 'ddi-test1'}) == 'ddi-test2'
+
+    def test_long_names_are_truncated(self):
+        name = 'a' * 120
+        assert ddiimporter.gen_free_name(name, set()) == 'a' * 100
+        assert ddiimporter.gen_free_name(name, {'a' * 100}) == 'a' * 97 + '1'
+
+
+class TestNameAllocator(object):
+    def test_like_wildcards_are_escaped(self):
+        assert ddiimporter._escape_like('mics_2019') == 'mics\\_2019'
+        assert ddiimporter._escape_like('100%\\') == '100\\%\\\\'
+        assert ddiimporter._escape_like('mics-2019') == 'mics-2019'
+
+    def test_names_are_fetched_once_per_base_name(self, monkeypatch):
+        queries = []
+
+        def get_existing_names(name):
+            queries.append(name)
+            return {'mics-2019', 'mics-20191'}
+
+        monkeypatch.setattr(ddiimporter, 'get_existing_names', get_existing_names)
+        allocator = ddiimporter.NameAllocator()
+        assert allocator.exists('mics-2019')
+        assert [allocator.allocate('mics-2019') for i in range(3)] == [
+            'mics-20192', 'mics-20193', 'mics-20194'
+        ]
+        assert allocator.exists('mics-20194')
+        assert allocator.allocate('other') == 'other'
+        assert queries == ['mics-2019', 'other']
+
+
+class _Registry(object):
+    """ Stand-in for ckanapi.LocalCKAN, with a single existing dataset """
+    existing_pkg = None
+
+    def __init__(self, username=None):
+        self.username = username
+
+    def call_action(self, action, data_dict):
+        assert action == 'package_show'
+        return dict(self.existing_pkg)
+
+
+class TestPreview(object):
+    def _patch(self, monkeypatch, existing_names=(), errors=None):
+        validations = []
+        if errors is None:
+            errors = {'title': ['Missing value']}
+
+        def plugin_validate(package_plugin, context, data_dict, schema, action):
+            validations.append((action, data_dict))
+            return data_dict, errors
+
+        monkeypatch.setattr(
+            ddiimporter, 'scheming_get_dataset_schema', lambda t: _schema([])
+        )
+        monkeypatch.setattr(
+            ddiimporter, 'get_existing_names', lambda name: set(existing_names)
+        )
+        monkeypatch.setattr(ddiimporter.lib_plugins, 'plugin_validate', plugin_validate)
+        monkeypatch.setattr(ddiimporter.cache, '_caches', {})
+        return validations
+
+    def test_preview(self, monkeypatch, ckan_config):
+        validations = self._patch(monkeypatch, existing_names=['ddi-synthetic-1'])
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.allow_duplicates', 'true')
+        importer = ddiimporter.DdiImporter(username='user')
+        pkg_dict, errors = importer.preview(
+            upload=_upload(ddi_generator.make_codebook(seed=1))
+        )
+        assert pkg_dict['name'] == 'ddi-synthetic-1'
+        assert errors == {'title': ['Missing value']}
+        # validated with the name the dataset would be created with
+        assert validations[0][0] == 'package_create'
+        assert validations[0][1]['name'] == 'ddi-synthetic-11'
+
+    def test_preview_of_duplicate(self, monkeypatch, ckan_config):
+        validations = self._patch(monkeypatch, existing_names=['ddi-synthetic-1'])
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.allow_duplicates', 'false')
+        pkg_dict, errors = ddiimporter.DdiImporter().preview(
+            upload=_upload(ddi_generator.make_codebook(seed=1))
+        )
+        assert list(errors) == ['name']
+        assert validations == []
+
+    def test_preview_of_update(self, monkeypatch, ckan_config):
+        validations = self._patch(
+            monkeypatch, existing_names=['ddi-synthetic-1'], errors={}
+        )
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.override_datasets', 'true')
+        monkeypatch.setattr(ddiimporter.ckanapi, 'LocalCKAN', _Registry)
+        monkeypatch.setattr(_Registry, 'existing_pkg', {
+            'id': 'pkg-id',
+            'name': 'ddi-synthetic-1',
+            'owner_org': 'org-id',
+            ddiimporter.DIGEST_FIELD: 'old-digest',
+        })
+        monkeypatch.setattr(
+            ddiimporter.model.Package, 'get', staticmethod(lambda id: id), raising=False
+        )
+        importer = ddiimporter.DdiImporter()
+        pkg_dict, errors = importer.preview(
+            upload=_upload(ddi_generator.make_codebook(seed=1))
+        )
+        assert errors == {}
+        assert importer.status == 'updated'
+        # validated as merged into the existing dataset
+        action, data_dict = validations[0]
+        assert action == 'package_update'
+        assert data_dict['id'] == 'pkg-id'
+        assert data_dict['owner_org'] == 'org-id'
+        assert data_dict['title'] == pkg_dict['title']
+        assert ddiimporter.get_stored_digest(data_dict) not in (None, 'old-digest')
+
+    def test_preview_of_unchanged_dataset(self, monkeypatch, ckan_config):
+        validations = self._patch(monkeypatch, existing_names=['ddi-synthetic-1'])
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.override_datasets', 'true')
+        monkeypatch.setattr(ddiimporter.ckanapi, 'LocalCKAN', _Registry)
+        codebook = ddi_generator.make_codebook(seed=1)
+        importer = ddiimporter.DdiImporter()
+        pkg_dict = importer._get_pkg_dict(_upload(codebook).stream)
+        monkeypatch.setattr(_Registry, 'existing_pkg', {
+            'id': 'pkg-id',
+            'name': 'ddi-synthetic-1',
+            ddiimporter.DIGEST_FIELD: ddiimporter.get_digest(
+                pkg_dict, importer.content_hash
+            ),
+        })
+        importer = ddiimporter.DdiImporter()
+        pkg_dict, errors = importer.preview(upload=_upload(codebook))
+        assert errors == {}
+        assert importer.status == 'unchanged'
+        assert validations == []
+
+    def test_import_reuses_the_preview(self, monkeypatch):
+        self._patch(monkeypatch)
+        parsed = []
+        parse_stream = metadata.DdiCkanMetadata.parse_stream
+
+        def count_parse_stream(self, fileobj):
+            parsed.append(fileobj)
+            return parse_stream(self, fileobj)
+
+        monkeypatch.setattr(metadata.DdiCkanMetadata, 'parse_stream', count_parse_stream)
+        codebook = ddi_generator.make_codebook(seed=1)
+        importer = ddiimporter.DdiImporter()
+        preview_dict, errors = importer.preview(upload=_upload(codebook))
+        pkg_dict = importer._get_pkg_dict(_upload(codebook).stream)
+        assert pkg_dict == preview_dict
+        assert len(parsed) == 1
+
+        importer._get_pkg_dict(_upload(ddi_generator.make_codebook(seed=2)).stream)
+        assert len(parsed) == 2
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+
+from lxml import etree
+
+from ckanext.ddi import exporter
+from ckanext.ddi.importer import metadata, variables
+from ckanext.ddi.tests import ddi_generator
+
+
+def _load_test_data(filename):
+    return open(os.path.join(os.path.dirname(__file__), 'test_data', filename), 'rb')
+
+
+def _export(pkg_dict, dataset_variables=(), **kwargs):
+    return b''.join(
+        exporter.DdiExporter(**kwargs).generate(pkg_dict, dataset_variables)
+    )
+
+
+class TestDdiExporter(object):
+    def test_fields(self):
+        keys = [field.key for field in exporter.get_fields(metadata.DdiCkanMetadata.mapping)]
+        assert 'title' in keys
+        assert 'country' in keys
+        # combined values and the CKAN fields are not exported
+        assert 'author' not in keys
+        assert 'data_collection_dates' not in keys
+        assert 'id' not in keys
+
+    def test_round_trip(self):
+        with _load_test_data('ddi_test.xml') as xml_file:
+            pkg_dict = metadata.DdiCkanMetadata().load(xml_file.read())
+
+        exported = metadata.DdiCkanMetadata().load(_export(pkg_dict))
+
+        for field in exporter.get_fields(metadata.DdiCkanMetadata.mapping):
+            if field.key != 'data_collector':
+                assert exported[field.key] == pkg_dict[field.key], field.key
+
+    def test_imported_fields(self):
+        pkg_dict = {
+            'name': 'study-1',
+            'original_id': 'STUDY 1',
+            'notes': 'Abstract',
+            'tags': [{'name': 'health', 'display_name': 'health'}],
+            'keywords': ['shelter', 'water'],
+            'data_collector': 'UNHCR,WFP',
+        }
+        exported = metadata.DdiCkanMetadata().load(_export(pkg_dict))
+        assert exported['id_number'] == 'STUDY 1'
+        assert exported['abstract'] == 'Abstract'
+        assert exported['notes'] == ''
+        assert exported['tags'] == [{'name': 'health'}]
+        assert [keyword['value'] for keyword in exported['keywords']] == ['shelter', 'water']
+        assert [collector['value'] for collector in exported['data_collector']] == \
+            ['UNHCR', 'WFP']
+
+    def test_elements_order(self):
+        pkg_dict = {'conditions': 'Conditions', 'title': 'Title', 'version': '1',
+                    'production_date': '2020', 'version_notes': 'Notes'}
+        xml = etree.fromstring(_export(pkg_dict))
+        assert [element.tag.split('}')[1] for element in xml.iter()] == [
+            'codeBook', 'stdyDscr', 'citation', 'titlStmt', 'titl', 'verStmt',
+            'version', 'notes', 'dataAccs', 'useStmt', 'conditions',
+        ]
+        assert xml.find('.//{%s}version' % exporter.DDI_NAMESPACE).get('date') == '2020'
+
+    def test_version(self):
+        xml = etree.fromstring(_export({'title': 'Title'}))
+        assert xml.tag == '{http://www.icpsr.umich.edu/DDI}codeBook'
+        assert xml.get('version') == '1.2.2'
+        assert xml.get('{%s}schemaLocation' % exporter.XSI_NAMESPACE) == \
+            'http://www.icpsr.umich.edu/DDI http://www.icpsr.umich.edu/DDI/Version1-2-2.xsd'
+
+    def test_variables(self):
+        xml = ddi_generator.make_codebook(seed=1, variables=20)
+        dataset_variables = list(variables.iter_variables(io.BytesIO(xml)))
+
+        exported = _export({'title': 'Title'}, iter(dataset_variables))
+
+        assert list(variables.iter_variables(io.BytesIO(exported))) == dataset_variables
+
+    def test_variables_are_streamed(self):
+        xml = ddi_generator.make_codebook(seed=1, variables=200)
+        chunks = list(exporter.DdiExporter(chunk_size=1024).generate(
+            {'title': 'Title'}, variables.iter_variables(io.BytesIO(xml))
+        ))
+        assert len(chunks) > 10
+        assert len(list(variables.iter_variables(io.BytesIO(b''.join(chunks))))) == 200
+
+
+class TestExportCache(object):
+    def test_exports_are_cached(self, tmpdir):
+        cache = exporter.ExportCache(str(tmpdir))
+        pkg_dict = {'id': 'dataset-id', 'metadata_modified': '2020-01-01T10:00:00.000001'}
+        calls = []
+
+        def generate():
+            calls.append(1)
+            return iter([b'<codeBook', b'/>'])
+
+        assert b''.join(cache.stream(pkg_dict, generate)) == b'<codeBook/>'
+        assert b''.join(cache.stream(pkg_dict, generate)) == b'<codeBook/>'
+        assert len(calls) == 1
+        assert os.listdir(str(tmpdir)) == [os.path.basename(cache.get_path(pkg_dict))]
+
+        pkg_dict['metadata_modified'] = '2020-01-02T10:00:00.000001'
+        assert b''.join(cache.stream(pkg_dict, generate)) == b'<codeBook/>'
+        assert len(calls) == 2
+        assert os.listdir(str(tmpdir)) == [os.path.basename(cache.get_path(pkg_dict))]
+
+    def test_data_dictionary_changes_the_etag(self, tmpdir):
+        cache = exporter.ExportCache(str(tmpdir))
+        resource = {'id': 'resource-id', 'name': variables.DATA_DICTIONARY_NAME}
+        pkg_dict = {'id': 'dataset-id', 'metadata_modified': '2020-01-01T10:00:00',
+                    'resources': [resource]}
+        calls = []
+
+        def generate():
+            calls.append(1)
+            return iter([b'<codeBook/>'])
+
+        b''.join(cache.stream(pkg_dict, generate))
+        # the variables were written to the DataStore after the export
+        resource['last_modified'] = '2020-01-01T10:00:05'
+        b''.join(cache.stream(pkg_dict, generate))
+        assert len(calls) == 2
+
+    def test_incomplete_exports_are_not_cached(self, tmpdir):
+        cache = exporter.ExportCache(str(tmpdir))
+        pkg_dict = {'id': 'dataset-id', 'metadata_modified': '2020-01-01T10:00:00'}
+
+        stream = cache.stream(pkg_dict, lambda: iter([b'<codeBook', b'/>']))
+        next(stream)
+        stream.close()
+
+        assert os.listdir(str(tmpdir)) == []
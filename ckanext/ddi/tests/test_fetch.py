@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer
+
+from ckanext.ddi.importer import fetch
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    body = b'<codeBook/>'
+    status = 200
+    etag = None
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.etag and self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(self.status)
+        if self.etag:
+            self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server, path='/index.php/catalog/ddi/1'):
+    return 'http://127.0.0.1:%d%s' % (server.server_address[1], path)
+
+
+class TestFetch(object):
+    def test_fetch(self, server):
+        with fetch.fetch(_url(server)) as xml_file:
+            assert xml_file.read() == b'<codeBook/>'
+
+    def test_sessions_are_shared_per_host(self, server):
+        assert fetch.get_session(_url(server, '/a')) is fetch.get_session(
+            _url(server, '/b')
+        )
+        assert fetch.get_session(_url(server)) is not fetch.get_session(
+            'http://example.com/index.php/catalog/ddi/1'
+        )
+
+    def test_http_error(self, server, monkeypatch):
+        monkeypatch.setattr(_Handler, 'status', 404)
+        with pytest.raises(fetch.FetchError):
+            fetch.fetch(_url(server))
+
+    def test_max_bytes(self, server, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.fetch_max_bytes', '5')
+        with pytest.raises(fetch.ContentTooLargeError):
+            fetch.fetch(_url(server))
+
+    def test_connection_error(self):
+        with pytest.raises(fetch.FetchError):
+            fetch.fetch('http://127.0.0.1:1/index.php/catalog/ddi/1')
+
+
+class TestFetchCache(object):
+    def test_not_modified_documents_are_read_from_the_cache(
+        self, server, ckan_config, monkeypatch, tmpdir
+    ):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.fetch_cache_dir', str(tmpdir))
+        monkeypatch.setattr(_Handler, 'etag', '"v1"')
+
+        with fetch.fetch(_url(server)) as xml_file:
+            assert xml_file.read() == b'<codeBook/>'
+        monkeypatch.setattr(_Handler, 'body', b'<changed/>')
+        with fetch.fetch(_url(server)) as xml_file:
+            assert xml_file.read() == b'<codeBook/>'
+
+        assert 'If-None-Match' not in server.requests[0][1]
+        assert server.requests[1][1]['If-None-Match'] == '"v1"'
+
+    def test_modified_documents_are_fetched(
+        self, server, ckan_config, monkeypatch, tmpdir
+    ):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.fetch_cache_dir', str(tmpdir))
+        monkeypatch.setattr(_Handler, 'etag', '"v1"')
+        fetch.fetch(_url(server)).close()
+
+        monkeypatch.setattr(_Handler, 'etag', '"v2"')
+        monkeypatch.setattr(_Handler, 'body', b'<changed/>')
+        with fetch.fetch(_url(server)) as xml_file:
+            assert xml_file.read() == b'<changed/>'
+        assert fetch.get_cache().get_conditional_headers(_url(server)) == {
+            'If-None-Match': '"v2"'
+        }
+
+    def test_documents_without_validators_are_not_cached(
+        self, server, ckan_config, monkeypatch, tmpdir
+    ):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.fetch_cache_dir', str(tmpdir))
+        fetch.fetch(_url(server)).close()
+        assert tmpdir.listdir() == []
+
+    def test_download_is_used_if_it_cannot_be_cached(
+        self, server, ckan_config, monkeypatch, tmpdir
+    ):
+        # a file where the cache directory should be
+        tmpdir.join('cache').write('')
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.ddi.fetch_cache_dir', str(tmpdir.join('cache'))
+        )
+        monkeypatch.setattr(_Handler, 'etag', '"v1"')
+        with fetch.fetch(_url(server)) as xml_file:
+            assert xml_file.read() == b'<codeBook/>'
+
+    def test_least_recently_used_documents_are_evicted(self, tmpdir):
+        cache = fetch.FetchCache(str(tmpdir), 25)
+        for i in range(3):
+            url = 'http://example.com/%d' % i
+            cache.store(url, io.BytesIO(b'0123456789'), {'ETag': '"%d"' % i})
+            os.utime(cache._get_paths(url)[0], (i, i))
+        cache.store('http://example.com/3', io.BytesIO(b'0123456789'), {'ETag': '"3"'})
+
+        assert cache.open('http://example.com/0') is None
+        assert cache.open('http://example.com/1') is None
+        for i in (2, 3):
+            cached_file = cache.open('http://example.com/%d' % i)
+            assert cached_file.read() == b'0123456789'
+            cached_file.close()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import sys
+
+import pytest
+
+# Dependencies of the importer, which the plugin and blueprints.py (loaded
+# by every CKAN process) must only import when an import, preview or export
+# is run
+HEAVY_MODULES = (
+    'ckanapi',
+    'ckanext.harvest',
+    'ckanext.scheming',
+    'lxml',
+    'requests',
+    'ckanext.ddi.importer.ddiimporter',
+    'ckanext.ddi.importer.metadata',
+    'ckanext.ddi.exporter',
+    'ckanext.ddi.jobs',
+)
+
+
+# Imported before the module under test, so that the modules CKAN core
+# imports itself (eg requests, through ckan.model and the toolkit) are not
+# counted as imported by ckanext.ddi
+CKAN_CORE = (
+    'import ckan.plugins.toolkit as tk; tk.check_ckan_version; import ckan.model'
+)
+
+
+def get_imports(module):
+    """
+        Return the modules loaded by `import module` in a new interpreter
+        where CKAN core is already imported, as (depth, name) pairs in the
+        order of `python -X importtime` (imported modules come before the
+        module importing them)
+    """
+    output = subprocess.check_output(
+        [
+            sys.executable, '-X', 'importtime', '-c',
+            '%s; import %s' % (CKAN_CORE, module),
+        ],
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        name = line.split('|')[2]
+        imports.append((len(name) - len(name.lstrip()), name.strip()))
+    return imports
+
+
+def get_imported_by_ddi(imports):
+    """ Return the modules imported, directly or not, by ckanext.ddi modules """
+    names = set()
+    for position, (depth, name) in enumerate(imports):
+        for parent_depth, parent_name in imports[position + 1:]:
+            if parent_depth < depth:
+                if parent_name.startswith('ckanext.ddi'):
+                    names.add(name)
+                    break
+                depth = parent_depth
+    return names
+
+
+def _is_heavy(name):
+    return any(
+        name == module or name.startswith(module + '.') for module in HEAVY_MODULES
+    )
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='requires -X importtime')
+class TestImports(object):
+    @pytest.mark.parametrize('module', [
+        'ckanext.ddi.plugins',
+        'ckanext.ddi.blueprints',
+        'ckanext.ddi.cli',
+    ])
+    def test_heavy_modules_are_imported_on_first_use(self, module):
+        imported = get_imported_by_ddi(get_imports(module))
+        assert sorted(name for name in imported if _is_heavy(name)) == []
+
+    def test_importer_imports_its_dependencies(self):
+        imported = get_imported_by_ddi(get_imports('ckanext.ddi.importer.ddiimporter'))
+        assert 'lxml.etree' in imported or 'lxml' in imported
+
+
+class TestImporterPackage(object):
+    def test_attributes(self):
+        from ckanext.ddi import importer
+        from ckanext.ddi.importer import ddiimporter, metadata
+        assert importer.DdiImporter is ddiimporter.DdiImporter
+        assert importer.DdiCkanMetadata is metadata.DdiCkanMetadata
+        with pytest.raises(AttributeError):
+            importer.DdiExporter
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+
+import pytest
+import ckan.plugins.toolkit as toolkit
+from ckantoolkit.tests import factories
+
+from ckanext.ddi import jobs
+
+
+@pytest.mark.usefixtures('clean_db', 'clean_index')
+class TestImportJob(object):
+    def test_import_dataset(self, tmpdir, storage_path):
+        sysadmin = factories.Sysadmin()
+        file_path = str(tmpdir.join('upload'))
+        shutil.copy(
+            os.path.join(os.path.dirname(__file__), 'test_data', 'ddi_test.xml'),
+            file_path,
+        )
+
+        pkg_id = jobs.import_dataset(
+            sysadmin['name'], {}, {'upload': (file_path, 'ddi_test.xml')}
+        )
+
+        assert pkg_id == 'ddi-test-1'
+        assert not os.path.exists(file_path)
+        dataset = toolkit.get_action('package_show')(
+            {'ignore_auth': True}, {'id': pkg_id}
+        )
+        assert 'ddi_test.xml' in dataset['resources'][0]['url']
+
+    def test_import_dataset_failure_removes_files(self, tmpdir):
+        sysadmin = factories.Sysadmin()
+        file_path = str(tmpdir.join('upload'))
+        tmpdir.join('upload').write('<codeBook>')
+
+        with pytest.raises(Exception):
+            jobs.import_dataset(
+                sysadmin['name'], {}, {'upload': (file_path, 'invalid.xml')}
+            )
+        assert not os.path.exists(file_path)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from ckanext.ddi import exporter
+from ckanext.ddi.importer import mapping, metadata
+
+TEST_FILE = os.path.join(os.path.dirname(__file__), 'test_data', 'ddi_test.xml')
+
+MAPPING = {
+    'mapping': {
+        'title': '//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:altTitl',
+        'study_topics': {
+            'type': 'ArrayTextValue',
+            'separator': ', ',
+            'value': {
+                'type': 'XPathMultiTextValue',
+                'xpath': '//ddi:codeBook/ddi:stdyDscr/ddi:stdyInfo/ddi:subject/ddi:keyword',  # noqa
+            },
+        },
+        'source': {'type': 'StringValue', 'value': 'DDI'},
+    },
+}
+
+
+def _write_mapping(tmpdir, content, name='mapping.json'):
+    path = tmpdir.join(name)
+    path.write(json.dumps(content))
+    return str(path)
+
+
+@pytest.fixture
+def mapping_file(tmpdir, monkeypatch, ckan_config):
+    path = _write_mapping(tmpdir, MAPPING)
+    monkeypatch.setitem(ckan_config, 'ckanext.ddi.mapping_file', path)
+    return path
+
+
+class TestCompileMapping(object):
+    def test_keys_are_added_and_overridden(self):
+        cls = mapping.compile_mapping(MAPPING)
+        assert issubclass(cls, metadata.DdiCkanMetadata)
+        assert cls.metadata[:len(metadata.DdiCkanMetadata.metadata)] == \
+            metadata.DdiCkanMetadata.metadata
+        assert 'study_topics' in cls.metadata
+        assert isinstance(cls.mapping['study_topics'], metadata.ArrayTextValue)
+        assert cls.mapping['study_topics'].env['separator'] == ', '
+        assert cls.mapping['country'] is metadata.DdiCkanMetadata.mapping['country']
+
+    def test_documents_are_mapped(self):
+        default = metadata.DdiCkanMetadata().load_stream(TEST_FILE)
+        pkg_dict = mapping.compile_mapping(MAPPING)().load_stream(TEST_FILE)
+        assert pkg_dict['title'] == default['abbreviation']
+        assert pkg_dict['source'] == 'DDI'
+        assert pkg_dict['country'] == default['country']
+
+    def test_fingerprint_changes_with_the_mapping(self):
+        cls = mapping.compile_mapping(MAPPING)
+        assert cls().get_fingerprint() != metadata.DdiCkanMetadata().get_fingerprint()
+
+    @pytest.mark.parametrize('spec', [
+        {'type': 'PythonValue', 'xpath': '//ddi:codeBook'},
+        {'type': 'XPathTextValue', 'xpath': '//ddi:codeBook['},
+        {'type': 'XPathTextValue'},
+        {'type': 'ArrayTextValue'},
+        # a single value for a type taking a list
+        {'type': 'CombinedValue', 'value': '//ddi:codeBook/ddi:stdyDscr'},
+        {'type': 'ArrayValue', 'value': {
+            'type': 'XPathMultiValue', 'xpath': '//ddi:codeBook/ddi:stdyDscr',
+        }},
+        # a list for a type taking a single value
+        {'type': 'ArrayTextValue', 'values': [{
+            'type': 'XPathMultiTextValue', 'xpath': '//ddi:codeBook/ddi:stdyDscr',
+        }]},
+    ])
+    def test_invalid_specs(self, spec):
+        with pytest.raises(mapping.MappingFileError):
+            mapping.compile_mapping({'mapping': {'title': spec}})
+
+    def test_error_names_the_key(self):
+        with pytest.raises(mapping.MappingFileError) as e:
+            mapping.compile_mapping({'mapping': {'topics': {
+                'type': 'FirstInOrderValue', 'value': '//ddi:codeBook',
+            }}})
+        assert 'topics' in str(e.value)
+
+    def test_list_values(self):
+        cls = mapping.compile_mapping({'mapping': {'authors': {
+            'type': 'ArrayValue',
+            'values': [{
+                'type': 'XPathMultiTextValue',
+                'xpath': '//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:rspStmt/ddi:AuthEnty',  # noqa
+            }],
+        }}})
+        pkg_dict = cls().load_stream(TEST_FILE)
+        assert isinstance(pkg_dict['authors'], list)
+
+    def test_mapping_is_required(self):
+        with pytest.raises(mapping.MappingFileError):
+            mapping.compile_mapping(['title'])
+
+
+class TestGetMetadataClass(object):
+    def test_default_mapping(self, monkeypatch, ckan_config):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.mapping_file', '')
+        assert mapping.get_metadata_class() is metadata.DdiCkanMetadata
+
+    def test_compiled_once(self, mapping_file):
+        cls = mapping.get_metadata_class()
+        assert 'study_topics' in cls.metadata
+        assert mapping.get_metadata_class() is cls
+
+    def test_loaded_file_is_used_until_loaded_again(self, mapping_file):
+        cls = mapping.load_mapping_file(mapping_file)
+        with open(mapping_file, 'w') as f:
+            json.dump({'mapping': {'source': 'string(//ddi:codeBook/@ID)'}}, f)
+        assert mapping.get_metadata_class() is cls
+
+        new_cls = mapping.load_mapping_file(mapping_file)
+        assert mapping.get_metadata_class() is new_cls
+        assert 'study_topics' not in new_cls.metadata
+        assert new_cls().get_fingerprint() != cls().get_fingerprint()
+
+    def test_plugin_loads_the_file(self, mapping_file):
+        from ckanext.ddi.plugins import DdiImport
+        DdiImport().configure({'ckanext.ddi.mapping_file': mapping_file})
+        assert 'study_topics' in mapping._compiled[mapping_file].metadata
+
+    def test_yaml(self, tmpdir, monkeypatch, ckan_config):
+        yaml = pytest.importorskip('yaml')
+        path = tmpdir.join('mapping.yaml')
+        path.write(yaml.safe_dump(MAPPING))
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.mapping_file', str(path))
+        assert 'study_topics' in mapping.get_metadata_class().metadata
+
+    def test_missing_file(self, tmpdir, monkeypatch, ckan_config):
+        monkeypatch.setitem(
+            ckan_config, 'ckanext.ddi.mapping_file', str(tmpdir.join('missing.json'))
+        )
+        with pytest.raises(mapping.MappingFileError):
+            mapping.get_metadata_class()
+
+    def test_exporter_uses_the_mapping_file(self, mapping_file):
+        fields = exporter.DdiExporter().fields
+        assert [field.path for field in fields if field.key == 'title'] == \
+            [('stdyDscr', 'citation', 'titlStmt', 'altTitl')]
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from ckanext.ddi.importer import metadata
+
+
+def _load_test_data(filename):
+    return open(os.path.join(os.path.dirname(__file__), 'test_data', filename), 'rb')
+
+
+class TestXPathPlan(object):
+    def test_unique_expressions_are_compiled_once(self):
+        plan = metadata.DdiCkanMetadata().get_plan()
+        id_xpath = '//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:IDNo'
+        assert id_xpath in plan.xpaths
+        assert len(plan.xpaths) < len(metadata.DdiCkanMetadata.mapping)
+
+    def test_plan_is_shared_across_instances(self):
+        assert (
+            metadata.DdiCkanMetadata().get_plan()
+            is metadata.DdiCkanMetadata().get_plan()
+        )
+
+    def test_load(self):
+        with _load_test_data('ddi_test.xml') as f:
+            pkg_dict = metadata.DdiCkanMetadata().load(f.read())
+        assert pkg_dict['name'] == 'DDI-test 1'
+        assert pkg_dict['id'] == pkg_dict['id_number'] == pkg_dict['name']
+        assert pkg_dict['abstract'] == pkg_dict['description']
+
+    def test_expressions_are_anchored_at_study_description(self):
+        assert metadata.anchor_xpath(
+            '//ddi:codeBook/ddi:stdyDscr/ddi:citation/ddi:titlStmt/ddi:IDNo'
+        ) == ('stdyDscr', './ddi:citation/ddi:titlStmt/ddi:IDNo')
+        assert metadata.anchor_xpath(
+            '//ddi:codeBook/ddi:stdyDscr//ddi:citation/ddi:verStmt'
+        ) == ('stdyDscr', './/ddi:citation/ddi:verStmt')
+        assert metadata.anchor_xpath(
+            '//ddi:codeBook/ddi:stdyInfo/ddi:citation'
+        ) == ('codeBook', './ddi:stdyInfo/ddi:citation')
+        assert metadata.anchor_xpath('//ddi:var') == (None, '//ddi:var')
+
+
+class TestLoadStream(object):
+    def _add_variables(self, xml, count):
+        variables = b''.join(
+            b'<var name="v%d"><labl>Variable %d</labl></var>' % (i, i)
+            for i in range(count)
+        )
+        return xml.replace(
+            b'</codeBook>', b'<dataDscr>' + variables + b'</dataDscr></codeBook>'
+        )
+
+    def test_load_stream_matches_load(self):
+        with _load_test_data('ddi_test.xml') as f:
+            xml = self._add_variables(f.read(), 100)
+        ckan_metadata = metadata.DdiCkanMetadata()
+        assert ckan_metadata.load_stream(io.BytesIO(xml)) == ckan_metadata.load(xml)
+
+    def test_load_stream_from_path(self):
+        path = os.path.join(os.path.dirname(__file__), 'test_data', 'ddi_test.xml')
+        ckan_metadata = metadata.DdiCkanMetadata()
+        with _load_test_data('ddi_test.xml') as f:
+            assert ckan_metadata.load_stream(path) == ckan_metadata.load_stream(f)
+
+    def test_skipped_sections_are_not_built(self):
+        with _load_test_data('ddi_test.xml') as f:
+            xml = self._add_variables(f.read(), 100)
+        root = metadata._parse_stream(io.BytesIO(xml))
+        assert not root.xpath('//ddi:dataDscr', namespaces=metadata.namespaces)
+        assert root.xpath('//ddi:stdyDscr', namespaces=metadata.namespaces)
+
+    def test_invalid_xml(self):
+        with pytest.raises(metadata.MetadataFormatError):
+            metadata.DdiCkanMetadata().load_stream(io.BytesIO(b'<codeBook>'))
+
+
+class TestConcurrentLoad(object):
+    def test_mapping_does_not_keep_the_document(self):
+        with _load_test_data('ddi_test.xml') as f:
+            metadata.DdiCkanMetadata().load(f.read())
+        for value in metadata.DdiCkanMetadata.mapping.values():
+            assert 'xml' not in value.env
+            assert 'results' not in value.env
+
+    def test_concurrent_loads(self):
+        with _load_test_data('ddi_test.xml') as f:
+            xml = f.read()
+        documents = [
+            xml.replace(b'DDI-test 1', ('DDI-test %d' % i).encode('ascii'))
+            for i in range(20)
+        ]
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(metadata.DdiCkanMetadata().load, documents * 5)
+        finally:
+            pool.close()
+        assert [r['name'] for r in results] == [
+            'DDI-test %d' % i for i in range(20)
+        ] * 5
+
+    def test_mapped_values_do_not_reference_the_document(self):
+        with _load_test_data('ddi_test.xml') as f:
+            pkg_dict = metadata.DdiCkanMetadata().load(f.read())
+        assert pkg_dict['production_date']
+        assert pkg_dict['contact_persons_email']
+        for value in pkg_dict.values():
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                assert not hasattr(item, 'getparent')
+
+
+class TestFrozenMapping(object):
+    def test_values_are_read_only(self):
+        value = metadata.ArrayTextValue(
+            metadata.XPathMultiTextValue('//ddi:codeBook'), separator=', '
+        )
+        assert not hasattr(value, '__dict__')
+        with pytest.raises(AttributeError):
+            value.env = {}
+        with pytest.raises(TypeError):
+            value.env['separator'] = ' '
+        assert metadata.CombinedValue([value])._config == (value,)
+
+    def test_mapping_is_read_only(self):
+        with pytest.raises(TypeError):
+            metadata.DdiCkanMetadata.mapping['title'] = metadata.StringValue('')
+
+    def test_mapping_is_built_once_on_first_use(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            return {'title': metadata.StringValue('Title')}
+
+        class LazyMetadata(metadata.DdiCkanMetadata):
+            mapping = metadata.LazyMapping(build)
+
+        assert calls == []
+        assert LazyMetadata().get_attribute('title').get_value() == 'Title'
+        assert LazyMetadata.mapping is LazyMetadata().get_mapping()
+        assert calls == [1]
+
+    def test_keys_are_shared_across_instances(self):
+        assert metadata.DdiCkanMetadata().metadata is metadata.DdiCkanMetadata().metadata
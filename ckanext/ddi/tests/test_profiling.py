@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pstats
+
+from ckanext.ddi.importer import metadata, profiling
+
+
+class _Importer(object):
+    mapping_timings = None
+
+    def run(self, file_path):
+        ckan_metadata = metadata.DdiCkanMetadata()
+        ckan_metadata.load_xml(
+            ckan_metadata.parse_stream(file_path), timings=self.mapping_timings
+        )
+        return 'ddi-test-1'
+
+
+class TestImportProfiler(object):
+    def test_profile_and_mapping_timings_are_saved(self, tmpdir):
+        file_path = os.path.join(
+            os.path.dirname(__file__), 'test_data', 'ddi_test.xml'
+        )
+        importer = _Importer()
+        profiler = profiling.ImportProfiler(str(tmpdir))
+        assert profiler.run(importer, 'ddi_test.xml', file_path=file_path) == 'ddi-test-1'
+        assert importer.mapping_timings is None
+
+        pstats_path, mapping_path = profiler.paths
+        assert pstats_path.endswith('-ddi_test.xml.pstats')
+        assert pstats.Stats(pstats_path).total_calls > 0
+        with open(mapping_path) as mapping_file:
+            lines = mapping_file.read().splitlines()
+        assert lines[0].split() == ['key', 'ms']
+        assert lines[-1].split()[0] == 'total'
+        assert len(lines) == len(metadata.DdiCkanMetadata().metadata) + 2
+
+    def test_profiles_of_the_same_second_are_kept(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(profiling.time, 'strftime', lambda fmt: '20200101-000000')
+        file_path = os.path.join(
+            os.path.dirname(__file__), 'test_data', 'ddi_test.xml'
+        )
+        paths = set()
+        for i in range(2):
+            profiler = profiling.ImportProfiler(str(tmpdir))
+            profiler.run(_Importer(), 'ddi_test.xml', file_path=file_path)
+            paths.update(profiler.paths)
+        assert len(paths) == 4
+        assert sorted(os.listdir(str(tmpdir))) == sorted(
+            os.path.basename(path) for path in paths
+        )
+
+    def test_format_mapping_timings(self):
+        table = profiling.format_mapping_timings({'title': 0.001, 'abstract': 0.002})
+        assert [line.split() for line in table.splitlines()] == [
+            ['key', 'ms'],
+            ['abstract', '2.000'],
+            ['title', '1.000'],
+            ['total', '3.000'],
+        ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import socket
+
+from ckanext.ddi.importer import timing
+
+
+def _timer(status='created', **timings):
+    timer = timing.ImportTimer()
+    timer.timings.update(timings)
+    timer.status = status
+    return timer
+
+
+class TestImportTimer(object):
+    def test_stages_add_up(self):
+        timer = timing.ImportTimer()
+        for i in range(2):
+            with timer.stage('uploading'):
+                pass
+        timer.start('total')
+        timer.add_bytes('parsing', 10)
+        timer.add_bytes('parsing', 5)
+        timer.report('created')
+        assert list(timer.timings) == ['uploading', 'total']
+        assert timer.bytes == {'parsing': 15}
+        assert timer.status == 'created'
+
+
+class TestSinks(object):
+    def test_histogram(self):
+        histogram = timing.HistogramSink(size=100)
+        for i in range(1, 201):
+            histogram.record(_timer(parsing=float(i)))
+        histogram.record(_timer('failed'))
+        summary = histogram.get_summary()
+        assert summary['imports'] == {'created': 200, 'failed': 1}
+        assert summary['stages']['parsing'] == {
+            'count': 100, 'p50': 150.0, 'p95': 195.0, 'max': 200.0
+        }
+
+    def test_log(self, caplog):
+        with caplog.at_level(logging.INFO):
+            timing.LogSink().record(_timer(parsing=0.5))
+        assert 'DDI import status=created parsing_seconds=0.500' in caplog.text
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = timing.StatsdSink('127.0.0.1', server.getsockname()[1], 'ddi')
+            sink.record(_timer(parsing=0.5))
+            assert server.recv(1024) == b'ddi.status.created:1|c\nddi.parsing:500|ms'
+        finally:
+            server.close()
+
+    def test_configured_sinks(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'ckanext.ddi.timing_sinks', 'histogram log')
+        sinks = timing.get_sinks()
+        assert sinks[0] is timing.get_histogram()
+        assert isinstance(sinks[1], timing.LogSink)
+        assert timing.get_sinks() is sinks
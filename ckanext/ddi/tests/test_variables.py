@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+
+import six
+
+from ckanext.ddi.importer import variables
+from ckanext.ddi.tests import ddi_generator
+
+
+VAR = b'''<?xml version='1.0' encoding='UTF-8'?>
+<codeBook xmlns="http://www.icpsr.umich.edu/DDI">
+  <stdyDscr/>
+  <dataDscr>
+    <var ID="V1" name="age" intrvl="contin">
+      <labl>
+        Age
+      </labl>
+      <qstn><qstnLit>How old are you?</qstnLit></qstn>
+      <sumStat type="vald">10</sumStat>
+      <sumStat type="min">18</sumStat>
+      <sumStat type="max">99</sumStat>
+      <catgry><catValu>1</catValu><labl>Adult</labl></catgry>
+      <catgry><catValu>2</catValu><labl>Senior</labl></catgry>
+      <varFormat type="numeric"/>
+    </var>
+  </dataDscr>
+</codeBook>
+'''
+
+
+class _Registry(object):
+    def __init__(self):
+        self.calls = []
+
+    def call_action(self, action, data_dict):
+        self.calls.append((action, data_dict))
+        return {'resource_id': data_dict.get('resource_id', 'resource-id')}
+
+
+class TestVariables(object):
+    def test_get_variable(self):
+        assert list(variables.iter_variables(io.BytesIO(VAR))) == [{
+            'name': 'age',
+            'label': 'Age',
+            'question': 'How old are you?',
+            'type': 'numeric',
+            'interval': 'contin',
+            'categories': '1=Adult; 2=Senior',
+            'valid': '10',
+            'invalid': '',
+            'min': '18',
+            'max': '99',
+            'mean': '',
+            'stdev': '',
+        }]
+
+    def test_variables_are_streamed(self):
+        xml = ddi_generator.make_codebook(seed=1, variables=50)
+        names = [
+            variable['name']
+            for variable in variables.iter_variables(io.BytesIO(xml))
+        ]
+        assert names == ['v%d' % i for i in range(1, 51)]
+
+    def test_csv_upload(self):
+        upload = variables.get_csv_upload(io.BytesIO(VAR))
+        assert upload.filename == 'data-dictionary.csv'
+        content = upload.stream.read()
+        if six.PY3:
+            content = content.decode('utf-8')
+        rows = list(csv.reader(content.splitlines()))
+        assert rows[0] == [name for name, field_type in variables.FIELDS]
+        assert rows[1][:3] == ['age', 'Age', 'How old are you?']
+
+    def test_read_csv(self, tmpdir):
+        csv_path = str(tmpdir.join('data-dictionary.csv'))
+        with open(csv_path, 'wb') as csv_file:
+            variables.write_csv(variables.iter_variables(io.BytesIO(VAR)), csv_file)
+        assert list(variables.read_csv(csv_path)) == \
+            list(variables.iter_variables(io.BytesIO(VAR)))
+
+    def test_no_csv_upload_without_variables(self):
+        xml = ddi_generator.make_codebook(seed=1)
+        assert variables.get_csv_upload(io.BytesIO(xml)) is None
+
+    def test_datastore_chunks(self):
+        xml = ddi_generator.make_codebook(seed=1, variables=25)
+        registry = _Registry()
+        resource_id = variables.write_datastore(
+            registry,
+            'dataset',
+            variables.iter_variables(io.BytesIO(xml)),
+            chunk_size=10,
+        )
+        assert resource_id == 'resource-id'
+        assert [
+            (action, len(data_dict.get('records', ()))) for action, data_dict in registry.calls
+        ] == [
+            ('datastore_create', 10),
+            ('datastore_upsert', 10),
+            ('datastore_upsert', 5),
+            ('resource_patch', 0),
+        ]
+        # the resource is marked as modified once the variables are written
+        assert registry.calls[-1][1]['id'] == 'resource-id'
+        assert registry.calls[-1][1]['last_modified']
+        record = registry.calls[0][1]['records'][0]
+        assert isinstance(record['valid'], float)
+
+    def test_datastore_table_is_replaced(self):
+        xml = ddi_generator.make_codebook(seed=1, variables=5)
+        registry = _Registry()
+        resource_id = variables.write_datastore(
+            registry,
+            'dataset',
+            variables.iter_variables(io.BytesIO(xml)),
+            resource_id='previous-id',
+        )
+        assert resource_id == 'previous-id'
+        assert [action for action, data_dict in registry.calls] == [
+            'datastore_delete', 'datastore_create', 'resource_patch'
+        ]
+        assert 'resource' not in registry.calls[1][1]
+        assert registry.calls[1][1]['resource_id'] == 'previous-id'
+
+    def test_get_data_dictionary_resource(self):
+        pkg_dict = {'resources': [
+            {'id': '1', 'name': variables.DATA_DICTIONARY_NAME},
+            {'id': '2', 'name': 'DDI XML'},
+            {'id': '3', 'name': variables.DATA_DICTIONARY_NAME},
+        ]}
+        assert variables.get_data_dictionary_resource(pkg_dict)['id'] == '3'
+        assert variables.get_data_dictionary_resource({'resources': []}) is None